@@ -0,0 +1,83 @@
+# Checks the import time of rsinc.rsinc (python -X importtime) against a
+# budget and that no heavy UI modules are imported eagerly. Prints the results
+# as JSON and exits non-zero if the budget is blown.
+#
+# Usage: python benchmarks/bench_import.py --budget-ms 150
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Modules that must only be imported when they are used.
+LAZY = ("halo", "pyfiglet", "tqdm", "rfc3339", "cProfile", "pstats")
+
+
+def import_time():
+    # Returns (cumulative us importing rsinc.rsinc, set of modules imported).
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import rsinc.rsinc"],
+        cwd=ROOT,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+    total = None
+    modules = set()
+    for line in out.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        modules.add(name)
+        if name == "rsinc.rsinc":
+            total = int(cumulative)
+
+    return total, modules
+
+
+def version_time():
+    # Returns the wall time in seconds of 'python -m rsinc --version'.
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "rsinc", "--version"],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=150)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    import_time()  # Warm up the bytecode cache.
+
+    runs = [import_time() for _ in range(args.repeat)]
+    best = min(total for total, _ in runs) / 1000
+    eager = sorted(m for m in runs[0][1] if m.split(".")[0] in LAZY)
+
+    report = {
+        "import_ms": best,
+        "budget_ms": args.budget_ms,
+        "version_s": min(version_time() for _ in range(args.repeat)),
+        "eager_heavy_modules": eager,
+        "ok": best <= args.budget_ms and not eager,
+    }
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
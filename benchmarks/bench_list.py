@@ -0,0 +1,69 @@
+# Times fan-out listing (Backend.fan_list) against one sequential walk on the
+# Local backend, with an artificial latency per directory listed like a cloud
+# remote. Prints the results as JSON.
+#
+# Usage: python benchmarks/bench_list.py --dirs 500 --latency 0.01
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from rsinc.backends import Local  # noqa: E402
+
+
+def make_dirs(root, dirs, files, seed=0):
+    # Makes a random tree of dirs directories holding files empty files each.
+    rng = random.Random(seed)
+    made = [""]
+
+    for i in range(dirs):
+        d = os.path.join(rng.choice(made), "d%d" % i)
+        os.makedirs(os.path.join(root, d))
+        made.append(d)
+
+    for d in made:
+        for j in range(files):
+            open(os.path.join(root, d, "f%d" % j), "w").close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dirs", type=int, default=500)
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--workers", type=int, nargs="+", default=[4, 8, 16])
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        make_dirs(root, args.dirs, args.files)
+        results = {}
+
+        backend = Local({"bench:": root}, latency=args.latency)
+        start = time.perf_counter()
+        walk, _, _ = backend.list_dirs("bench:", "", args.dirs + 1)
+        results["sequential"] = time.perf_counter() - start
+
+        for workers in args.workers:
+            backend = Local({"bench:": root}, args.latency, workers)
+            start = time.perf_counter()
+            fan, _ = backend.fan_list("bench:")
+            results["fan_out_%d" % workers] = time.perf_counter() - start
+            assert sorted(fan) == sorted(walk), "listings differ"
+    finally:
+        shutil.rmtree(root)
+
+    report = {"params": vars(args), "entries": len(walk), "wall": results}
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
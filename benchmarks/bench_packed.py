@@ -0,0 +1,131 @@
+# Times pack, unpack, get_branch and merge on wide and deep trees and prints
+# the results as JSON. The recursive helpers rsinc used to have are timed
+# alongside for comparison, they fail on trees deeper than the recursion limit.
+#
+# Usage: python benchmarks/bench_packed.py --files 100000 --depth 4 200
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from rsinc.classes import Flat  # noqa: E402
+from rsinc import packed  # noqa: E402
+
+
+def old_insert(nest, chain):
+    if len(chain) == 2:
+        nest["file"].update({chain[0]: chain[1]})
+        return
+
+    if chain[0] not in nest["fold"]:
+        nest["fold"].update({chain[0]: packed.empty()})
+
+    old_insert(nest["fold"][chain[0]], chain[1:])
+
+
+def old_pack(flat):
+    nest = packed.empty()
+    for name, file in flat.names.items():
+        old_insert(nest, name.split("/") + [file.uid])
+
+    return nest
+
+
+def old_unpack(nest, flat, path=""):
+    for k, v in nest["file"].items():
+        flat.update(path + k, v)
+
+    for k, v in nest["fold"].items():
+        old_unpack(v, flat, path + k + "/")
+
+
+def old_get_branch(nest, chain):
+    if len(chain) == 0:
+        return nest
+    return old_get_branch(nest["fold"][chain[0]], chain[1:])
+
+
+def old_merge(nest, chain, new):
+    if len(chain) == 1:
+        nest["fold"].update({chain[0]: new})
+        return
+
+    if chain[0] not in nest["fold"]:
+        nest["fold"].update({chain[0]: packed.empty()})
+
+    old_merge(nest["fold"][chain[0]], chain[1:], new)
+
+
+OLD = {
+    "pack": old_pack,
+    "unpack": old_unpack,
+    "get_branch": lambda nest, path: old_get_branch(nest, path.split("/")),
+    "merge": lambda nest, path, new: old_merge(nest, path.split("/"), new),
+}
+NEW = {
+    "pack": packed.pack,
+    "unpack": packed.unpack,
+    "get_branch": packed.get_branch,
+    "merge": packed.merge,
+}
+
+
+def make_flat(files, depth):
+    # A Flat of files spread over 16 chains of directories depth deep.
+    flat = Flat("/bench")
+    for i in range(files):
+        dirs = ["d%d" % (j if j else i % 16) for j in range(depth)]
+        flat.update("/".join(dirs + ["f%d" % i]), "%d" % i)
+
+    return flat
+
+
+def run(helpers, flat, depth):
+    # Times each helper, None if it overflowed the stack.
+    out = {}
+    try:
+        start = time.perf_counter()
+        nest = helpers["pack"](flat)
+        out["pack"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        helpers["unpack"](nest, Flat("/bench"))
+        out["unpack"] = time.perf_counter() - start
+
+        deepest = "/".join("d%d" % (j if j else 0) for j in range(depth))
+        start = time.perf_counter()
+        for _ in range(1000):
+            branch = helpers["get_branch"](nest, deepest)
+            helpers["merge"](nest, deepest, branch)
+        out["get_branch_merge_x1000"] = time.perf_counter() - start
+    except RecursionError:
+        return None
+
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--depth", type=int, nargs="+", default=[4, 200])
+    args = parser.parse_args()
+
+    results = {}
+    for depth in args.depth:
+        flat = make_flat(args.files, depth)
+        results["depth_%d" % depth] = {
+            "recursive": run(OLD, flat, depth),
+            "iterative": run(NEW, flat, depth),
+        }
+
+    report = {"params": vars(args), "wall": results}
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
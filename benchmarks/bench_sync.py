@@ -0,0 +1,208 @@
+# Times the sync engine on synthetic trees and prints the results as JSON.
+#
+# Usage: python benchmarks/bench_sync.py --files 10000 100000 --out res.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from copy import deepcopy
+from datetime import datetime, timezone
+
+import ujson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from rsinc.classes import Flat, Struct  # noqa: E402
+from rsinc.packed import pack, unpack  # noqa: E402
+from rsinc.rclone import parse_lsjson, parse_hashsum, build_flat  # noqa: E402
+from rsinc.sync import calc_states, match_moves, match_states  # noqa: E402
+from synth import make_tree, mutate, conflicts, case_collisions  # noqa: E402
+
+LCL = "/bench/lcl"
+RMT = "bench:rmt"
+
+
+def peak_rss():
+    # Peak resident set size of this process in KiB (Linux units).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Timer:
+    # Records the wall/cpu time and peak RSS after each phase.
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        self.phases[name] = {
+            "wall": time.perf_counter() - wall,
+            "cpu": time.process_time() - cpu,
+            "peak_rss_kb": peak_rss(),
+        }
+
+
+def rclone_output(tree):
+    # Fakes the raw output of rclone lsjson and rclone hashsum for tree.
+    dicts = []
+    lines = []
+    for name, (size, hash, mtime) in tree.items():
+        stamp = datetime.fromtimestamp(mtime, timezone.utc).isoformat()
+        dicts.append(
+            {
+                "Path": name,
+                "Name": name.rsplit("/", 1)[-1],
+                "Size": size,
+                "ModTime": stamp.replace("+00:00", "Z"),
+                "IsDir": False,
+            }
+        )
+        lines.append(("%s  %s\n" % (hash, name)).encode())
+
+    return ujson.dumps(dicts), lines
+
+
+def run(args, files):
+    timer = Timer()
+
+    base = make_tree(files, args.depth, args.clone_ratio, seed=files)
+    rates = {
+        "move": args.move,
+        "rename": args.rename,
+        "delete": args.delete,
+        "update": args.update,
+        "create": args.create,
+    }
+    lcl_tree = mutate(base, rates, seed=1, prefix="l")
+    rmt_tree = mutate(base, rates, seed=2, prefix="r")
+    conflicts(lcl_tree, rmt_tree, args.conflict)
+    case_collisions(lcl_tree, rmt_tree, args.case)
+
+    text, lines = rclone_output(lcl_tree)
+    with timer("lsl_parse"):
+        entries = parse_lsjson(ujson.loads(text))
+        lcl = build_flat(LCL, entries, parse_hashsum(lines))
+    del text, lines, entries
+
+    rmt = Flat(RMT)
+    for name, (size, hash, mtime) in rmt_tree.items():
+        rmt.update(name, str(size) + hash, mtime)
+
+    last = Flat(LCL)
+    for name, (size, hash, mtime) in base.items():
+        last.update(name, str(size) + hash, mtime)
+
+    with timer("pack"):
+        nest = pack(last)
+    del last
+
+    with timer("master_save"):
+        fd, master = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as fp:
+            ujson.dump({"history": [], "ignores": [], "nest": nest}, fp)
+
+    with timer("master_load"):
+        with open(master, "r") as fp:
+            nest = ujson.load(fp)["nest"]
+    master_bytes = os.path.getsize(master)
+    os.remove(master)
+
+    old = Flat(LCL)
+    with timer("unpack"):
+        unpack(nest, old)
+    del nest
+
+    with timer("calc_states"):
+        calc_states(old, lcl)
+        calc_states(old, rmt)
+
+    track = Struct()
+    track.lcl = lcl.path
+    track.rmt = rmt.path
+    track.case = not args.case_sensitive
+
+    with timer("deepcopy"):
+        cp_lcl = deepcopy(lcl)
+        cp_rmt = deepcopy(rmt)
+
+    with timer("match_moves"):
+        match_moves(track, old, cp_lcl, cp_rmt)
+        match_moves(track, old, cp_rmt, cp_lcl)
+
+    with timer("match_states"):
+        cp_lcl.clean()
+        cp_rmt.clean()
+        match_states(track, cp_lcl, cp_rmt, recover=False)
+        match_states(track, cp_rmt, cp_lcl, recover=False)
+
+    return {
+        "files": files,
+        "lcl_files": len(lcl_tree),
+        "rmt_files": len(rmt_tree),
+        "ops": track.count,
+        "master_bytes": master_bytes,
+        "phases": timer.phases,
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        return out.stdout.decode().strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--files", type=int, nargs="+", default=[10000, 100000]
+    )
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--clone-ratio", type=float, default=0.02)
+    parser.add_argument("--move", type=float, default=0.01)
+    parser.add_argument("--rename", type=float, default=0.01)
+    parser.add_argument("--delete", type=float, default=0.01)
+    parser.add_argument("--update", type=float, default=0.01)
+    parser.add_argument("--create", type=float, default=0.01)
+    parser.add_argument("--conflict", type=float, default=0.001)
+    parser.add_argument("--case", type=float, default=0.001)
+    parser.add_argument("--case-sensitive", action="store_true")
+    parser.add_argument("--out", help="Write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        "results": [run(args, n) for n in args.files],
+    }
+
+    if args.out is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.out, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
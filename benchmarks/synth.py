@@ -0,0 +1,102 @@
+# Generates synthetic file trees for benchmarking the sync engine
+
+import random
+
+MUTATIONS = ("move", "rename", "delete", "update", "create")
+
+
+def _hash(rng):
+    # Random 40 character hex string, like a SHA-1.
+    return "%040x" % rng.getrandbits(160)
+
+
+def make_tree(files, depth=4, clone_ratio=0.02, seed=0):
+    """
+    @brief      Makes a random tree of files.
+
+    @param      files        Number of files
+    @param      depth        Maximum directory depth
+    @param      clone_ratio  Fraction of files that are copies of another file
+    @param      seed         Random seed
+
+    @return     Dict mapping names to (size, hash, modtime) tuples.
+    """
+    rng = random.Random(seed)
+    fanout = max(2, int(round(files ** (1 / (depth + 1)))))
+
+    tree = {}
+    hashes = []
+    for i in range(files):
+        levels = rng.randint(0, depth)
+        dirs = ["d%d" % rng.randrange(fanout) for _ in range(levels)]
+        name = "/".join(dirs + ["f%d.dat" % i])
+
+        if hashes and rng.random() < clone_ratio:
+            size, hash = rng.choice(hashes)
+        else:
+            size, hash = rng.randrange(1 << 20), _hash(rng)
+            hashes.append((size, hash))
+
+        tree[name] = (size, hash, 1.5e9 + i)
+
+    return tree
+
+
+def mutate(tree, rates, seed=0, prefix=""):
+    """
+    @brief      Applies random moves, renames, deletes, updates and creates.
+
+    @param      tree    Dict from make_tree, not modified
+    @param      rates   Dict mapping each of MUTATIONS to a fraction of files
+    @param      seed    Random seed
+    @param      prefix  Prefix for new names so two sides don't collide
+
+    @return     New dict of the mutated tree.
+    """
+    rng = random.Random(seed)
+    out = dict(tree)
+    names = sorted(tree)
+    dirs = sorted(set(n.rsplit("/", 1)[0] for n in names if "/" in n))
+
+    for kind in MUTATIONS:
+        count = int(rates.get(kind, 0) * len(names))
+        for i, name in enumerate(rng.sample(names, min(count, len(names)))):
+            if name not in out:
+                continue
+
+            base = name.rsplit("/", 1)[-1]
+            if kind == "move" and dirs:
+                new = rng.choice(dirs) + "/%s%s" % (prefix, base)
+                out[new] = out.pop(name)
+            elif kind == "rename":
+                out[name[: -len(base)] + prefix + "r" + base] = out.pop(name)
+            elif kind == "delete":
+                del out[name]
+            elif kind == "update":
+                size, _, time = out[name]
+                out[name] = (size + 1, _hash(rng), time + 1)
+            elif kind == "create":
+                new = name[: -len(base)] + "%sc%d.dat" % (prefix, i)
+                out[new] = (rng.randrange(1 << 20), _hash(rng), 2e9)
+
+    return out
+
+
+def conflicts(lcl, rmt, rate, seed=0):
+    # Updates the same files differently in lcl and rmt (in place).
+    rng = random.Random(seed)
+    common = sorted(set(lcl) & set(rmt))
+    for name in rng.sample(common, int(rate * len(common))):
+        size, _, time = lcl[name]
+        lcl[name] = (size + 2, _hash(rng), time + 2)
+        rmt[name] = (size + 3, _hash(rng), time + 3)
+
+
+def case_collisions(lcl, rmt, rate, seed=0):
+    # Creates files in lcl and rmt with names differing only by case.
+    rng = random.Random(seed)
+    names = sorted(lcl)
+    for i, name in enumerate(rng.sample(names, int(rate * len(names)))):
+        new = name[: -len(name.rsplit("/", 1)[-1])] + "Case%d.dat" % i
+        lcl[new] = (1, _hash(rng), 2e9)
+        rmt[new.lower()] = (2, _hash(rng), 2e9)
@@ -0,0 +1,630 @@
+# Provides the backends the sync engine uses to list and change files
+
+import os
+import shutil
+import subprocess
+import threading
+from time import sleep, monotonic
+
+from . import native
+from .classes import SubPool
+from .rclone import lsjson, lsjson_dirs, hashsum, build_flat
+from .rclone import split_cached, remember
+from .stats import stats, telemetry
+
+NUMBER_OF_WORKERS = 7
+FANOUT_SPLIT = 4  # Queued directories per worker before listing deeper.
+FANOUT_DEEP = 3  # Levels listed per call while the queue is long.
+
+# Makes rclone log its transfer stats as json lines (see SubPool).
+JSON_STATS = ["--use-json-log", "--stats", "1s", "--stats-log-level", "NOTICE"]
+
+
+class Backend:
+    # Interface between the sync engine and the files it syncs. Every path is
+    # a full path i.e. os.path.join(flat.path, name). Operations may run in the
+    # background until wait() is called.
+
+    workers = 1
+    fanout = ()  # Prefixes of the paths to list with fan_list.
+    shared = ()  # Paths whose listings are shared, see share().
+    hidden = frozenset()  # Names of the files lsl leaves out, see hide().
+
+    def list(self, path, names=None):
+        # Returns a list of (name, size, modtime) tuples of the files in path.
+        # If names is given only those files are listed, if they exist.
+        raise NotImplementedError
+
+    def hash(self, path, hash_name, names=None):
+        # Returns a dict mapping the names of the files in path to hashes. If
+        # names is given only those files need to be hashed.
+        raise NotImplementedError
+
+    def list_dirs(self, path, rel, depth, hash_name=None):
+        # Lists the directory rel, relative to path, depth levels deep. Returns
+        # a list of (name, size, modtime) tuples of the files found, a dict of
+        # any hashes the listing gave for free and a list of the directories
+        # on the last level, which were not listed. Names are relative to path.
+        raise NotImplementedError
+
+    def fan_list(self, path, hash_name=None):
+        # Lists path with list_dirs calls on up to workers directories at
+        # once. While few directories are queued they are listed one level at
+        # a time, to split the tree up, then FANOUT_DEEP levels at a time to
+        # save calls. Returns the entries and hashes, see list_dirs.
+        from concurrent.futures import ThreadPoolExecutor, wait
+        from concurrent.futures import FIRST_COMPLETED
+
+        entries, hashes, queue = [], {}, []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            first = executor.submit(self.list_dirs, path, "", 1, hash_name)
+            running = {first}
+
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found, free, dirs = future.result()
+                    entries += found
+                    hashes.update(free)
+                    queue += dirs
+
+                depth = 1
+                if len(queue) + len(running) > self.workers * FANOUT_SPLIT:
+                    depth = FANOUT_DEEP
+
+                while queue and len(running) < self.workers:
+                    running.add(
+                        executor.submit(
+                            self.list_dirs, path, queue.pop(), depth, hash_name
+                        )
+                    )
+
+        stats.count("fan_lists")
+        return entries, hashes
+
+    def fans(self, path):
+        # True if path should be listed with fan_list.
+        return any(path.startswith(prefix) for prefix in self.fanout)
+
+    def share(self, roots):
+        # Lists each of roots, a dict mapping paths to the paths inside them
+        # that lsl will list, once for all of those. Files changed through
+        # the backend since are re-listed before the listing is used again,
+        # and the listing is dropped after its last use.
+        self.shared = tuple(roots)
+        self.uses = {root: len(paths) for root, paths in roots.items()}
+        self.locks = {root: threading.Lock() for root in roots}
+        self.listings = {}  # Root -> dict of its listing, see _shared.
+        self.listing_lock = threading.Lock()
+
+    def hide(self, name):
+        # Leaves files called name out of the Flats from lsl, before they are
+        # hashed. list() still lists them.
+        self.hidden = self.hidden | {name}
+
+    def dirty(self, *paths):
+        # Marks paths as changed in the shared listings they are in.
+        if not self.shared:
+            return
+
+        with self.listing_lock:
+            for root, known in self.listings.items():
+                prefix = os.path.join(root, "")
+                for path in paths:
+                    if path.startswith(prefix):
+                        known["dirty"].add(path[len(prefix):])
+
+    def lsl(self, path, hash_name, cache=None, names=None, make=None):
+        # Returns a Flat of the files in path (or just those in names). If
+        # cache, a dict mapping paths to (size, modtime, hash), is given only
+        # files whose size or modtime do not match it are hashed. The cache is
+        # updated. See build_flat for make.
+        root = None if names is not None else self._shared_root(path)
+
+        if root is None:
+            entries, hashes = self._listing(path, hash_name, cache, names)
+        else:
+            entries, hashes = self._shared(root, path, hash_name, cache)
+
+        return build_flat(path, entries, hashes, make)
+
+    def _shared_root(self, path):
+        # Returns the shared root path is in, None if it is in none.
+        for root in self.shared:
+            if path == root or path.startswith(os.path.join(root, "")):
+                return root
+
+        return None
+
+    def _shared(self, root, path, hash_name, cache):
+        # Returns the entries and hashes of path from the listing of root, it
+        # is listed the first time and its changed files re-listed after.
+        # Only root's lock is held while listing, so other roots are listed
+        # at the same time.
+        with self.locks[root]:
+            with self.listing_lock:
+                known = self.listings.get(root)
+                fresh = known is None or known["hash"] != hash_name
+                if fresh:
+                    # Added first so files changed while listing are marked.
+                    known = {"hash": hash_name, "dirty": set()}
+                    self.listings[root] = known
+
+            if fresh:
+                entries, hashes = self._listing(root, hash_name, cache)
+                known["files"] = {e[0]: e for e in entries}
+                known["hashes"] = hashes
+
+            with self.listing_lock:
+                dirty = sorted(known["dirty"])
+                known["dirty"].clear()
+
+            if dirty:
+                entries, hashes = self._listing(root, hash_name, cache, dirty)
+                for name in dirty:
+                    known["files"].pop(name, None)
+                    known["hashes"].pop(name, None)
+                known["files"].update((e[0], e) for e in entries)
+                known["hashes"].update(hashes)
+
+            prefix = ""
+            if path != root:
+                prefix = path[len(root):].lstrip("/") + "/"
+            cut = len(prefix)
+
+            entries = [
+                (name[cut:], size, time)
+                for name, size, time in known["files"].values()
+                if name.startswith(prefix)
+            ]
+            hashes = {
+                name[cut:]: hash
+                for name, hash in known["hashes"].items()
+                if name.startswith(prefix)
+            }
+
+            self._used(root)
+
+        return entries, hashes
+
+    def _used(self, root):
+        # Counts a use of root's listing, dropping it after the last one.
+        with self.listing_lock:
+            self.uses[root] -= 1
+            if self.uses[root] > 0:
+                return
+
+            self.listings.pop(root, None)
+            self.shared = tuple(r for r in self.shared if r != root)
+
+    def _listing(self, path, hash_name, cache=None, names=None):
+        # Lists and hashes path for lsl, returns the entries and hashes.
+        with stats.phase("list"):
+            if names is None and self.fans(path):
+                free = hash_name if cache is None else None
+                entries, hashes = self.fan_list(path, free)
+            else:
+                entries, hashes = self.list(path, names), {}
+
+        if self.hidden:
+            hidden = self.hidden
+            entries = [
+                e for e in entries if os.path.basename(e[0]) not in hidden
+            ]
+
+        if cache is None:
+            todo = [e for e in entries if e[0] not in hashes]
+        else:
+            hashes, todo = split_cached(path, entries, cache)
+
+        stats.count("files_listed", len(entries))
+        if len(todo) > 0:
+            some = None
+            if names is not None or len(todo) < len(entries):
+                some = [e[0] for e in todo]
+
+            with stats.phase("hash"):
+                hashes.update(self.hash(path, hash_name, some))
+            stats.count("bytes_hashed", sum(e[1] for e in todo))
+
+        if cache is not None:
+            remember(path, entries, hashes, cache, names)
+
+        return entries, hashes
+
+    def lsl_many(self, path, hash_names, caches=None):
+        # Returns a dict mapping each hash name to a Flat of the files in path,
+        # caches optionally maps hash names to caches (see lsl).
+        caches = {} if caches is None else caches
+        return {h: self.lsl(path, h, caches.get(h)) for h in hash_names}
+
+    def read(self, path):
+        # Returns the contents (bytes) of the file at path, None if it can not
+        # be read.
+        raise NotImplementedError
+
+    def write(self, path, data):
+        # Replaces the file at path with data (bytes), right away.
+        raise NotImplementedError
+
+    def mkdir(self, path):
+        raise NotImplementedError
+
+    def copy(self, src, dst, size=0):
+        raise NotImplementedError
+
+    def move(self, src, dst):
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+    def rmdirs(self, path):
+        # Removes empty directories in path.
+        raise NotImplementedError
+
+    def wait(self):
+        # Blocks until all operations have finished.
+        return
+
+    def failures(self):
+        # Returns, and forgets, the full paths used by operations that failed.
+        return set()
+
+
+class Rclone(Backend):
+    # Runs every operation as an rclone subprocess in a SubPool. Local paths
+    # are listed and hashed in-process if native is set and the hash allows.
+
+    def __init__(
+        self, workers=NUMBER_OF_WORKERS, flags=None, native=True, fanout=()
+    ):
+        self.workers = workers
+        self.pool = SubPool(workers)
+        self.flags = [] if flags is None else flags
+        self.native = native
+        self.fanout = tuple(fanout)
+        self.follow = "-L" in self.flags or "--copy-links" in self.flags
+
+    def _is_native(self, path, hash_name=None):
+        if not self.native or not os.path.isabs(path):
+            return False
+
+        return hash_name is None or hash_name in native.HASHES
+
+    def list(self, path, names=None):
+        if not self._is_native(path):
+            return lsjson(path, self.flags, names)
+
+        if names is not None:
+            return list(native.stat_names(path, names, self.follow))
+
+        os.makedirs(path, exist_ok=True)
+        return list(native.scan(path, self.follow))
+
+    def list_dirs(self, path, rel, depth, hash_name=None):
+        return lsjson_dirs(path, rel, depth, self.flags, hash_name)
+
+    def hash(self, path, hash_name, names=None):
+        if self._is_native(path, hash_name):
+            return native.hash_dir(path, hash_name, self.follow, names)
+        else:
+            return hashsum(path, hash_name, names)
+
+    def lsl(self, path, hash_name, cache=None, names=None, make=None):
+        if self._is_native(path, hash_name):
+            return native.lsl(
+                path, hash_name, self.follow, cache, names, make
+            )
+        else:
+            return super().lsl(path, hash_name, cache, names, make)
+
+    def lsl_many(self, path, hash_names, caches=None):
+        hash_names = tuple(hash_names)
+        fast = [h for h in hash_names if self._is_native(path, h)]
+        rest = [h for h in hash_names if h not in fast]
+
+        flats = super().lsl_many(path, rest, caches)
+        if fast:
+            flats.update(native.lsl_many(path, fast, self.follow, caches))
+
+        return flats
+
+    def read(self, path):
+        stats.count("rclone_procs")
+        result = subprocess.run(
+            ["rclone", "cat", path] + self.flags, capture_output=True
+        )
+        return result.stdout if result.returncode == 0 else None
+
+    def write(self, path, data):
+        self.dirty(path)
+        stats.count("rclone_procs")
+        subprocess.run(["rclone", "rcat", path] + self.flags, input=data)
+
+    def mkdir(self, path):
+        stats.count("rclone_procs")
+        subprocess.run(["rclone", "mkdir", path])
+
+    def copy(self, src, dst, size=0):
+        self.dirty(dst)
+        cmd = ["rclone", "copyto", src, dst] + JSON_STATS
+        self.pool.run(cmd + self.flags, size=size)
+
+    def move(self, src, dst):
+        self.dirty(src, dst)
+        self.pool.run(["rclone", "moveto", src, dst] + self.flags)
+
+    def delete(self, path):
+        self.dirty(path)
+        self.pool.run(["rclone", "delete", path] + self.flags)
+
+    def rmdirs(self, path):
+        stats.count("rclone_procs")
+        subprocess.run(["rclone", "rmdirs", path])
+
+    def wait(self):
+        self.pool.wait()
+
+    def failures(self):
+        failed = set()
+        for args in self.pool.take_failed():
+            # i.e. ["rclone", "copyto", src, dst, flags...]
+            failed.update(a for a in args[2:4] if not a.startswith("-"))
+
+        return failed
+
+
+class Memory(Backend):
+    # In-memory fake holding (size, hash, modtime) for each path. Operations
+    # are instant, plus latency seconds, so the sync engine can be measured
+    # without rclone. The hash of a file does not depend on hash_name.
+
+    def __init__(self, latency=0, workers=NUMBER_OF_WORKERS):
+        self.files = {}
+        self.blobs = {}  # Path -> contents of the files made with write().
+        self.latency = latency
+        self.workers = workers
+
+    def put(self, path, size, hash, time=0):
+        self.files[path] = (size, hash, time)
+
+    def _under(self, path):
+        prefix = path.rstrip("/") + "/"
+        for full, meta in self.files.items():
+            if full.startswith(prefix):
+                yield full[len(prefix):], meta
+
+    def list(self, path, names=None):
+        sleep(self.latency)
+        found = [(n, size, t) for n, (size, _, t) in self._under(path)]
+
+        if names is not None:
+            names = set(names)
+            found = [e for e in found if e[0] in names]
+
+        return found
+
+    def hash(self, path, hash_name, names=None):
+        return {name: hash for name, (_, hash, _) in self._under(path)}
+
+    def read(self, path):
+        return self.blobs.get(path)
+
+    def write(self, path, data):
+        self.blobs[path] = data
+
+    def mkdir(self, path):
+        return
+
+    def copy(self, src, dst, size=0):
+        self.dirty(dst)
+        sleep(self.latency)
+        self.files[dst] = self.files[src]
+
+    def move(self, src, dst):
+        self.dirty(src, dst)
+        sleep(self.latency)
+        self.files[dst] = self.files.pop(src)
+
+    def delete(self, path):
+        self.dirty(path)
+        sleep(self.latency)
+        del self.files[path]
+
+    def rmdirs(self, path):
+        return
+
+
+class Local(Backend):
+    # Fake remote(s) backed by local directories. roots maps remote prefixes
+    # (i.e. "fake:") to directories, other paths are used as they are. Each
+    # directory list_dirs lists costs latency seconds, like a cloud remote.
+
+    def __init__(
+        self, roots=None, latency=0, workers=NUMBER_OF_WORKERS, fanout=()
+    ):
+        self.roots = {} if roots is None else roots
+        self.latency = latency
+        self.workers = workers
+        self.fanout = tuple(fanout)
+        self.failed = set()
+
+    def real(self, path):
+        # Translates path to a local path.
+        for prefix, root in self.roots.items():
+            if path.startswith(prefix):
+                return os.path.join(root, path[len(prefix):].lstrip("/"))
+
+        return path
+
+    def list(self, path, names=None):
+        sleep(self.latency)
+        real = self.real(path)
+
+        if names is not None:
+            return list(native.stat_names(real, names))
+
+        os.makedirs(real, exist_ok=True)
+        return list(native.scan(real))
+
+    def list_dirs(self, path, rel, depth, hash_name=None):
+        real = self.real(path)
+        entries, level = [], [rel]
+
+        for _ in range(depth):
+            below = []
+            for d in level:
+                sleep(self.latency)
+                with os.scandir(os.path.join(real, d)) as it:
+                    for entry in it:
+                        name = os.path.join(d, entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            below.append(name)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            entries.append((name, st.st_size, st.st_mtime))
+            level = below
+
+        return entries, {}, level
+
+    def hash(self, path, hash_name, names=None):
+        return native.hash_dir(self.real(path), hash_name, names=names)
+
+    def read(self, path):
+        try:
+            with open(self.real(path), "rb") as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def write(self, path, data):
+        self.dirty(path)
+        real = self.real(path)
+        os.makedirs(os.path.dirname(real), exist_ok=True)
+        with open(real, "wb") as fp:
+            fp.write(data)
+
+    def mkdir(self, path):
+        os.makedirs(self.real(path), exist_ok=True)
+
+    def copy(self, src, dst, size=0):
+        self.dirty(dst)
+        telemetry.begin(dst)
+        sleep(self.latency)
+        real = self.real(dst)
+        try:
+            os.makedirs(os.path.dirname(real), exist_ok=True)
+            shutil.copy2(self.real(src), real)
+        except OSError:
+            self.failed.update((src, dst))
+            telemetry.end(dst, size, False)
+        else:
+            telemetry.end(dst, size, True)
+
+    def move(self, src, dst):
+        self.dirty(src, dst)
+        sleep(self.latency)
+        real = self.real(dst)
+        try:
+            os.makedirs(os.path.dirname(real), exist_ok=True)
+            os.replace(self.real(src), real)
+        except OSError:
+            self.failed.update((src, dst))
+
+    def delete(self, path):
+        self.dirty(path)
+        sleep(self.latency)
+        try:
+            os.remove(self.real(path))
+        except OSError:
+            self.failed.add(path)
+
+    def failures(self):
+        failed, self.failed = self.failed, set()
+        return failed
+
+    def rmdirs(self, path):
+        for dirpath, _, _ in os.walk(self.real(path), topdown=False):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+
+class Budget:
+    # Wraps a backend, refusing new operations once seconds have passed since
+    # it was made (None for no limit). A copy that would take the bytes
+    # copied past max_bytes is refused too, but smaller copies, moves and
+    # deletes still run. The first copy always runs, so a file bigger than
+    # max_bytes is synced on its own. Operations already running finish.
+    # Refused operations are reported by failures() like failed ones, so the
+    # state saved after a live pass only holds the operations that ran. They
+    # are kept in refused until forget(), as live passes may run at once.
+    # Anything else is passed to the backend.
+
+    def __init__(self, backend, seconds=None, max_bytes=None):
+        self.backend = backend
+        self.deadline = None if seconds is None else monotonic() + seconds
+        self.max_bytes = max_bytes
+        self.sent = 0  # Bytes copied so far.
+        self.spent = False  # Out of time.
+        self.refused = set()  # Full paths of the refused operations.
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def late(self):
+        # True once the time is up.
+        if not self.spent and self.deadline is not None:
+            self.spent = monotonic() > self.deadline
+
+        return self.spent
+
+    def fits(self, size):
+        # True if size more bytes may be copied.
+        return (
+            self.max_bytes is None
+            or self.sent == 0
+            or self.sent + size <= self.max_bytes
+        )
+
+    def over(self):
+        # True once the time is up or every byte allowed has been copied.
+        full = self.max_bytes is not None and self.sent >= self.max_bytes
+        return self.late() or full
+
+    def copy(self, src, dst, size=0):
+        with self.lock:
+            refuse = self.late() or not self.fits(size)
+            if refuse:
+                self.refused.update((src, dst))
+            else:
+                self.sent += size
+
+        if not refuse:
+            self.backend.copy(src, dst, size)
+
+    def move(self, src, dst):
+        if self.late():
+            self.refused.update((src, dst))
+            return
+
+        self.backend.move(src, dst)
+
+    def delete(self, path):
+        if self.late():
+            self.refused.add(path)
+            return
+
+        self.backend.delete(path)
+
+    def failures(self):
+        return self.backend.failures() | self.refused
+
+    def forget(self):
+        # Forgets the refused operations, once their live passes are saved.
+        self.refused = set()
+
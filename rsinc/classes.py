@@ -2,18 +2,27 @@
 
 import subprocess
 import os
+import sys
 
-from time import sleep
+from threading import Lock, Thread
+from time import sleep, perf_counter
+
+import ujson
+
+from .stats import stats, telemetry
 
 THESAME, UPDATED, DELETED, CREATED = tuple(range(4))
 NOMOVE, MOVED, CLONE, NOTHERE = tuple(range(4, 8))
 
 
 class File:
-    def __init__(self, name, uid, time, state, moved, is_clone, synced, ignore):
+    def __init__(
+        self, name, uid, time, state, moved, is_clone, synced, ignore, size=0
+    ):
         self.name = name
         self.uid = uid
         self.time = time
+        self.size = size
 
         self.state = state
         self.moved = moved
@@ -30,6 +39,7 @@ class File:
             self.is_clone,
             self.synced,
             self.ignore,
+            self.size,
         )
 
 
@@ -51,11 +61,20 @@ class Flat:
         is_clone=False,
         synced=False,
         ignore=False,
+        size=0,
     ):
         self.names.update(
             {
                 name: File(
-                    name, uid, time, state, moved, is_clone, synced, ignore
+                    name,
+                    uid,
+                    time,
+                    state,
+                    moved,
+                    is_clone,
+                    synced,
+                    ignore,
+                    size,
                 )
             }
         )
@@ -76,6 +95,10 @@ class Flat:
         for file in self.names.values():
             file.synced = False
 
+    def snapshot(self, sort=True):
+        # Returns the names of the files, sorted if sort, as they are now.
+        return sorted(self.names) if sort else tuple(self.names)
+
     def rm(self, name):
         if not self.names[name].is_clone:
             del self.uids[self.names[name].uid]
@@ -104,27 +127,43 @@ class Struct:
         self.rmt = None
         self.dry = True
         self.case = True
-        self.pool = None
-        self.rclone_flags = []
+        self.backend = None
+        self.ops = None
 
 
 class SubPool:
+    # Runs up to max_workers commands at once, run() blocks while the pool is
+    # full. It can be shared by several threads.
     def __init__(self, max_workers):
         self.procs = []
         self.max_workers = max_workers
+        self.failed = []  # Args of the commands that exited non-zero.
+        self.lock = Lock()
+
+    def run(self, cmd, size=None):
+        # If size is given cmd is a transfer logging json stats to stderr.
+        with self.lock:
+            if len(self.procs) >= self.max_workers:
+                done = None
+                with stats.phase("pool_wait"):
+                    while done is None:
+                        done = self._find_done_process()
+
+                self._finish(done)
+
+            stats.count("rclone_procs")
+            if size is None:
+                proc = subprocess.Popen(cmd)
+            else:
+                proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+                telemetry.begin(proc.pid)
+                proc.reader = Thread(target=_read_stats, args=(proc,))
+                proc.reader.daemon = True
+                proc.reader.start()
 
-    def run(self, cmd):
-
-        if len(self.procs) < self.max_workers:
-            self.procs.append(subprocess.Popen(cmd))
-            return
-        else:
-            done = None
-            while done is None:
-                done = self._find_done_process()
-
-            self.procs.pop(done).terminate()
-            self.run(cmd)
+            proc.start = perf_counter()
+            proc.size = size
+            self.procs.append(proc)
 
     def _find_done_process(self):
 
@@ -141,10 +180,58 @@ class SubPool:
 
         return None
 
-    def wait(self):
+    def _finish(self, c):
+        proc = self.procs.pop(c)
+        stats.op(proc.args[1], perf_counter() - proc.start)
 
-        for proc in self.procs:
-            proc.wait()
-            proc.terminate()
+        if proc.returncode != 0:
+            self.failed.append(proc.args)
 
-        self.procs = []
+        if proc.size is not None:
+            proc.reader.join()
+            telemetry.end(proc.pid, proc.size, proc.returncode == 0)
+
+        proc.terminate()
+
+    def wait(self):
+        # Blocks until every command, from any thread, has finished. The lock
+        # is let go between checks so other threads can still run commands.
+        with stats.phase("pool_wait"):
+            while True:
+                with self.lock:
+                    if not self.procs:
+                        return
+
+                    done = self._find_done_process()
+                    if done is not None:
+                        self._finish(done)
+
+    def take_failed(self):
+        # Returns, and forgets, the args of the commands that failed.
+        with self.lock:
+            failed, self.failed = self.failed, []
+
+        return failed
+
+
+def _read_stats(proc):
+    # Feeds the json stats rclone logs to stderr into telemetry, passing other
+    # log lines through.
+    errors = 0
+    for line in proc.stderr:
+        try:
+            entry = ujson.loads(line)
+        except ValueError:
+            sys.stderr.write(line.decode(errors="replace"))
+            continue
+
+        if "stats" in entry:
+            s = entry["stats"]
+            telemetry.update(proc.pid, s.get("bytes", 0), s.get("speed", 0))
+            errors = max(errors, s.get("errors", 0))
+        else:
+            sys.stderr.write(
+                "%s: %s\n" % (entry.get("level", "?"), entry.get("msg", ""))
+            )
+
+    stats.count("rclone_errors", errors)
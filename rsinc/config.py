@@ -95,6 +95,18 @@ def config_cli(config_path):
         "MASTER": os.path.join(DRIVE_DIR, "master.json"),
         "TEMP_FILE": os.path.join(DRIVE_DIR, "rsinc.tmp"),
         "FAST_SAVE": False,
+        "NATIVE_LOCAL": True,
+        "QUICK": False,
+        "PLAN_PROCS": 1,
+        "STREAM": False,
+        "FAN_OUT_LIST": [],
+        "MEMORY_LIMIT_MB": 0,
+        "HASH_INDEX": [],
+        "TIME_BUDGET": None,
+        "MAX_BYTES": None,
+        "LEASE_TTL": 0,
+        "LEASE_WAIT": 600,
+        "METRICS_FILE": None,
     }
 
     with open(config_path, "w") as file:
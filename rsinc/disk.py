@@ -0,0 +1,334 @@
+# Provides DiskFlat, a Flat kept in SQLite for trees that do not fit in memory
+
+import os
+import sqlite3
+import tempfile
+import weakref
+
+from .classes import File, THESAME
+
+# Columns of the files table, in the order of File.dump().
+FIELDS = ("uid", "time", "state", "moved", "is_clone", "synced", "ignore")
+FIELDS += ("size",)
+FLAGS = ("moved", "is_clone", "synced", "ignore")
+COLUMNS = "fid, alive, name, uid, time, state, moved, is_clone, synced, "
+COLUMNS += '"ignore", size'
+CHUNK = 10000  # Rows fetched at a time while iterating.
+
+# Rows are never deleted, removed files are only marked dead. The uids table
+# can still point at them, as the uids dict of a Flat can hold removed Files.
+SCHEMA = """
+CREATE TABLE files (
+    fid INTEGER PRIMARY KEY,
+    alive INTEGER,
+    name TEXT,
+    uid TEXT,
+    time REAL,
+    state INTEGER,
+    moved INTEGER,
+    is_clone INTEGER,
+    synced INTEGER,
+    "ignore" INTEGER,
+    size INTEGER
+);
+CREATE UNIQUE INDEX names ON files (name) WHERE alive = 1;
+CREATE TABLE uids (uid TEXT PRIMARY KEY, fid INTEGER) WITHOUT ROWID;
+CREATE TABLE lower (lower TEXT PRIMARY KEY) WITHOUT ROWID;
+"""
+
+
+def connect(file, cache_mb):
+    # Opens a database that only lives as long as the run, so it can skip
+    # the journal and syncing.
+    db = sqlite3.connect(file, check_same_thread=False)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA temp_store = FILE")
+    db.execute("PRAGMA cache_size = %d" % (-1024 * cache_mb))
+    return db
+
+
+def _close(db, file):
+    db.close()
+    os.remove(file)
+
+
+class DiskFile(File):
+    # A File of a DiskFlat, changes to its fields are written to its row.
+
+    def __init__(self, flat, fid, alive, name, *dump):
+        object.__setattr__(self, "flat", flat)
+        object.__setattr__(self, "fid", fid)
+        object.__setattr__(self, "alive", bool(alive))
+        object.__setattr__(self, "name", name)
+        for key, value in zip(FIELDS, dump):
+            if key in FLAGS:
+                value = bool(value)
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if key in FIELDS:
+            self.flat.db.execute(
+                'UPDATE files SET "%s" = ? WHERE fid = ?' % key,
+                (value, self.fid),
+            )
+
+
+class Names:
+    # The names dict of a DiskFlat.
+
+    def __init__(self, flat):
+        self.flat = flat
+
+    def fid(self, name):
+        # Returns the fid of the live row of name, or None.
+        sql = "SELECT fid FROM files WHERE name = ? AND alive = 1"
+        row = self.flat.db.execute(sql, (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def __contains__(self, name):
+        return self.fid(name) is not None
+
+    def __getitem__(self, name):
+        fid = self.fid(name)
+        if fid is None:
+            raise KeyError(name)
+
+        return self.flat.load(fid)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        sql = "SELECT COUNT(*) FROM files WHERE alive = 1"
+        return self.flat.db.execute(sql).fetchone()[0]
+
+    def __iter__(self):
+        for row in self.flat.rows("name"):
+            yield row[0]
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for row in self.flat.rows(COLUMNS):
+            yield row[2], self.flat.load(row[0], row)
+
+    def values(self):
+        for _, file in self.items():
+            yield file
+
+
+class Uids:
+    # The uids dict of a DiskFlat, maps uids to the last file updated with
+    # that uid, alive or not.
+
+    def __init__(self, flat):
+        self.flat = flat
+
+    def fid(self, uid):
+        # Returns the fid uid maps to, or None.
+        sql = "SELECT fid FROM uids WHERE uid = ?"
+        row = self.flat.db.execute(sql, (uid,)).fetchone()
+        return None if row is None else row[0]
+
+    def __contains__(self, uid):
+        return self.fid(uid) is not None
+
+    def __getitem__(self, uid):
+        fid = self.fid(uid)
+        if fid is None:
+            raise KeyError(uid)
+
+        return self.flat.load(fid)
+
+
+class Lower:
+    # The lower set of a DiskFlat.
+
+    def __init__(self, flat):
+        self.flat = flat
+
+    def __contains__(self, lower):
+        sql = "SELECT 1 FROM lower WHERE lower = ?"
+        return self.flat.db.execute(sql, (lower,)).fetchone() is not None
+
+
+class DiskFlat:
+    # Same interface as Flat but the files are kept in a SQLite database in a
+    # temporary file, only the Files in use are held in memory. Much slower
+    # than Flat, it is for trees too big for memory. The database is removed
+    # when the DiskFlat is garbage collected.
+
+    def __init__(self, path, cache_mb=64):
+        self.path = path
+        self.dirs = set()
+        self.cache_mb = cache_mb
+
+        fd, self.file = tempfile.mkstemp(prefix="rsinc-", suffix=".db")
+        os.close(fd)
+        self.db = connect(self.file, cache_mb)
+        self.db.executescript(SCHEMA)
+        weakref.finalize(self, _close, self.db, self.file)
+
+        self.live = weakref.WeakValueDictionary()  # Fid -> DiskFile.
+        self.names = Names(self)
+        self.uids = Uids(self)
+        self.lower = Lower(self)
+        self.snaps = 0
+
+    @classmethod
+    def copy_of(cls, flat, cache_mb=64):
+        # Returns a DiskFlat of the files in flat.
+        out = cls(flat.path, cache_mb)
+        for name, file in flat.names.items():
+            out.update(name, *file.dump())
+
+        return out
+
+    def load(self, fid, row=None):
+        # Returns the DiskFile of fid, row is its row if already fetched.
+        file = self.live.get(fid)
+        if file is not None:
+            return file
+
+        if row is None:
+            sql = "SELECT %s FROM files WHERE fid = ?" % COLUMNS
+            row = self.db.execute(sql, (fid,)).fetchone()
+
+        file = DiskFile(self, *row)
+        self.live[fid] = file
+        return file
+
+    def kill(self, fid):
+        # Marks the row of fid dead, it stays reachable through uids.
+        self.db.execute("UPDATE files SET alive = 0 WHERE fid = ?", (fid,))
+        file = self.live.get(fid)
+        if file is not None:
+            object.__setattr__(file, "alive", False)
+
+    def rows(self, columns):
+        # Yields the live rows of the files table in name order, CHUNK at a
+        # time. The name must be the first column, or the third of COLUMNS.
+        sql = "SELECT %s FROM files WHERE alive = 1 AND name > ? "
+        sql = sql % columns + "ORDER BY name LIMIT %d" % CHUNK
+        at = 2 if columns == COLUMNS else 0
+        last = ""
+
+        while True:
+            rows = self.db.execute(sql, (last,)).fetchall()
+            if len(rows) == 0:
+                return
+
+            yield from rows
+            last = rows[-1][at]
+
+    def update(
+        self,
+        name,
+        uid,
+        time=0,
+        state=THESAME,
+        moved=False,
+        is_clone=False,
+        synced=False,
+        ignore=False,
+        size=0,
+    ):
+        db = self.db
+
+        old = self.names.fid(name)
+        if old is not None:
+            self.kill(old)
+
+        prior = self.uids.fid(uid)
+        if prior is not None:
+            is_clone = True
+
+        row = (name, uid, time, state, moved, is_clone, synced, ignore, size)
+        fid = db.execute(
+            "INSERT INTO files VALUES (NULL, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            row,
+        ).lastrowid
+        db.execute("INSERT OR IGNORE INTO lower VALUES (?)", (name.lower(),))
+        db.execute("INSERT OR REPLACE INTO uids VALUES (?, ?)", (uid, fid))
+
+        if prior is not None:
+            self.load(prior).is_clone = True
+
+        d = os.path.dirname(name)
+        d = os.path.join(self.path, d)
+        self.dirs.add(d)
+
+    def clean(self):
+        self.db.execute("UPDATE files SET synced = 0 WHERE alive = 1")
+        for file in self.live.values():
+            if file.alive:
+                object.__setattr__(file, "synced", False)
+
+    def rm(self, name):
+        file = self.names[name]
+        if not file.is_clone:
+            self.db.execute("DELETE FROM uids WHERE uid = ?", (file.uid,))
+
+        self.kill(file.fid)
+        self.db.execute("DELETE FROM lower WHERE lower = ?", (name.lower(),))
+
+    def tag_ignore(self, regexs):
+        self.db.execute('UPDATE files SET "ignore" = 0 WHERE alive = 1')
+
+        ignored = []
+        for name, fid in self.rows("name, fid"):
+            if any(r.match(os.path.join(self.path, name)) for r in regexs):
+                ignored.append((fid,))
+
+        sql = 'UPDATE files SET "ignore" = 1 WHERE fid = ?'
+        self.db.executemany(sql, ignored)
+
+        ignored = set(fid for fid, in ignored)
+        for fid, file in self.live.items():
+            if file.alive:
+                object.__setattr__(file, "ignore", fid in ignored)
+
+    def rm_ignore(self):
+        sql = 'SELECT name FROM files WHERE alive = 1 AND "ignore" = 1'
+        for (name,) in self.db.execute(sql).fetchall():
+            self.rm(name)
+
+    def snapshot(self, sort=True):
+        # See Flat.snapshot, the names are copied to a temporary table now
+        # and are always sorted.
+        self.snaps += 1
+        table = "snap_%d" % self.snaps
+        sql = "CREATE TEMP TABLE %s AS SELECT name FROM files "
+        self.db.execute(sql % table + "WHERE alive = 1 ORDER BY name")
+        return self._snapshot(table)
+
+    def _snapshot(self, table):
+        # Yields the names in a snapshot table then drops it.
+        sql = "SELECT rowid, name FROM %s WHERE rowid > ? ORDER BY rowid"
+        sql = sql % table + " LIMIT %d" % CHUNK
+        last = 0
+
+        try:
+            while True:
+                rows = self.db.execute(sql, (last,)).fetchall()
+                if len(rows) == 0:
+                    return
+
+                for _, name in rows:
+                    yield name
+                last = rows[-1][0]
+        finally:
+            self.db.execute("DROP TABLE IF EXISTS %s" % table)
+
+    def __deepcopy__(self, memo):
+        out = DiskFlat(self.path, self.cache_mb)
+        self.db.commit()
+        self.db.backup(out.db)
+        out.dirs = set(self.dirs)
+        return out
@@ -0,0 +1,58 @@
+# Provides History, the set of local directories synced before
+
+MARK = "/"  # Key marking a node as in the set, never a path component.
+# A node in the set with no children is stored as 1 instead of {MARK: 1}.
+
+
+def chain(path):
+    # Splits path into the keys of its node, ignoring any trailing slash.
+    return path.rstrip("/").split("/")
+
+
+class History:
+    # A set of paths kept as a trie of their components, so the directories
+    # of a synced tree share their common prefixes. Looking a path up is
+    # linear in its depth, not in the size of the set. dump() is the form
+    # saved in master.
+
+    def __init__(self, saved=None):
+        self.root = {}
+
+        if isinstance(saved, dict):
+            self.root = saved
+        elif saved is not None:
+            # Masters from before the trie hold a list of paths.
+            self.update(saved)
+
+    def __contains__(self, path):
+        node = self.root
+        for key in chain(path):
+            if not isinstance(node, dict):
+                return False
+            node = node.get(key)
+            if node is None:
+                return False
+
+        return node == 1 or MARK in node
+
+    def add(self, path):
+        keys = chain(path)
+        node = self.root
+        for key in keys[:-1]:
+            child = node.get(key)
+            if not isinstance(child, dict):
+                child = node[key] = {} if child is None else {MARK: 1}
+            node = child
+
+        child = node.get(keys[-1])
+        if isinstance(child, dict):
+            child[MARK] = 1
+        else:
+            node[keys[-1]] = 1
+
+    def update(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def dump(self):
+        return self.root
@@ -0,0 +1,122 @@
+# Provides the hash index rsinc keeps in remote folders that hash slowly
+
+import logging
+import os
+import zlib
+
+import ujson
+
+from .rclone import STAMP_TOL
+
+log = logging.getLogger(__name__)
+
+INDEX = ".rsinc-index"  # Name of the index file in an indexed remote folder.
+VERSION = 1
+
+
+def read_index(backend, path, hash_name):
+    """
+    @brief      Reads the hash index of a remote folder.
+
+    @param      backend    The Backend to read it with
+    @param      path       The remote folder
+    @param      hash_name  The hash the index must be made with
+
+    @return     Dict mapping full paths to (size, modtime, hash), the same form
+                as the quick mode cache. Empty if there is no usable index.
+    """
+    data = backend.read(os.path.join(path, INDEX))
+    if data is None:
+        return {}
+
+    try:
+        index = ujson.loads(zlib.decompress(data))
+    except (zlib.error, ValueError):
+        log.warning("Ignoring unreadable index in %s", path)
+        return {}
+
+    if index.get("version") != VERSION or index.get("hash") != hash_name:
+        return {}
+
+    return {
+        os.path.join(path, name): (size, time, hash)
+        for name, size, time, hash in index["files"]
+    }
+
+
+def write_index(backend, path, hash_name, cache):
+    # Writes the entries of cache in path as the hash index of path.
+    prefix = os.path.join(path, "")
+    files = sorted(
+        [full[len(prefix):], size, time, hash]
+        for full, (size, time, hash) in cache.items()
+        if full.startswith(prefix) and os.path.basename(full) != INDEX
+    )
+
+    index = {"version": VERSION, "hash": hash_name, "files": files}
+    data = zlib.compress(ujson.dumps(index).encode())
+    backend.write(os.path.join(path, INDEX), data)
+
+
+def updated(known, ops, failed, lcl, path, entries):
+    """
+    @brief      Works out the hash index of a remote folder after a sync from
+                the index before it and the operations that ran. A file is
+                only kept if its listed size matches what the index expects.
+
+    @param      known    Index before the sync, see read_index
+    @param      ops      List of the (kind, src, dst) operations of the sync
+    @param      failed   Set of the full paths used by failed operations
+    @param      lcl      Flat of the local folder before the sync
+    @param      path     The remote folder
+    @param      entries  List of (name, size, modtime) tuples of the remote
+                         folder after the sync
+
+    @return     The new index, without the files whose hash is unknown.
+    """
+    content = {}  # Full path -> (size, hash) of files changed, None if lost.
+    prefix = os.path.join(lcl.path, "")
+
+    def get(full):
+        # (size, hash) of the file at full path, None if not known.
+        if full in content:
+            return content[full]
+
+        hit = known.get(full)
+        if hit is not None:
+            return hit[0], hit[2]
+
+        if full.startswith(prefix):
+            file = lcl.names.get(full[len(prefix):])
+            if file is not None:
+                return file.size, file.uid[len(str(file.size)):]
+
+        return None
+
+    for kind, src, dst in ops:
+        if kind == "delete":
+            content[src] = None
+        elif kind in ("copy", "move"):
+            ok = src not in failed and dst not in failed
+            value = get(src) if ok else None
+            if kind == "move":
+                content[src] = None
+            content[dst] = value
+
+    out = {}
+    for name, size, time in entries:
+        full = os.path.join(path, name)
+        if full in content:
+            value = content[full]
+            if value is not None and value[0] == size:
+                out[full] = (size, time, value[1])
+        else:
+            hit = known.get(full)
+            if (
+                hit is not None
+                and hit[0] == size
+                and abs(hit[1] - time) < STAMP_TOL
+            ):
+                out[full] = hit
+
+    return out
@@ -0,0 +1,154 @@
+# Provides Lease, a lock on a remote folder for hosts that share the remote
+
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import quote, unquote
+
+import ujson
+
+from .colors import ylw
+
+log = logging.getLogger(__name__)
+
+LEASES = ".rsinc-leases"  # Folder in BASE_R holding the lease files.
+POLL = 5  # Seconds between checks while waiting for a lease, on average.
+SETTLE = 1  # Seconds to wait after writing a lease before checking it won.
+
+# Tells apart every rsinc process, on any host.
+OWNER = "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def overlaps(a, b):
+    # True if folder a is b, inside b or contains b. "" and "." are the root.
+    a, b = [f.strip("/") if f != "." else "" for f in (a, b)]
+    a, b = [f + "/" if f else "" for f in (a, b)]
+    return a.startswith(b) or b.startswith(a)
+
+
+class Lease:
+    # A lease on a folder of a remote, held by one process. It is a file in
+    # the LEASES folder of the remote root, named after the folder and the
+    # owner, holding the time it expires. While it is held a thread rewrites
+    # it every ttl / 3 seconds, so a host that dies loses its leases ttl
+    # seconds later. The clocks of the hosts must agree to well within ttl.
+    #
+    # Only one process at a time can hold leases on folders that overlap, so
+    # hosts sync different folders at once but never the same files. Remotes
+    # have no atomic create: a process writes its lease and then looks for
+    # others. If it sees another live lease on an overlapping folder it
+    # backs off and tries again after a random delay. As each checks after
+    # writing, at least one of two racing processes sees the other.
+
+    def __init__(self, backend, base, folder, ttl, owner=OWNER):
+        self.backend = backend
+        self.root = os.path.join(base, LEASES)
+        self.folder = folder
+        self.ttl = ttl
+        self.owner = owner
+        name = quote(folder, safe="") + "@" + quote(owner, safe="")
+        self.path = os.path.join(self.root, name)
+        self.stop = threading.Event()
+        self.beat = None
+
+    def others(self):
+        # Returns the live leases of other owners on overlapping folders.
+        found = []
+        for name, _, _ in self.backend.list(self.root):
+            folder, _, owner = [unquote(s) for s in name.partition("@")]
+            if owner == self.owner or not overlaps(folder, self.folder):
+                continue
+
+            try:
+                data = self.backend.read(os.path.join(self.root, name))
+                lease = ujson.loads(data)
+            except (TypeError, ValueError):
+                continue  # Gone or half written.
+
+            if lease["expires"] > time.time():
+                found.append(lease)
+            elif lease["expires"] + self.ttl < time.time():
+                # Left by a process that died, tidy it away.
+                self.backend.delete(os.path.join(self.root, name))
+                self.backend.wait()
+
+        return found
+
+    def write(self):
+        # Writes the lease, live for another ttl seconds.
+        lease = {
+            "folder": self.folder,
+            "owner": self.owner,
+            "expires": time.time() + self.ttl,
+        }
+        self.backend.write(self.path, ujson.dumps(lease).encode())
+
+    def remove(self):
+        self.backend.delete(self.path)
+        self.backend.wait()
+
+    def acquire(self, wait):
+        """
+        @brief      Takes the lease, waiting while another process holds an
+                    overlapping one.
+
+        @param      wait  Seconds to wait for other leases to go
+
+        @return     True if the lease is held, False if it was not free in
+                    time.
+        """
+        deadline = time.monotonic() + wait
+        shown = False
+
+        while True:
+            held = self.others()
+            if len(held) == 0:
+                self.write()
+                time.sleep(SETTLE)
+                held = self.others()
+                if len(held) == 0:
+                    break
+
+                self.remove()  # Lost a race, back off.
+
+            if not shown:
+                print(ylw("Waiting:"), "for", held[0]["owner"], end="")
+                print(" to finish syncing", repr(held[0]["folder"]))
+                shown = True
+
+            if time.monotonic() > deadline:
+                log.warning("Lease on %s still held", self.folder)
+                return False
+
+            time.sleep(POLL * random.uniform(0.5, 1.5))
+
+        log.info("Took lease on %s as %s", self.folder, self.owner)
+        self.stop.clear()
+        self.beat = threading.Thread(target=self._beat, daemon=True)
+        self.beat.start()
+        return True
+
+    def _beat(self):
+        # Keeps the lease live until release().
+        while not self.stop.wait(self.ttl / 3):
+            self.write()
+
+    def release(self):
+        if self.beat is None:
+            return
+
+        self.stop.set()
+        self.beat.join()
+        self.beat = None
+        self.remove()
+        log.info("Released lease on %s", self.folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
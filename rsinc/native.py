@@ -0,0 +1,315 @@
+# Provides a native (no rclone) lister for the local side
+
+import hashlib
+import mmap
+import os
+import stat
+
+from .colors import red
+from .rclone import build_flat, split_cached, remember
+from .stats import stats
+
+BUFFER = 1 << 20  # Read size for small files.
+MMAP_MIN = 1 << 22  # Files larger than this are memory-mapped.
+POOL_MIN = 1 << 24  # Bytes to hash before a process pool is worth starting.
+
+
+class QuickXorHash:
+    # OneDrive's QuickXorHash. Byte i of the stream is xor-ed into a 160 bit
+    # register at bit (11 * i) % 160, this repeats every 160 bytes so whole
+    # 160 byte blocks can be xor-folded together first.
+
+    WIDTH = 160
+    SHIFT = 11
+
+    def __init__(self):
+        self.fold = 0
+        self.length = 0
+        self.tail = b""
+
+    def update(self, data):
+        data = self.tail + bytes(data)
+        cut = len(data) - len(data) % self.WIDTH
+
+        self.length += len(data) - len(self.tail)
+        self.tail = data[cut:]
+
+        if cut:
+            self.fold ^= _fold(data[:cut], self.WIDTH * 8)
+
+    def digest(self):
+        fold = self.fold
+        if self.tail:
+            fold ^= int.from_bytes(self.tail, "little")
+
+        mask = (1 << self.WIDTH) - 1
+        out = 0
+        for i in range(self.WIDTH):
+            byte = (fold >> (8 * i)) & 0xFF
+            if byte:
+                bit = (i * self.SHIFT) % self.WIDTH
+                out ^= ((byte << bit) | (byte >> (self.WIDTH - bit))) & mask
+
+        out ^= self.length << (self.WIDTH - 64)
+        return out.to_bytes(self.WIDTH // 8, "little")
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+def _fold(data, width):
+    # Xor-folds data (a whole number of width bit blocks) into one block.
+    n = (len(data) * 8) // width
+    bits = width << (n - 1).bit_length()
+    x = int.from_bytes(data, "little")
+
+    while bits > width:
+        bits //= 2
+        x = (x >> bits) ^ (x & ((1 << bits) - 1))
+
+    return x
+
+
+HASHES = {
+    "SHA-1": hashlib.sha1,
+    "MD5": hashlib.md5,
+    "QuickXorHash": QuickXorHash,
+}
+
+
+def hash_file(path, hash_names):
+    """
+    @brief      Hashes a file with several hash functions in one read pass.
+
+    @param      path        The path of the file to hash
+    @param      hash_names  Iterable of names of hashes in HASHES
+
+    @return     Dict mapping hash name to lowercase hex digest, None if the
+                file could not be read.
+    """
+    hashers = [(name, HASHES[name]()) for name in hash_names]
+
+    try:
+        with open(path, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size >= MMAP_MIN:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for start in range(0, size, MMAP_MIN):
+                        chunk = mm[start:start + MMAP_MIN]
+                        for _, h in hashers:
+                            h.update(chunk)
+            else:
+                chunk = fp.read(BUFFER)
+                while chunk:
+                    for _, h in hashers:
+                        h.update(chunk)
+                    chunk = fp.read(BUFFER)
+    except OSError:
+        return None
+
+    return {name: h.hexdigest() for name, h in hashers}
+
+
+def _hash_star(args):
+    return hash_file(*args)
+
+
+def scan(path, follow=False):
+    """
+    @brief      Recursively lists the files under path with os.scandir.
+
+    @param      path    The directory to list
+    @param      follow  Follow symlinks (like rclone's --copy-links), otherwise
+                        they are skipped like rclone does by default
+
+    @return     Generator of (relative name, size, modtime) tuples.
+    """
+    stack = [""]
+
+    while stack:
+        rel = stack.pop()
+        try:
+            it = os.scandir(os.path.join(path, rel))
+        except OSError as e:
+            print(red("ERROR:"), "can't list", e.filename)
+            continue
+
+        with it:
+            for entry in it:
+                if entry.is_symlink() and not follow:
+                    continue
+
+                name = rel + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=follow):
+                        stack.append(name + "/")
+                    elif entry.is_file(follow_symlinks=follow):
+                        st = entry.stat(follow_symlinks=follow)
+                        yield name, st.st_size, st.st_mtime
+                except OSError:
+                    print(red("ERROR:"), "can't stat", name)
+
+
+def stat_names(path, names, follow=False):
+    """
+    @brief      Lists just the named files under path.
+
+    @param      path    The directory the names are relative to
+    @param      names   Iterable of relative names of files
+    @param      follow  Follow symlinks
+
+    @return     Generator of (relative name, size, modtime) tuples of the names
+                that are files.
+    """
+    for name in names:
+        full = os.path.join(path, name)
+        try:
+            if os.path.islink(full) and not follow:
+                continue
+            st = os.stat(full)
+        except OSError:
+            continue
+
+        if stat.S_ISREG(st.st_mode):
+            yield name, st.st_size, st.st_mtime
+
+
+def hash_many(paths, sizes, hash_names, workers=None):
+    """
+    @brief      Hashes many files, in a process pool if there is enough to do.
+
+    @param      paths       List of paths of files to hash
+    @param      sizes       List of the sizes of the files
+    @param      hash_names  Iterable of names of hashes in HASHES
+    @param      workers     Number of processes, defaults to the cpu count
+
+    @return     List of hash_file results in the same order as paths.
+    """
+    hash_names = tuple(hash_names)
+    jobs = [(p, hash_names) for p in paths]
+
+    if sum(sizes) < POOL_MIN or len(paths) < 2:
+        return [_hash_star(job) for job in jobs]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_hash_star, jobs, chunksize=32))
+
+
+def hash_dir(path, hash_name, follow=False, names=None):
+    """
+    @brief      Hashes every file under path.
+
+    @param      path       The local path to hash
+    @param      hash_name  The name of the hash to use
+    @param      follow     Follow symlinks
+    @param      names      List of the names of the files to hash, None for
+                           every file
+
+    @return     Dict mapping file names to hashes.
+    """
+    entries = list(scan(path, follow))
+    if names is not None:
+        names = set(names)
+        entries = [e for e in entries if e[0] in names]
+    names = [e[0] for e in entries]
+    hashes = hash_many(
+        [os.path.join(path, n) for n in names],
+        [e[1] for e in entries],
+        (hash_name,),
+    )
+    return {n: h[hash_name] for n, h in zip(names, hashes) if h is not None}
+
+
+def lsl(path, hash_name, follow=False, cache=None, names=None, make=None):
+    """
+    @brief      Native replacement for rclone.lsl on a local path.
+
+    @param      path       The local path to list
+    @param      hash_name  The hash name to use for the file uid's
+    @param      follow     Follow symlinks
+    @param      cache      Optional dict mapping paths to (size, modtime,
+                           hash), files whose size and modtime match are not
+                           re-hashed. Updated with the new hashes.
+    @param      names      List of the names of the files to list, None for
+                           every file
+    @param      make       Makes the Flat to fill, see rclone.build_flat
+
+    @return     A Flat of files representing the current state of directory at
+                path.
+    """
+    caches = None if cache is None else {hash_name: cache}
+    flats = lsl_many(path, (hash_name,), follow, caches, names, make)
+    return flats[hash_name]
+
+
+def lsl_many(
+    path, hash_names, follow=False, caches=None, names=None, make=None
+):
+    """
+    @brief      Lists path once and builds a Flat for each hash, reading each
+                file once for all the hashes it needs.
+
+    @param      path        The local path to list
+    @param      hash_names  Iterable of hash names in HASHES
+    @param      follow      Follow symlinks
+    @param      caches      Optional dict mapping hash names to caches, see lsl
+    @param      names       List of the names of the files to list, None for
+                            every file
+    @param      make        Makes each Flat to fill, see rclone.build_flat
+
+    @return     Dict mapping hash names to Flats.
+    """
+    os.makedirs(path, exist_ok=True)
+    caches = {} if caches is None else caches
+
+    with stats.phase("list"):
+        if names is None:
+            entries = list(scan(path, follow))
+        else:
+            entries = list(stat_names(path, names, follow))
+    stats.count("files_listed", len(entries))
+
+    hashes = {}
+    todo = {}  # Name -> entry of the files to hash.
+    need = {}  # Name -> list of the hashes the file needs.
+
+    for hash_name in hash_names:
+        if hash_name in caches:
+            hashes[hash_name], miss = split_cached(
+                path, entries, caches[hash_name]
+            )
+        else:
+            hashes[hash_name], miss = {}, entries
+
+        for entry in miss:
+            todo[entry[0]] = entry
+            need.setdefault(entry[0], []).append(hash_name)
+
+    # Group files by the hashes they need so each is read once.
+    groups = {}
+    for name, entry in todo.items():
+        groups.setdefault(tuple(need[name]), []).append(entry)
+
+    with stats.phase("hash"):
+        for group, group_entries in groups.items():
+            done = hash_many(
+                [os.path.join(path, e[0]) for e in group_entries],
+                [e[1] for e in group_entries],
+                group,
+            )
+            for entry, digests in zip(group_entries, done):
+                if digests is not None:
+                    for hash_name in group:
+                        hashes[hash_name][entry[0]] = digests[hash_name]
+    stats.count("bytes_hashed", sum(e[1] for e in todo.values()))
+
+    flats = {}
+    for hash_name in hash_names:
+        found = hashes[hash_name]
+        if hash_name in caches:
+            remember(path, entries, found, caches[hash_name], names)
+        flats[hash_name] = build_flat(path, entries, found, make)
+
+    return flats
@@ -1,4 +1,11 @@
 # Provides functions for manipulating packed dictionarys
+#
+# A packed dict (nest) is a trie of the paths in a Flat, each directory is
+# {"fold": {name: nest}, "file": {name: uid}}. It is also how the state is
+# saved in master. The helpers below are iterative, so their cost is linear in
+# the size of the tree and they do not hit the recursion limit on deep trees.
+
+import sys
 
 
 def empty():
@@ -6,62 +13,96 @@ def empty():
     return {"fold": {}, "file": {}}
 
 
-def insert(nest, chain):
-    # Inserts element at the end of the chain into packed dict, nest.
-    if len(chain) == 2:
-        nest["file"].update({chain[0]: chain[1]})
-        return
+def _walk(nest, chain, make=False):
+    # Returns packed dict at end of chain in packed dict, nest, making any
+    # missing directories if make.
+    for key in chain:
+        folds = nest["fold"]
+        if key not in folds:
+            if not make:
+                raise KeyError(key)
+            folds[sys.intern(key)] = empty()
+        nest = folds[key]
 
-    if chain[0] not in nest["fold"]:
-        nest["fold"].update({chain[0]: empty()})
+    return nest
 
-    insert(nest["fold"][chain[0]], chain[1:])
+
+def insert(nest, chain):
+    # Inserts element at the end of the chain into packed dict, nest.
+    _walk(nest, chain[:-2], make=True)["file"][chain[-2]] = chain[-1]
 
 
 def pack(flat):
-    # Converts flat, into packed dict.
+    # Converts flat, into packed dict. Each directory is looked up once.
     nest = empty()
+    dirs = {"": nest}  # Directory path -> its packed dict.
+
+    def node(path):
+        # Returns the packed dict of path, making it if needed.
+        out = dirs.get(path)
+        missing = []
+        while out is None:
+            missing.append(path)
+            path = path.rpartition("/")[0]
+            out = dirs.get(path)
+
+        for path in reversed(missing):
+            key = path.rpartition("/")[2]
+            folds = out["fold"]
+            out = folds.get(key)
+            if out is None:
+                out = folds[sys.intern(key)] = empty()
+            dirs[path] = out
+
+        return out
+
     for name, file in flat.names.items():
-        chain = name.split("/") + [file.uid]
-        insert(nest, chain)
+        path, _, key = name.rpartition("/")
+        node(path)["file"][key] = file.uid
 
     return nest
 
 
 def unpack(nest, flat, path=""):
-    # Converts packed dict, nest, into flat.
-    for k, v in nest["file"].items():
-        flat.update(path + k, v)
+    # Converts packed dict, nest, into flat. Same order as a depth first walk.
+    stack = [(path, nest)]
+    while stack:
+        path, nest = stack.pop()
+        for k, v in nest["file"].items():
+            flat.update(path + k, v)
 
-    for k, v in nest["fold"].items():
-        unpack(v, flat, path + k + "/")
+        folds = [(path + k + "/", v) for k, v in nest["fold"].items()]
+        stack.extend(reversed(folds))
 
 
-def _get_branch(nest, chain):
-    # Returns packed dict at end of chain in packed dict, nest.
-    if len(chain) == 0:
-        return nest
-    else:
-        return _get_branch(nest["fold"][chain[0]], chain[1:])
+def count(nest):
+    # Returns the number of files in packed dict, nest.
+    total = 0
+    stack = [nest]
+    while stack:
+        nest = stack.pop()
+        total += len(nest["file"])
+        stack.extend(nest["fold"].values())
 
+    return total
 
-def get_branch(nest, path):
-    # Helper function for _get_branch, converts path to chain.
-    return _get_branch(nest, path.split("/"))
 
+def drop(nest, path):
+    # Removes the file at path from packed dict, nest, if it is there.
+    chain = path.split("/")
+    try:
+        _walk(nest, chain[:-1])["file"].pop(chain[-1], None)
+    except KeyError:
+        pass
 
-def _merge(nest, chain, new):
-    # Merge packed dict, new, into packed dict, nest, at end of chain.
-    if len(chain) == 1:
-        nest["fold"].update({chain[0]: new})
-        return
 
-    if chain[0] not in nest["fold"]:
-        nest["fold"].update({chain[0]: empty()})
-
-    _merge(nest["fold"][chain[0]], chain[1:], new)
+def get_branch(nest, path):
+    # Returns packed dict at path in packed dict, nest.
+    return _walk(nest, path.split("/"))
 
 
 def merge(nest, path, new):
-    # Helper function for _merge, converts path to chain.
-    _merge(nest, path.split("/"), new)
+    # Merge packed dict, new, into packed dict, nest, at path.
+    chain = path.split("/")
+    parent = _walk(nest, chain[:-1], make=True)
+    parent["fold"][sys.intern(chain[-1])] = new
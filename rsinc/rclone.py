@@ -1,40 +1,43 @@
-# Provides interface to rclone commands
+# Provides interface to rclone commands and the sync operations
 
 import subprocess
 import logging
 import os
+import tempfile
+import threading
+from contextlib import contextmanager
 
 import ujson
-from rfc3339 import strtotimestamp
-from tqdm import tqdm
 
-from .classes import Flat, Struct, CREATED
+from .classes import Flat, CREATED
 from .colors import red, mgt, cyn, ylw
+from .stats import stats, telemetry
 
 log = logging.getLogger(__name__)
 
 RCLONE_ENCODING = "UTF-8"
+STAMP_TOL = 1e-6  # Modtimes closer than this (seconds) are the same.
+CACHE_LOCK = threading.Lock()  # Held while a stamp cache is changed.
 
-track = Struct()  # global used to track how many operations sync needs.
 
-
-def make_dirs(dirs):
+def make_dirs(dirs, backend):
     """
     @brief      Makes new directories
 
-    @param      dirs  List of directories to mkdir
+    @param      dirs     List of directories to mkdir
+    @param      backend  The backend to make them with
 
     @return     None.
     """
-    global track
-
-    if track.pool.max_workers == 1 or len(dirs) == 0:
+    if backend.workers == 1 or len(dirs) == 0:
         return
 
+    from tqdm import tqdm
+
     for d in tqdm(sorted(dirs, key=len), desc="mkdirs"):
-        subprocess.run(["rclone", "mkdir", d])
+        backend.mkdir(d)
 
-    track.pool.wait()
+    backend.wait()
 
 
 def prepend(name, prefix):
@@ -52,15 +55,16 @@ def prepend(name, prefix):
     return new_name
 
 
-def resolve_case(name, flat):
+def resolve_case(track, name, flat):
     """
     @brief      Prepends name with '_' until no case conflicts in flat.
-    @param      name  The name of the file in flat
-    @param      flat  The Flat with the file in
+
+    @param      track  Struct of the sync in progress
+    @param      name   The name of the file in flat
+    @param      flat   The Flat with the file in
+
     @return     New name of the file.
     """
-    global track
-
     new_name = name
 
     if track.case:
@@ -73,66 +77,247 @@ def resolve_case(name, flat):
     return new_name
 
 
-def lsl(path, hash_name):
+@contextmanager
+def files_from(names):
+    # Yields the rclone flags limiting a command to names (None for all).
+    if names is None:
+        yield []
+        return
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as fp:
+        fp.write("".join(name + "\n" for name in names))
+        fp.flush()
+        yield ["--files-from", fp.name]
+
+
+def lsjson(path, flags=None, names=None):
     """
-    @brief      Runs rclone lsjson and builds a Flat.
+    @brief      Runs rclone lsjson on path.
 
-    @param      path       The path to lsjson
-    @param      hash_name  The hash name to use for the file uid's
-    @param      regexs     List of compiled regexes, a file path/name that
-                           matches any regex will be ignored
+    @param      path   The path to lsjson
+    @param      flags  Extra flags to pass to rclone
+    @param      names  List of the names of the files to list, None for every
+                       file
 
-    @return     A Flat of files representing the current state of directory at
-                path.
+    @return     List of (name, size, modtime) tuples of the files in path.
     """
-    global track
+    flags = [] if flags is None else flags
 
     command = ["rclone", "lsjson", "-R", "--files-only", path]
+    stats.count("rclone_procs", 2)
     subprocess.run(["rclone", "mkdir", path])
-    result = subprocess.Popen(
-        command + track.rclone_flags, stdout=subprocess.PIPE
+
+    with files_from(names) as only:
+        result = subprocess.Popen(
+            command + flags + only, stdout=subprocess.PIPE
+        )
+        entries = ujson.load(result.stdout)
+        result.wait()
+
+    return parse_lsjson(entries)
+
+
+def lsjson_dirs(path, rel, depth, flags=None, hash_name=None):
+    """
+    @brief      Runs rclone lsjson on one directory, depth levels deep.
+
+    @param      path       The path the names are relative to
+    @param      rel        The directory to list, relative to path
+    @param      depth      Number of levels to list
+    @param      flags      Extra flags to pass to rclone
+    @param      hash_name  Name of a hash to ask for (with --hash), None for
+                           no hashes
+
+    @return     List of (name, size, modtime) tuples of the files, dict
+                mapping names to the hashes the remote had, list of the
+                directories on the last level (not listed).
+    """
+    from rfc3339 import strtotimestamp
+
+    flags = [] if flags is None else flags
+
+    command = ["rclone", "lsjson", "-R", "--max-depth", str(depth)]
+    if hash_name is not None:
+        command.append("--hash")
+
+    if rel == "":
+        # The root may not exist yet, i.e. on a first sync.
+        stats.count("rclone_procs")
+        subprocess.run(["rclone", "mkdir", path])
+
+    stats.count("rclone_procs")
+    target = os.path.join(path, rel) if rel else path
+    result = subprocess.run(
+        command + [target] + flags, stdout=subprocess.PIPE
     )
-    list_of_dicts = ujson.load(result.stdout)
+    if result.returncode != 0:
+        # An empty listing would turn every file below into a deletion.
+        print(red("ERROR:"), "can't list", target)
+        raise subprocess.CalledProcessError(result.returncode, result.args)
+
+    found = ujson.loads(result.stdout)
+
+    entries, hashes, dirs = [], {}, []
+    for d in found:
+        name = os.path.join(rel, d["Path"])
+        if d["IsDir"]:
+            if d["Path"].count("/") == depth - 1:
+                dirs.append(name)
+            continue
+
+        entries.append((name, d["Size"], strtotimestamp(d["ModTime"])))
+        hash = d.get("Hashes", {}).get(hash_name)
+        if hash:
+            hashes[name] = hash
+
+    return entries, hashes, dirs
+
+
+def parse_lsjson(list_of_dicts):
+    # Converts decoded rclone lsjson output to (name, size, modtime) tuples.
+    from rfc3339 import strtotimestamp
+
+    return [
+        (d["Path"], d["Size"], strtotimestamp(d["ModTime"]))
+        for d in list_of_dicts
+    ]
+
+
+def hashsum(path, hash_name, names=None):
+    """
+    @brief      Runs rclone hashsum on path.
 
+    @param      path       The path to hash
+    @param      hash_name  The name of the hash to use
+    @param      names      List of the names of the files to hash, None for
+                           every file
+
+    @return     Dict mapping file names to hashes.
+    """
     command = ["rclone", "hashsum", hash_name, path]
-    result = subprocess.Popen(command, stdout=subprocess.PIPE)
+    stats.count("rclone_procs")
+
+    with files_from(names) as only:
+        result = subprocess.Popen(command + only, stdout=subprocess.PIPE)
+        hashes = parse_hashsum(result.stdout)
+        result.wait()
+
+    return hashes
+
+
+def parse_hashsum(lines):
+    # Converts lines (bytes) of rclone hashsum output to a name -> hash dict.
     hashes = {}
 
-    for file in result.stdout:
+    for file in lines:
         decode = file.decode(RCLONE_ENCODING).strip()
         tmp = decode.split("  ", 1)
         hashes[tmp[1]] = tmp[0]
 
-    out = Flat(path)
-    for d in list_of_dicts:
-        time = strtotimestamp(d["ModTime"])
-        hashsize = str(d["Size"])
+    return hashes
 
-        hash = hashes.get(d["Path"], None)
-        if hash is not None:
-            hashsize += hash
-        else:
-            print(red("ERROR:"), "can't find", d["Path"], "hash")
+
+def build_flat(path, entries, hashes, make=None):
+    """
+    @brief      Builds a Flat from a listing and the hashes of its files.
+
+    @param      path     The path that was listed
+    @param      entries  List of (name, size, modtime) tuples
+    @param      hashes   Dict mapping file names to hashes
+    @param      make     Function taking the path and number of files and
+                         returning the empty Flat (or DiskFlat) to fill, None
+                         for a Flat
+
+    @return     A Flat of files representing the current state of directory at
+                path.
+    """
+    out = Flat(path) if make is None else make(path, len(entries))
+    for name, size, time in entries:
+        hash = hashes.get(name, None)
+        if hash is None:
+            print(red("ERROR:"), "can't find", name, "hash")
             continue
 
-        out.update(d["Path"], hashsize, time)
+        out.update(name, str(size) + hash, time, size=size)
 
     return out
 
 
-def safe_push(name, flat_s, flat_d):
+def split_cached(path, entries, cache):
+    """
+    @brief      Looks up the hashes of a listing in a cache of file stamps.
+
+    @param      path     The path that was listed
+    @param      entries  Iterable of (name, size, modtime) tuples
+    @param      cache    Dict mapping full paths to (size, modtime, hash)
+
+    @return     Dict mapping names to the hashes of files whose size and
+                modtime match the cache, list of the entries to hash.
+    """
+    hashes = {}
+    todo = []
+
+    for entry in entries:
+        name, size, time = entry
+        hit = cache.get(os.path.join(path, name))
+
+        if (
+            hit is not None
+            and hit[0] == size
+            and abs(hit[1] - time) < STAMP_TOL
+        ):
+            hashes[name] = hit[2]
+        else:
+            todo.append(entry)
+
+    return hashes, todo
+
+
+def remember(path, entries, hashes, cache, names=None):
+    # Stores the stamps of a listing in cache, forgetting files that have gone.
+    # If the listing was limited to names only they can have gone. Folders
+    # crawled at once share the cache, so it is changed under CACHE_LOCK.
+    with CACHE_LOCK:
+        if names is None:
+            prefix = os.path.join(path, "")
+            gone = [full for full in cache if full.startswith(prefix)]
+        else:
+            gone = [os.path.join(path, name) for name in names]
+
+        for full in gone:
+            cache.pop(full, None)
+
+        for name, size, time in entries:
+            if name in hashes:
+                cache[os.path.join(path, name)] = (size, time, hashes[name])
+
+
+def lsl(path, hash_name, flags=None):
+    """
+    @brief      Runs rclone lsjson and builds a Flat.
+
+    @param      path       The path to lsjson
+    @param      hash_name  The hash name to use for the file uid's
+    @param      flags      Extra flags to pass to rclone lsjson
+
+    @return     A Flat of files representing the current state of directory at
+                path.
+    """
+    return build_flat(path, lsjson(path, flags), hashsum(path, hash_name))
+
+
+def safe_push(track, name, flat_s, flat_d):
     """
     @brief      Used to push file when file not in destination, performs case
                 checking / correcting and updates Flats as appropriate.
 
+    @param      track   Struct of the sync in progress
     @param      name    The name of the file to push
     @param      flat_s  The source Flat
     @param      flat_d  The destination Flat
 
     @return     None.
     """
-    global track
-
     old = ""
     new = name
 
@@ -140,24 +325,25 @@ def safe_push(name, flat_s, flat_d):
     c = 1
 
     while new != old:
-        new, old = resolve_case(new, pair[c]), new
+        new, old = resolve_case(track, new, pair[c]), new
         c = 0 if c == 1 else 1
 
     cpd_dump = flat_s.names[name].dump()
     flat_d.update(new, *cpd_dump)
 
-    push(name, new, flat_s, flat_d)
+    push(track, name, new, flat_s, flat_d)
 
     if new != name:
         # Must wait for copy to finish before renaming source.
-        track.pool.wait()
-        move(name, new, flat_s)
+        wait(track)
+        move(track, name, new, flat_s)
 
 
-def safe_move(name_s, name_d, flat_in, flat_mirror):
+def safe_move(track, name_s, name_d, flat_in, flat_mirror):
     """
     @brief      Moves file performing case checking / correcting.
 
+    @param      track        Struct of the sync in progress
     @param      name_s       The name of the source file
     @param      name_d       The name of the destination file
     @param      flat_in      The Flat in which the move occurs
@@ -172,26 +358,46 @@ def safe_move(name_s, name_d, flat_in, flat_mirror):
     c = 0
 
     while new != old:
-        new, old = resolve_case(new, pair[c]), new
+        new, old = resolve_case(track, new, pair[c]), new
         c = 0 if c == 1 else 1
 
     if new != name_d:
-        move(name_d, new, flat_mirror)
+        move(track, name_d, new, flat_mirror)
+
+    move(track, name_s, new, flat_in)
+
+
+def record(track, kind, src, dst=None):
+    # Appends an operation to track.ops if they are being recorded.
+    if track.ops is not None:
+        track.ops.append((kind, src, dst))
+
+
+def wait(track):
+    """
+    @brief      Waits for all running operations to finish (live runs only).
+
+    @param      track  Struct of the sync in progress
+
+    @return     None.
+    """
+    record(track, "wait", None)
 
-    move(name_s, new, flat_in)
+    if not track.dry:
+        track.backend.wait()
 
 
-def move(name_s, name_d, flat):
+def move(track, name_s, name_d, flat):
     """
     @brief      Moves file in flat. Updates flat as appropriate.
 
+    @param      track   Struct of the sync in progress
     @param      name_s  The name of the source file
     @param      name_d  The name of the destination file
     @param      flat    The Flat in which the move occurs
 
     @return     None.
     """
-    global track
     track.count += 1
 
     base = flat.path
@@ -209,18 +415,14 @@ def move(name_s, name_d, flat):
     info = col(text) + " (%s) " % base + name_s + col(" to: ") + name_d
     text = text.ljust(10)
 
+    src = os.path.join(base, name_s)
+    dst = os.path.join(base, name_d)
+    record(track, "move", src, dst)
+
     if not track.dry:
         print("%d/%d" % (track.count, track.total), info)
         log.info("%s(%s) %s TO %s", text.upper(), base, name_s, name_d)
-        track.pool.run(
-            [
-                "rclone",
-                "moveto",
-                os.path.join(base, name_s),
-                os.path.join(base, name_d),
-            ]
-            + track.rclone_flags
-        )
+        track.backend.move(src, dst)
     else:
         print(info)
 
@@ -229,10 +431,11 @@ def move(name_s, name_d, flat):
     flat.update(name_d, *mvd_dump)
 
 
-def push(name_s, name_d, flat_s, flat_d):
+def push(track, name_s, name_d, flat_s, flat_d):
     """
     @brief      Copies file.
 
+    @param      track   Struct of the sync in progress
     @param      name_s  The name of the source file
     @param      name_d  The name of the destination file
     @param      flat_s  The Flat containing the source file
@@ -240,7 +443,6 @@ def push(name_s, name_d, flat_s, flat_d):
 
     @return     None.
     """
-    global track
     track.count += 1
 
     if flat_s.path == track.lcl and flat_d.path == track.rmt:
@@ -253,32 +455,34 @@ def push(name_s, name_d, flat_s, flat_d):
 
     info = col("%s " % text) + name_d
     text = text.ljust(10)
+    size = flat_s.names[name_s].size
+
+    src = os.path.join(flat_s.path, name_s)
+    dst = os.path.join(flat_d.path, name_d)
+    record(track, "copy", src, dst)
 
     if not track.dry:
-        print("%d/%d" % (track.count, track.total), info)
+        progress = telemetry.progress()
+        print("%d/%d" % (track.count, track.total), progress, info)
         log.info("%s%s", text.upper(), name_d)
-        cmd = [
-            "rclone",
-            "copyto",
-            os.path.join(flat_s.path, name_s),
-            os.path.join(flat_d.path, name_d),
-        ]
-        track.pool.run(cmd + track.rclone_flags)
+        track.backend.copy(src, dst, size)
     else:
         print(info)
+        telemetry.plan(size)
 
     # Needed for fast save
     flat_d.names[name_d].uid = flat_s.names[name_s].uid
 
 
-def pull(name_s, name_d, flat_s, flat_d):
-    push(name_d, name_s, flat_d, flat_s)
+def pull(track, name_s, name_d, flat_s, flat_d):
+    push(track, name_d, name_s, flat_d, flat_s)
 
 
-def conflict(name_s, name_d, flat_s, flat_d):
+def conflict(track, name_s, name_d, flat_s, flat_d):
     """
     @brief      Resolves conflicts by renaming files and copying both ways.
 
+    @param      track   Struct of the sync in progress
     @param      name_s  The name of the conflicting file in flat_s
     @param      name_d  The name of the conflicting file in flat_d
     @param      flat_s  The Flat of lcl/rmt files
@@ -286,8 +490,6 @@ def conflict(name_s, name_d, flat_s, flat_d):
 
     @return     None.
     """
-    global track
-
     if (
         flat_s.names[name_s].state == CREATED
         and flat_d.names[name_d].state == CREATED
@@ -303,47 +505,49 @@ def conflict(name_s, name_d, flat_s, flat_d):
 
     if not track.dry:
         log.info("CONFLICT: %s", name_s)
+        stats.count("conflicts")
 
-    nn_s = resolve_case(prepend(name_s, "lcl_"), flat_s)
-    nn_d = resolve_case(prepend(name_d, "rmt_"), flat_d)
+    nn_s = resolve_case(track, prepend(name_s, "lcl_"), flat_s)
+    nn_d = resolve_case(track, prepend(name_d, "rmt_"), flat_d)
 
-    move(name_s, nn_s, flat_s)
-    move(name_d, nn_d, flat_d)
+    move(track, name_s, nn_s, flat_s)
+    move(track, name_d, nn_d, flat_d)
 
     if nn_s != name_s or nn_d != name_d:
         # Must wait for renames before copying.
-        track.pool.wait()
+        wait(track)
 
-    safe_push(nn_s, flat_s, flat_d)
-    safe_push(nn_d, flat_d, flat_s)
+    safe_push(track, nn_s, flat_s, flat_d)
+    safe_push(track, nn_d, flat_d, flat_s)
 
 
-def delL(name_s, name_d, flat_s, flat_d):
+def delL(track, name_s, name_d, flat_s, flat_d):
     """
     @brief      Deletes file.
 
+    @param      track   Struct of the sync in progress
     @param      name_s  The name of the file to delete
     @param      name_d  Dummy argument
     @param      flat_s  The Flat in containing the file to delete
     @param      flat_d  Dummy argument
 
     """
-    global track
     track.count += 1
 
-    info = ylw("Delete: ") + os.path.join(flat_s.path, name_s)
+    path = os.path.join(flat_s.path, name_s)
+    info = ylw("Delete: ") + path
+    record(track, "delete", path)
 
     if not track.dry:
         print("%d/%d" % (track.count, track.total), info)
-        log.info("DELETE:   %s", os.path.join(flat_s.path, name_s))
-        cmd = ["rclone", "delete", os.path.join(flat_s.path, name_s)]
-        track.pool.run(cmd + track.rclone_flags)
+        log.info("DELETE:   %s", path)
+        track.backend.delete(path)
     else:
         print(info)
 
 
-def delR(name_s, name_d, flat_s, flat_d):
-    delL(name_d, name_s, flat_d, flat_s)
+def delR(track, name_s, name_d, flat_s, flat_d):
+    delL(track, name_d, name_s, flat_d, flat_s)
 
 
 def null(*args):
@@ -2,69 +2,37 @@
 
 import argparse
 import os
-import subprocess
+import sys
 import logging
-import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
 
-import ujson
-import halo
-from pyfiglet import Figlet
-
-from .sync import sync, calc_states
-from .rclone import make_dirs, lsl
-from .packed import pack, merge, unpack, get_branch, empty
-from .classes import Flat
+from .session import SyncSession, FanOut, remotes, rounds, qt, read
 from .colors import grn, ylw, red
 from .config import config_cli
+from .stats import stats, telemetry
 
 from .__init__ import __version__
 
-SPIN = halo.Halo(spinner="dots", placement="right", color="yellow")
 CONFIG_FILE = os.path.expanduser("~/.rsinc/config.json")  # Default config path
 
-custom_fig = Figlet(font="graffiti")
-print(custom_fig.renderText("Rsinc"))
-print("Copyright 2019 C. J. Williams (CHURCHILL COLLEGE)")
-print("This is free software with ABSOLUTELY NO WARRANTY")
-
 
-def qt(string):
-    return '"' + string + '"'
+class NoSpin:
+    # Stands in for a halo spinner when not interactive.
+    def start(self, text):
+        print(text)
 
-
-def read(file):
-    """Reads json do dict and returns dict."""
-    try:
-        with open(file, "r") as fp:
-            d = ujson.load(fp)
-            if not isinstance(d, dict):
-                raise ValueError("old file format")
-    except Exception as e:
-        emsg = "{} is corrupt ({}). ".format(file, e)
-        if file.endswith("master.json"):
-            emsg += "Delete it and restart rsinc to rebuild it."
-        raise TypeError(emsg)
-    return d
+    def stop_and_persist(self, symbol=""):
+        return
 
 
-def write(file, d):
-    """Writes dict to json"""
-    with open(file, "w") as fp:
-        ujson.dump(d, fp, sort_keys=True, indent=2)
+SPIN = NoSpin()
 
 
 def strtobool(string):
     return string.lower() in STB
 
-
-def escape(string):
-    tmp = []
-    for char in string:
-        tmp.append(ESCAPE.get(char, char))
-    return "".join(tmp)
-
-
 # ****************************************************************************
 # *                               Set-up/Parse                               *
 # ****************************************************************************
@@ -74,79 +42,208 @@ def formatter(prog):
     return argparse.HelpFormatter(prog, max_help_position=52)
 
 
-parser = argparse.ArgumentParser(formatter_class=formatter)
-
-parser.add_argument("folders", help="Folders to sync", nargs="*")
-parser.add_argument("-d", "--dry", action="store_true", help="Do a dry run")
-parser.add_argument(
-    "-c", "--clean", action="store_true", help="Clean directories"
-)
-parser.add_argument(
-    "-D", "--default", help="Sync defaults", action="store_true"
-)
-parser.add_argument(
-    "-r", "--recovery", action="store_true", help="Enter recovery mode"
-)
-parser.add_argument(
-    "-a", "--auto", help="Don't ask permissions", action="store_true"
-)
-parser.add_argument(
-    "-p", "--purge", help="Reset history for all folders", action="store_true"
-)
-parser.add_argument(
-    "-i", "--ignore", help="Find .rignore files", action="store_true"
-)
-parser.add_argument(
-    "-v", "--version", action="version", version=f"rsinc version: {__version__}"
-)
-parser.add_argument(
-    "--config", action="store_true", help="Enter interactive CLI configurer"
-)
-parser.add_argument(
-    "--config_path", help="Path to config file (default ~/.rsinc/config.json)"
-)
-parser.add_argument(
-    "args",
-    nargs=argparse.REMAINDER,
-    help="Global flags to pass to rclone commands",
-)
-
-args = parser.parse_args()
+def build_parser():
+    # Returns the parser for rsinc's command line arguments.
+    parser = argparse.ArgumentParser(formatter_class=formatter)
+
+    parser.add_argument("folders", help="Folders to sync", nargs="*")
+    parser.add_argument(
+        "-d", "--dry", action="store_true", help="Do a dry run"
+    )
+    parser.add_argument(
+        "-c", "--clean", action="store_true", help="Clean directories"
+    )
+    parser.add_argument(
+        "-D", "--default", help="Sync defaults", action="store_true"
+    )
+    parser.add_argument(
+        "-r", "--recovery", action="store_true", help="Enter recovery mode"
+    )
+    parser.add_argument(
+        "-a", "--auto", help="Don't ask permissions", action="store_true"
+    )
+    parser.add_argument(
+        "-p",
+        "--purge",
+        help="Reset history for all folders",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-i", "--ignore", help="Find .rignore files", action="store_true"
+    )
+    parser.add_argument(
+        "-q",
+        "--quick",
+        action="store_true",
+        help="Only hash files whose size or modtime changed",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Sync N folders at once and confirm them together",
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help="Start recovery transfers before hashing finishes",
+    )
+    parser.add_argument(
+        "--plan-procs",
+        type=int,
+        help="Plan large folders with N processes",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        help="Stop starting transfers after SECONDS and save what finished",
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        help="Stop starting transfers before BYTES are copied",
+        metavar="BYTES",
+    )
+    parser.add_argument(
+        "--paths-from",
+        help="Only sync the files listed in FILE, - for stdin",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        version=f"rsinc version: {__version__}",
+    )
+    parser.add_argument(
+        "--config",
+        action="store_true",
+        help="Enter interactive CLI configurer",
+    )
+    parser.add_argument(
+        "--config_path",
+        help="Path to config file (default ~/.rsinc/config.json)",
+    )
+    parser.add_argument(
+        "--plan-out", help="Save the planned operations to file"
+    )
+    parser.add_argument(
+        "--apply-plan", help="Check and execute the plans saved in file"
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print timings and counters at exit",
+    )
+    parser.add_argument(
+        "--stats-json", help="Write timings and counters to file"
+    )
+    parser.add_argument(
+        "--profile", help="Write a cProfile dump of the planner"
+    )
+    parser.add_argument(
+        "--metrics", help="Write Prometheus metrics to file at exit"
+    )
+    parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="Global flags to pass to rclone commands",
+    )
+
+    return parser
 
 
 # ****************************************************************************
 # *                              Configuration                               *
 # ****************************************************************************
 
-# Read config and assign variables.
-if args.config_path is None:
-    config_path = CONFIG_FILE
-else:
-    config_path = args.config_path
-
-if not os.path.isfile(config_path) or args.config:
-    config_cli(config_path)
-
-config = read(config_path)
-
-CASE_INSENSATIVE = config["CASE_INSENSATIVE"]
-DEFAULT_DIRS = config["DEFAULT_DIRS"]
-LOG_FOLDER = config["LOG_FOLDER"]
-HASH_NAME = config["HASH_NAME"]
-TEMP_FILE = config["TEMP_FILE"]
-MASTER = config["MASTER"]
-BASE_R = config["BASE_R"]
-BASE_L = config["BASE_L"]
-FAST_SAVE = config["FAST_SAVE"]
-
-# Set up logging.
-logging.basicConfig(
-    filename=LOG_FOLDER + datetime.now().strftime("%Y-%m-%d"),
-    level=logging.DEBUG,
-    datefmt="%H:%M:%S",
-    format="%(asctime)s %(levelname)s: %(message)s",
-)
 
+def configure(config_path, interactive):
+    """
+    @brief      Reads the config (running the configurer if needed) and sets
+                up logging.
+
+    @param      config_path  Path to the config file, None for the default
+    @param      interactive  Force the interactive configurer
+
+    @return     The config dict.
+    """
+    if config_path is None:
+        config_path = CONFIG_FILE
+
+    if not os.path.isfile(config_path) or interactive:
+        config_cli(config_path)
+
+    config = read(config_path)
+
+    # Set up logging.
+    logging.basicConfig(
+        filename=config["LOG_FOLDER"] + datetime.now().strftime("%Y-%m-%d"),
+        level=logging.DEBUG,
+        datefmt="%H:%M:%S",
+        format="%(asctime)s %(levelname)s: %(message)s",
+    )
+
+    return config
+
+
+def read_targets(file, base, folders):
+    """
+    @brief      Reads a list of files to sync, one path per line, and groups
+                them by the folder they are in.
+
+    @param      file     Path to the list, - for stdin
+    @param      base     The local base path, BASE_L
+    @param      folders  List of folders (relative to BASE_L) being synced
+
+    @return     Dict mapping folders to the names (relative to the folder) of
+                their listed files.
+    """
+    if file == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(file, "r") as fp:
+            lines = fp.read().splitlines()
+
+    # Normalised so the root folder "." matches, deepest match wins.
+    roots = [
+        (os.path.join(os.path.normpath(os.path.join(base, f)), ""), f)
+        for f in folders
+    ]
+    roots.sort(key=lambda root: len(root[0]), reverse=True)
+
+    targets = {}
+    for line in lines:
+        line = line.strip()
+        if line == "":
+            continue
+
+        path = os.path.normpath(os.path.abspath(line))
+        for root, folder in roots:
+            if path.startswith(root):
+                name = os.path.relpath(path, root)
+                targets.setdefault(folder, []).append(name)
+                break
+        else:
+            print(ylw("Rejecting:"), path, "not in the folders synced")
+
+    return targets
+
+
+def banner():
+    # Prints the title, pyfiglet is only imported when needed.
+    from pyfiglet import Figlet
+
+    custom_fig = Figlet(font="graffiti")
+    print(custom_fig.renderText("Rsinc"))
+    print("Copyright 2019 C. J. Williams (CHURCHILL COLLEGE)")
+    print("This is free software with ABSOLUTELY NO WARRANTY")
+
+
+# ****************************************************************************
 # ****************************************************************************
 # *                               Main Program                               *
 # ****************************************************************************
@@ -154,14 +251,40 @@ logging.basicConfig(
 
 def main():
     # Entry point for 'rsinc' as terminal command.
+    global args, SPIN
+
+    args = build_parser().parse_args()
 
-    recover = args.recovery
-    dry_run = args.dry
-    auto = args.auto
+    interactive = sys.stdout.isatty() and not args.auto
+    if interactive:
+        import halo
+
+        SPIN = halo.Halo(spinner="dots", placement="right", color="yellow")
+        banner()
+
+    config = configure(args.config_path, args.config)
+    BASE_L = config["BASE_L"]
+
+    if args.quick:
+        config["QUICK"] = True
+    if args.stream:
+        config["STREAM"] = True
+    if args.plan_procs is not None:
+        config["PLAN_PROCS"] = args.plan_procs
+    if args.time_budget is not None:
+        config["TIME_BUDGET"] = args.time_budget
+    if args.max_bytes is not None:
+        config["MAX_BYTES"] = args.max_bytes
+    if args.metrics is not None:
+        config["METRICS_FILE"] = args.metrics
+
+    stats.profiling = args.profile is not None
 
     # Decide which folder(s) to sync.
-    if args.default:
-        tmp = DEFAULT_DIRS
+    if args.apply_plan is not None:
+        tmp = []
+    elif args.default:
+        tmp = config["DEFAULT_DIRS"]
     elif len(args.folders) == 0:
         tmp = [os.getcwd()]
     else:
@@ -188,16 +311,13 @@ def main():
             folders.append(os.path.relpath(f, BASE_L))
 
     # Get & read master.
-    if args.purge or not os.path.exists(MASTER):
-        print(ylw("WARN:"), MASTER, "missing, this must be your first run")
-        write(MASTER, {'history':[], 'ignores':[], 'nest':empty()})
-
-    master = read(MASTER)
-    history = master['history']
-    ignores = master['ignores']
-    nest = master['nest']
+    if len(remotes(config)) > 1:
+        session = FanOut(config, flags=args.args)
+    else:
+        session = SyncSession(config, flags=args.args)
 
-    history = set(history)
+    if args.purge:
+        session.load(purge=True)
 
     # Find all the ignore files in lcl and save them.
     if args.ignore:
@@ -208,163 +328,320 @@ def main():
                     ignores.append(os.path.join(dirpath, name))
 
         print("Found:", ignores)
-        write(MASTER, {'history':list(history), 'ignores':ignores, 'nest':nest})
+        session.set_ignores(ignores)
 
     # Detect crashes.
-    if os.path.exists(TEMP_FILE):
-        corrupt = read(TEMP_FILE)["folder"]
-        if corrupt in folders:
-            folders.remove(corrupt)
+    corrupt = session.crashed()
+    unfinished = session.unfinished()
+    for folder in reversed(corrupt):
+        if folder in folders:
+            folders.remove(folder)
+
+        folders.insert(0, folder)
+        if folder in unfinished:
+            print(ylw("Resuming:"), "the recovery of", folder)
+        else:
+            print(red("ERROR") + ", detected a crash, recovering", folder)
+            logging.warning("Detected crash, recovering %s", folder)
+
+    targets = None
+    if args.paths_from is not None:
+        if (
+            isinstance(session, FanOut)
+            or args.apply_plan is not None
+            or args.jobs > 1
+        ):
+            print(red("ERROR:"), "--paths-from needs a single remote", end="")
+            print(", one job and no --apply-plan")
+            return
 
-        folders.insert(0, corrupt)
-        recover = True
-        print(red("ERROR") + ", detected a crash, recovering", corrupt)
-        logging.warning("Detected crash, recovering %s", corrupt)
+        targets = read_targets(args.paths_from, BASE_L, folders)
+        folders = [f for f in folders if f in targets]
+    else:
+        session.share(folders)
+
+    if isinstance(session, FanOut):
+        sync_fanout(session, folders, corrupt)
+    elif args.apply_plan is not None:
+        apply_plan(session, args.apply_plan, corrupt)
+    elif args.jobs > 1 and len(folders) > 1:
+        sync_many(session, folders, corrupt)
+    else:
+        planned = []
 
-    # Main loop.
-    for folder in folders:
-        print("")
-        path_lcl = os.path.join(BASE_L, folder)
-        path_rmt = os.path.join(BASE_R, folder)
+        # Main loop.
+        for folder in folders:
+            print("")
+            if session.spent():
+                print(ylw("Budget spent:"), "stopping before", qt(folder))
+                break
 
-        # Determine if first run.
-        if os.path.join(BASE_L, folder) in history:
-            print(grn("Have:"), qt(folder) + ", entering sync & merge mode")
-        else:
-            print(ylw("Don't have:"), qt(folder) + ", entering first_sync mode")
-            recover = True
+            lease = session.lease(folder)
+            if lease is None:
+                print(ylw("Skipping:"), qt(folder), "is busy")
+                continue
 
-        # Build relative regular expressions
-        rmt_regexs, lcl_regexs, plain = build_regexs(
-            BASE_L, BASE_R, path_lcl, ignores
-        )
-        print("Ignore:", plain)
+            with lease:
+                sync_one(session, folder, corrupt, targets, planned)
 
-        # Scan directories.
-        SPIN.start(("Crawling: ") + qt(folder))
+    session.save_stamps()
 
-        lcl = lsl(path_lcl, HASH_NAME)
-        rmt = lsl(path_rmt, HASH_NAME)
-        old = Flat(path_lcl)
+    print("")
+    if telemetry.transfers:
+        print(telemetry.summary())
+    print(grn("All synced!"))
 
+    if args.stats:
+        print("")
+        stats.show()
+    if args.stats_json is not None:
+        stats.write(args.stats_json)
+    if args.profile is not None:
+        stats.dump_profile(args.profile)
+    if config.get("METRICS_FILE"):
+        stats.write_prometheus(config["METRICS_FILE"])
+
+
+def sync_one(session, folder, corrupt, targets, planned):
+    # Plans, executes and saves one folder, see main.
+    recover = args.recovery or folder in corrupt
+    plan = session.prepare(folder, recover)
+
+    if targets is not None:
+        plan = session.target(plan, targets[folder])
+        if plan is None:
+            return
+
+    if session.streaming and plan["recover"] and not args.plan_out:
+        session.stream_plan(plan)
+    else:
+        SPIN.start(("Crawling: ") + qt(folder))
+        session.crawl(plan)
         SPIN.stop_and_persist(symbol="✔")
 
-        lcl.tag_ignore(lcl_regexs)
-        rmt.tag_ignore(rmt_regexs)
+        session.dry_pass(plan)
+
+    if args.plan_out is not None:
+        planned.append(plan)
+        session.export(planned, args.plan_out)
+
+    if not args.dry and (
+        args.auto or plan["total"] == 0 or strtobool(input("Execute? "))
+    ):
+        execute(session, plan)
+
+    if args.clean:
+        prune(session, plan)
 
-        # First run & recover mode.
-        if recover:
-            print("Running", ylw("recover/first_sync"), "mode")
+
+def lease_all(session, folders):
+    # Takes the leases on folders, returns an ExitStack holding them and the
+    # folders whose lease was taken. They are taken in sorted order, so two
+    # hosts never each hold a lease the other is waiting for.
+    held, taken = ExitStack(), set()
+    for folder in sorted(folders):
+        lease = session.lease(folder)
+        if lease is None:
+            print(ylw("Skipping:"), qt(folder), "is busy")
         else:
-            print("Reading last state")
-            branch = get_branch(nest, folder)
-            unpack(branch, old)
-
-            calc_states(old, lcl)
-            calc_states(old, rmt)
-
-        print(grn("Dry pass:"))
-        total, new_dirs, _, _ = sync(
-            lcl,
-            rmt,
-            old,
-            recover,
-            dry_run=True,
-            case=CASE_INSENSATIVE,
-            flags=args.args,
-        )
-
-        print("Found:", total, "job(s)")
-        print("With:", len(new_dirs), "folder(s) to make")
-
-        if not dry_run and (
-            auto or total == 0 or strtobool(input("Execute? "))
-        ):
-            if total != 0 or recover:
-                print(grn("Live pass:"))
-
-                write(TEMP_FILE, {"folder": folder})
-
-                make_dirs(new_dirs)
-                _, _, lcl, rmt, = sync(
-                    lcl,
-                    rmt,
-                    old,
-                    recover,
-                    total=total,
-                    case=CASE_INSENSATIVE,
-                    dry_run=dry_run,
-                    flags=args.args,
-                )
+            held.enter_context(lease)
+            taken.add(folder)
+
+    return held, [f for f in folders if f in taken]
+
+
+def sync_many(session, folders, corrupt):
+    """
+    @brief      Syncs several folders at once: crawls them concurrently, shows
+                one combined plan, asks once and then runs the live passes
+                concurrently through the one (worker bounded) backend. A
+                folder overlapping an earlier one is synced in a later round,
+                planned once the rounds before it are saved.
+
+    @param      session  The SyncSession to sync with
+    @param      folders  List of folders (relative to BASE_L) to sync
+    @param      corrupt  List of folders recovering from a crash
+
+    @return     None.
+    """
+    held, folders = lease_all(session, folders)
+    with held:
+        planned = []
+        for group in rounds(folders):
+            if session.spent():
+                print("")
+                print(ylw("Budget spent:"), "stopping before", qt(group[0]))
+                break
 
-                SPIN.start(grn("Saving: ") + qt(folder))
+            sync_leased(session, group, corrupt, planned)
 
-                # Get post sync state
-                if total == 0:
-                    print("Skipping crawl as no jobs")
-                    now = lcl
-                elif FAST_SAVE:
-                    print("Skipping crawl as FAST_SAVE")
-                    now = lcl
-                else:
-                    now = lsl(path_lcl, HASH_NAME)
-                    now.tag_ignore(lcl_regexs)
 
-                now.rm_ignore()
+def sync_leased(session, folders, corrupt, planned):
+    # Syncs one round of sync_many, folders do not overlap and their leases
+    # are held. The plans are added to planned, for --plan-out.
+    plans = []
+    for folder in folders:
+        print("")
+        recover = args.recovery or folder in corrupt
+        plans.append(session.prepare(folder, recover))
 
-                # Merge into history.
-                history.add(os.path.join(BASE_L, folder))
-                history.update(d for d in now.dirs)
+    print("")
+    SPIN.start("Crawling: %d folders" % len(plans))
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # list() re-raises any exception from a crawl.
+        list(executor.map(session.crawl, plans))
+    SPIN.stop_and_persist(symbol="✔")
+
+    # Dry passes print their operations so must run one at a time.
+    for plan in plans:
+        print("")
+        print(grn("Plan:"), qt(plan["folder"]))
+        session.dry_pass(plan)
 
-                # Merge into nest
-                merge(nest, folder, pack(now))
-                write(MASTER, {'history':list(history), 'ignores':ignores, 'nest':nest})
+    if args.plan_out is not None:
+        planned += plans
+        session.export(planned, args.plan_out)
 
-                subprocess.run(["rm", TEMP_FILE])
+    total = sum(plan["total"] for plan in plans)
+    n_dirs = sum(len(plan["new_dirs"]) for plan in plans)
 
-                SPIN.stop_and_persist(symbol="✔")
+    print("")
+    print("Found:", total, "job(s) in", len(plans), "folder(s)")
+    print("With:", n_dirs, "folder(s) to make")
 
-        if args.clean:
-            SPIN.start(grn("Pruning: ") + qt(folder))
-            subprocess.run(["rclone", "rmdirs", path_rmt])
-            subprocess.run(["rclone", "rmdirs", path_lcl])
+    if not args.dry and (
+        args.auto or total == 0 or strtobool(input("Execute all? "))
+    ):
+        print("")
+        print(grn("Executing:"), len(plans), "folder(s)")
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            list(executor.map(session.execute, plans))
+
+        if session.pending:
+            SPIN.start(grn("Saving: ") + "%d folder(s)" % len(plans))
+            session.commit()
             SPIN.stop_and_persist(symbol="✔")
 
-        recover = args.recovery
+    if args.clean:
+        for plan in plans:
+            prune(session, plan)
+
+
+def sync_fanout(fan, folders, corrupt):
+    """
+    @brief      Syncs folders to every remote in REMOTES, listing local once.
+
+    @param      fan      The FanOut to sync with
+    @param      folders  List of folders (relative to BASE_L) to sync
+    @param      corrupt  List of folders recovering from a crash
+
+    @return     None.
+    """
+    if args.plan_out is not None or args.apply_plan is not None:
+        print(red("ERROR:"), "plan files need a single remote")
+        return
+
+    for folder in folders:
+        print("")
+        if fan.spent():
+            print(ylw("Budget spent:"), "stopping before", qt(folder))
+            break
+
+        lease = fan.lease(folder)
+        if lease is None:
+            print(ylw("Skipping:"), qt(folder), "is busy")
+            continue
+
+        with lease:
+            fan_one(fan, folder, corrupt)
+
+
+def fan_one(fan, folder, corrupt):
+    # Plans, executes and saves one folder on every remote, see sync_fanout.
+    recover = args.recovery or folder in corrupt
+
+    plans = fan.prepare(folder, recover)
+
+    SPIN.start(("Crawling: ") + qt(folder))
+    fan.crawl(plans)
+    SPIN.stop_and_persist(symbol="✔")
+
+    fan.dry_pass(plans)
+
+    total = sum(plan["total"] for plan in plans)
 
     print("")
-    print(grn("All synced!"))
+    print("Found:", total, "job(s) for", len(plans), "remote(s)")
+
+    if not args.dry and (
+        args.auto or total == 0 or strtobool(input("Execute all? "))
+    ):
+        fan.execute(plans)
+        SPIN.start(grn("Saving: ") + qt(folder))
+        fan.commit()
+        SPIN.stop_and_persist(symbol="✔")
 
+    if args.clean:
+        fan.prune(plans)
 
-def build_regexs(BASE_L, BASE_R, path_lcl, files):
-    lcl_regex = []
-    rmt_regex = []
-    plain = []
 
-    for file in files:
-        for f_char, p_char in zip(os.path.dirname(file), path_lcl):
-            if f_char != p_char:
-                break
-        else:
-            if os.path.exists(file):
-                with open(file, "r") as fp:
-                    for line in fp:
-                        if line.rstrip() == "":
-                            continue
-                        mid = os.path.dirname(file)
-                        mid = mid[len(BASE_L) + 1:]
-                        mid = os.path.join(escape(mid), line.rstrip())
+def apply_plan(session, file, corrupt):
+    """
+    @brief      Executes the still valid plans in a plan file.
 
-                        lcl = os.path.join(escape(BASE_L), mid)
-                        rmt = os.path.join(escape(BASE_R), mid)
+    @param      session  The SyncSession to sync with
+    @param      file     Path to the plan file
+    @param      corrupt  List of folders recovering from a crash
 
-                        plain.append(mid)
-                        lcl_regex.append(re.compile(lcl))
-                        rmt_regex.append(re.compile(rmt))
+    @return     None.
+    """
+    if corrupt:
+        print(red("ERROR:"), "recover from the crash before applying a plan")
+        return
 
-    return rmt_regex, lcl_regex, plain
+    folders = [saved["folder"] for saved in read(file)["plans"]]
+    held, folders = lease_all(session, folders)
+    with held:
+        apply_leased(session, file, folders)
 
 
+def apply_leased(session, file, folders):
+    # See apply_plan, the leases on folders are held.
+    plans = session.apply(file, folders)
+    total = sum(plan["total"] for plan in plans)
+
+    print("")
+    print("Found:", total, "job(s) in", len(plans), "valid plan(s)")
+
+    if not args.dry and (
+        args.auto or total == 0 or strtobool(input("Execute all? "))
+    ):
+        for plan in plans:
+            print("")
+            print(grn("Executing:"), qt(plan["folder"]))
+            execute(session, plan)
+
+    if args.clean:
+        for plan in plans:
+            prune(session, plan)
+
+
+def execute(session, plan):
+    # Runs the live pass of a plan and saves it straight away.
+    session.execute(plan)
+
+    if session.pending:
+        SPIN.start(grn("Saving: ") + qt(plan["folder"]))
+        session.commit()
+        SPIN.stop_and_persist(symbol="✔")
+
+
+def prune(session, plan):
+    # Removes empty directories from both sides of a plan's folder.
+    SPIN.start(grn("Pruning: ") + qt(plan["folder"]))
+    session.prune(plan)
+    SPIN.stop_and_persist(symbol="✔")
+
 STB = (
     "yes",
     "ye",
@@ -381,21 +658,3 @@ STB = (
     "ok",
     "hell yes",
 )
-
-
-ESCAPE = {
-    "\\": "\\\\",
-    ".": "\\.",
-    "^": "\\^",
-    "$": "\\$",
-    "*": "\\*",
-    "+": "\\+",
-    "?": "\\?",
-    "|": "\\|",
-    "(": "\\(",
-    ")": "\\)",
-    "{": "\\{",
-    "}": "\\}",
-    "[": "\\[",
-    "]": "\\]",
-}
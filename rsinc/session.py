@@ -0,0 +1,1520 @@
+# Provides SyncSession, an API for running rsinc from another program
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from contextlib import ExitStack, nullcontext
+from copy import deepcopy
+
+import ujson
+
+from .sync import sync, sync_parallel, calc_states, PARALLEL_MIN
+from .rclone import make_dirs, push, pull
+from .backends import Rclone, Budget
+from .packed import pack, merge, unpack, get_branch, empty
+from .packed import insert, drop
+from .classes import Flat, Struct, DELETED
+from .history import History
+from .index import INDEX, read_index, write_index, updated
+from .lease import Lease, LEASES
+from .colors import grn, ylw, red
+from .stats import stats, telemetry
+
+log = logging.getLogger(__name__)
+
+STREAM_BATCH = 1000  # Files on both sides hashed per step of a stream.
+FILE_BYTES = 1024  # Rough memory used by a File in a Flat.
+FLAT_COPIES = 5  # Flats of a folder in memory at once while planning.
+
+
+def qt(string):
+    return '"' + string + '"'
+
+
+def read(file):
+    """Reads json do dict and returns dict."""
+    try:
+        with open(file, "r") as fp:
+            d = ujson.load(fp)
+            if not isinstance(d, dict):
+                raise ValueError("old file format")
+    except Exception as e:
+        emsg = "{} is corrupt ({}). ".format(file, e)
+        if file.endswith("master.json"):
+            emsg += "Delete it and restart rsinc to rebuild it."
+        raise TypeError(emsg)
+    return d
+
+
+def write(file, d):
+    """Writes dict to json"""
+    with open(file, "w") as fp:
+        ujson.dump(d, fp, sort_keys=True, indent=2)
+
+
+def escape(string):
+    tmp = []
+    for char in string:
+        tmp.append(ESCAPE.get(char, char))
+    return "".join(tmp)
+
+
+def build_regexs(BASE_L, BASE_R, path_lcl, files):
+    lcl_regex = []
+    rmt_regex = []
+    plain = []
+
+    for file in files:
+        for f_char, p_char in zip(os.path.dirname(file), path_lcl):
+            if f_char != p_char:
+                break
+        else:
+            if os.path.exists(file):
+                with open(file, "r") as fp:
+                    for line in fp:
+                        if line.rstrip() == "":
+                            continue
+                        mid = os.path.dirname(file)
+                        mid = mid[len(BASE_L) + 1:]
+                        mid = os.path.join(escape(mid), line.rstrip())
+
+                        lcl = os.path.join(escape(BASE_L), mid)
+                        rmt = os.path.join(escape(BASE_R), mid)
+
+                        plain.append(mid)
+                        lcl_regex.append(re.compile(lcl))
+                        rmt_regex.append(re.compile(rmt))
+
+    return rmt_regex, lcl_regex, plain
+
+
+def fingerprint(nest, folder):
+    # Returns a digest of the packed last state of folder, None if it has none.
+    try:
+        branch = get_branch(nest, folder)
+    except KeyError:
+        return None
+
+    text = ujson.dumps(branch, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def remotes(config):
+    # Returns a config for each remote. Entries of REMOTES override the top
+    # level keys, the first defaults to its MASTER, TEMP_FILE and STAMPS.
+    out = []
+    for i, entry in enumerate(config.get("REMOTES", [{}])):
+        one = dict(config)
+        one.pop("REMOTES", None)
+
+        if i > 0:
+            stem = os.path.splitext(config["MASTER"])[0]
+            one["MASTER"] = "%s-%d.json" % (stem, i)
+            one["TEMP_FILE"] = "%s.%d" % (config["TEMP_FILE"], i)
+            one["STAMPS"] = "%s-%d.stamps.json" % (stem, i)
+
+        one.update(entry)
+        out.append(one)
+
+    return out
+
+
+def by_name(path, entries, regexs):
+    # Builds a Flat from a listing using each file's name as its uid, enough
+    # to plan everything but the files on both sides in recovery mode.
+    out = Flat(path)
+    for name, size, time in entries:
+        out.update(name, name, time, size=size)
+
+    out.tag_ignore(regexs)
+    return out
+
+
+def subset(flat, names):
+    # Returns a Flat of the files of flat in names.
+    out = Flat(flat.path)
+    for name in names:
+        if name in flat.names:
+            out.update(name, *flat.names[name].dump())
+
+    return out
+
+
+def overlap(a, b):
+    # True if folder a is b, inside b or contains b.
+    a, b = a.rstrip("/") + "/", b.rstrip("/") + "/"
+    return a.startswith(b) or b.startswith(a)
+
+
+def inside(a, b):
+    # True if folder a is inside folder b.
+    a, b = a.rstrip("/") + "/", b.rstrip("/") + "/"
+    return a != b and a.startswith(b)
+
+
+def covered(root, folders, children):
+    # True if everything in folder root is in one of folders. Only the
+    # directories between root and folders are looked in, with children.
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        names = children(path)
+        if names is None:
+            return False
+
+        for name in names:
+            full = os.path.join(path, name)
+            if any(full == f or inside(full, f) for f in folders):
+                continue
+            elif any(inside(f, full) for f in folders):
+                stack.append(full)
+            else:
+                return False  # Would list files that are not synced.
+
+    return True
+
+
+def roots(folders, children):
+    """
+    @brief      Works out which folders to list so that folders can share
+                listings.
+
+    @param      folders   List of folders (relative to BASE_L) to sync
+    @param      children  Function returning the set of the names of the
+                          files and directories in a folder, None if unknown
+
+    @return     Dict mapping each folder to list to the folders served from
+                its listing. That is the common ancestor of folders if
+                everything in it is synced, else each folder with others
+                inside it. A folder serving only itself is not shared.
+    """
+    folders = sorted(set(folders))
+    outer = [f for f in folders if not any(inside(f, g) for g in folders)]
+
+    if len(outer) > 1:
+        root = os.path.commonpath(outer)
+        if root != "" and covered(root, outer, children):
+            return {root: folders}
+
+    out = {}
+    for root in outer:
+        served = [f for f in folders if f == root or inside(f, root)]
+        if len(served) > 1:
+            out[root] = served
+
+    return out
+
+
+def rounds(folders):
+    # Splits folders into rounds of folders that do not overlap, to sync at
+    # once. A folder goes in the round after the last one holding a folder it
+    # overlaps, so overlapping folders are synced in the order given.
+    out = []
+    for folder in folders:
+        n = 0
+        for i, group in enumerate(out):
+            if any(overlap(folder, f) for f in group):
+                n = i + 1
+
+        if n == len(out):
+            out.append([])
+        out[n].append(folder)
+
+    return out
+
+
+class SyncSession:
+    # Loads the config and master once and keeps them, and what it learns
+    # while syncing, in memory so a long running program can sync often:
+    #
+    #   session = SyncSession("~/.rsinc/config.json")
+    #   plan = session.plan("Documents")
+    #   session.execute(plan)
+    #   session.commit()
+    #
+    # Between calls it keeps the last state of each folder as a Flat, the
+    # hashes of local files (reused while their size and modtime match) and
+    # the compiled .rignore regexs. A plan is a dict, see prepare().
+    #
+    # In quick mode (config QUICK) the hashes of both sides are kept and saved
+    # to the STAMPS file, so only new files and files whose size or modtime
+    # changed are hashed.
+    #
+    # In streaming mode (config STREAM) recovery plans are made from the file
+    # names alone, see stream_plan(), and execute() starts transferring while
+    # the files on both sides are still being hashed.
+    #
+    # With a memory limit (config MEMORY_LIMIT_MB) folders whose Flats would
+    # not fit are planned with DiskFlats, kept in temporary SQLite files.
+    #
+    # Remote folders starting with a prefix in config HASH_INDEX keep an index
+    # of their files' hashes in INDEX, see rsinc/index.py. It is used instead
+    # of quick mode's cache for them, only files changed since are hashed.
+    #
+    # With a budget (config TIME_BUDGET seconds from the start or MAX_BYTES
+    # copied) the backend refuses operations that do not fit, see Budget.
+    # The refused operations are saved like failed ones, so the next run
+    # carries on from the completed ones. A recovery cut short is resumed in
+    # recovery mode by the next run.
+    #
+    # Hosts sharing a remote can hold leases on the folders they sync (config
+    # LEASE_TTL seconds), see lease(). Overlapping folders are synced by one
+    # host at a time, others wait up to LEASE_WAIT seconds.
+    #
+    # With config METRICS_FILE the statistics of the process (see stats.py)
+    # are written there in the Prometheus text format after every commit.
+
+    def __init__(self, config, backend=None, flags=None):
+        if not isinstance(config, dict):
+            config = read(os.path.expanduser(config))
+
+        self.config = config
+        self.case = config["CASE_INSENSATIVE"]
+        self.hash_name = config["HASH_NAME"]
+        self.temp_file = config["TEMP_FILE"]
+        self.master = config["MASTER"]
+        self.base_r = config["BASE_R"]
+        self.base_l = config["BASE_L"]
+        self.fast_save = config["FAST_SAVE"]
+        self.quick = config.get("QUICK", False)
+        self.procs = config.get("PLAN_PROCS", 1)
+        self.streaming = config.get("STREAM", False)
+        self.memory = config.get("MEMORY_LIMIT_MB", 0)
+        self.indexed = tuple(config.get("HASH_INDEX", []))
+        self.lease_ttl = config.get("LEASE_TTL", 0)
+        self.lease_wait = config.get("LEASE_WAIT", 600)
+        self.metrics = config.get("METRICS_FILE")
+        self.stamps = config.get(
+            "STAMPS", os.path.join(os.path.dirname(self.master), "stamps.json")
+        )
+
+        if backend is None:
+            native = config.get("NATIVE_LOCAL", True)
+            fanout = config.get("FAN_OUT_LIST", [])
+            backend = Rclone(flags=flags, native=native, fanout=fanout)
+        self.raw = backend  # Not limited by the budget, for leases.
+        self.budget = None
+        seconds, max_bytes = config.get("TIME_BUDGET"), config.get("MAX_BYTES")
+        if seconds is not None or max_bytes is not None:
+            backend = self.budget = Budget(backend, seconds, max_bytes)
+
+        self.backend = backend
+        if self.indexed:
+            backend.hide(INDEX)
+
+        self.hashes = {}  # Local path -> (size, modtime, hash).
+        self.olds = {}  # Folder -> Flat of its last state.
+        self.regexs = {}  # Local path -> (rmt, lcl, plain) ignore regexs.
+        self.pending = []  # Executed plans waiting for commit().
+        self.failed = set()  # Failed full paths of the pending plans.
+        self.lock = threading.Lock()  # For live passes run at once.
+        self.resume = []  # Folders whose recovery a budget cut short.
+
+        self.load()
+        if self.quick:
+            self.load_stamps()
+        self.resume = self.unfinished()
+
+    def load(self, purge=False):
+        """
+        @brief      (Re)reads master, dropping any cached state.
+
+        @param      purge  Reset master to its empty state first
+
+        @return     None.
+        """
+        if purge:
+            print(ylw("Purging:"), self.master)
+        elif not os.path.exists(self.master):
+            print(ylw("WARN:"), self.master, "missing, first run")
+
+        if purge or not os.path.exists(self.master):
+            self.history, self.ignores, self.nest = History(), [], empty()
+            self.save_master()
+
+        master = read(self.master)
+        self.history = History(master["history"])
+        self.ignores = master["ignores"]
+        self.nest = master["nest"]
+
+        self.olds.clear()
+        self.regexs.clear()
+
+    def load_stamps(self):
+        # Reads the hash cache from STAMPS, ignoring it if made with another
+        # hash function.
+        if not os.path.exists(self.stamps):
+            return
+
+        stamps = read(self.stamps)
+        if stamps.get("hash") == self.hash_name:
+            self.hashes = stamps["stamps"]
+
+    def save_stamps(self):
+        # Writes the hash cache to STAMPS (quick mode only).
+        if self.quick:
+            write(self.stamps, {"hash": self.hash_name, "stamps": self.hashes})
+
+    def save_master(self):
+        # Writes history, ignores and nest to master.
+        write(
+            self.master,
+            {
+                "history": self.history.dump(),
+                "ignores": self.ignores,
+                "nest": self.nest,
+            },
+        )
+
+    def set_ignores(self, ignores):
+        # Replaces the list of .rignore files and saves it.
+        self.ignores = ignores
+        self.regexs.clear()
+        self.save_master()
+
+    def crashed(self):
+        # Returns the list of folders a crashed run left unsaved.
+        if not os.path.exists(self.temp_file):
+            return []
+
+        temp = read(self.temp_file)
+        return temp.get("folders", [temp["folder"]])
+
+    def unfinished(self):
+        # Returns the folders in crashed() whose recovery a budget cut short.
+        if not os.path.exists(self.temp_file):
+            return []
+
+        return read(self.temp_file).get("resume", [])
+
+    def spent(self):
+        # True if the budget, if any, is spent.
+        return self.budget is not None and self.budget.over()
+
+    def children(self, folder):
+        # Names of the files and directories in folder on either side, None
+        # if the backend can not list a single level.
+        names = set()
+        path_lcl = os.path.join(self.base_l, folder)
+        if os.path.isdir(path_lcl):
+            names.update(os.listdir(path_lcl))
+
+        path_rmt = os.path.join(self.base_r, folder)
+        try:
+            entries, _, dirs = self.backend.list_dirs(path_rmt, "", 1)
+        except NotImplementedError:
+            return None
+
+        names.update(os.path.basename(e[0]) for e in entries)
+        names.update(os.path.basename(d) for d in dirs)
+        return names
+
+    def roots(self, folders, local=True):
+        # Maps the full paths of the listings folders can share to the full
+        # paths listed from each, on the remote side and, if local, the local.
+        bases = [self.base_l, self.base_r] if local else [self.base_r]
+        out = {}
+        for root, served in roots(folders, self.children).items():
+            for base in bases:
+                out[os.path.join(base, root)] = [
+                    os.path.join(base, f) for f in served
+                ]
+
+        return out
+
+    def share(self, folders):
+        """
+        @brief      Lets the folders synced next share listings. A folder
+                    inside another is served from the outer folder's listing,
+                    and folders with a common ancestor from the ancestor's if
+                    all of it, on both sides, is in the folders. Files changed
+                    by the syncs are re-listed before a listing is used again
+                    and it is dropped once the last folder is listed.
+
+        @param      folders  List of folders (relative to BASE_L) to sync
+
+        @return     None.
+        """
+        self.backend.share(self.roots(folders))
+
+    def ignore(self, path_lcl):
+        # Returns the (cached) ignore regexs for path_lcl.
+        if path_lcl not in self.regexs:
+            self.regexs[path_lcl] = build_regexs(
+                self.base_l, self.base_r, path_lcl, self.ignores
+            )
+
+        return self.regexs[path_lcl]
+
+    def spill(self, files):
+        # Returns True if planning a folder of this many files (both sides)
+        # would go over the memory limit.
+        need = files * FILE_BYTES * FLAT_COPIES
+        return self.memory > 0 and need > self.memory * 2**20
+
+    def make_flat(self, path, files):
+        # Returns the empty Flat to fill with a listing of files files. A
+        # DiskFlat if planning with two sides this big would go over the
+        # memory limit, so big listings never become Files in memory.
+        if self.spill(2 * files):
+            from .disk import DiskFlat
+
+            return DiskFlat(path, self.cache_mb())
+
+        return Flat(path)
+
+    def cache_mb(self):
+        # SQLite page cache of each DiskFlat, a share of the memory limit.
+        return max(8, self.memory // (2 * FLAT_COPIES))
+
+    def last(self, folder, disk=False):
+        # Returns the (cached) Flat of the last state of folder, or a fresh
+        # DiskFlat of it if disk.
+        if disk:
+            from .disk import DiskFlat
+
+            old = DiskFlat(os.path.join(self.base_l, folder), self.cache_mb())
+            unpack(get_branch(self.nest, folder), old)
+            return old
+
+        if folder not in self.olds:
+            old = Flat(os.path.join(self.base_l, folder))
+            unpack(get_branch(self.nest, folder), old)
+            self.olds[folder] = old
+
+        return self.olds[folder]
+
+    def prepare(self, folder, recover=False):
+        """
+        @brief      Prints the status of folder and builds the plan used to
+                    sync it.
+
+        @param      folder   The folder (relative to BASE_L) to sync
+        @param      recover  Flag to force recovery mode
+
+        @return     Plan dict, filled in further by crawl and dry_pass.
+        """
+        path_lcl = os.path.join(self.base_l, folder)
+        path_rmt = os.path.join(self.base_r, folder)
+
+        # Determine if first run.
+        if path_lcl in self.history:
+            print(grn("Have:"), qt(folder) + ", entering sync & merge mode")
+        else:
+            print(ylw("Don't have:"), qt(folder), end="")
+            print(", entering first_sync mode")
+            recover = True
+
+        # Build relative regular expressions
+        rmt_regexs, lcl_regexs, plain = self.ignore(path_lcl)
+        print("Ignore:", plain)
+
+        if path_rmt.startswith(self.indexed):
+            # The index is never synced.
+            skip = re.compile(".*/" + re.escape(INDEX) + "$")
+            rmt_regexs, lcl_regexs = rmt_regexs + [skip], lcl_regexs + [skip]
+
+        if self.lease_ttl:
+            # Nor are the leases, if the root is synced.
+            rmt_regexs = rmt_regexs + [self.skip(self.base_r)]
+            lcl_regexs = lcl_regexs + [self.skip(self.base_l)]
+
+        return {
+            "folder": folder,
+            "path_lcl": path_lcl,
+            "path_rmt": path_rmt,
+            "recover": recover,
+            "lcl_regexs": lcl_regexs,
+            "rmt_regexs": rmt_regexs,
+        }
+
+    def skip(self, base):
+        # Regex of the paths in the LEASES folder of base, also as the paths
+        # of the root folder ".".
+        base = re.escape(os.path.join(base, ""))
+        return re.compile(base + r"(\./)?" + re.escape(LEASES) + "/")
+
+    def lease(self, folder):
+        """
+        @brief      Takes the lease on folder in the remote, see Lease. Hold it
+                    from before the folder is crawled until it is saved.
+
+        @param      folder  The folder (relative to BASE_L) to sync
+
+        @return     The Lease, to use as a context manager that releases it. A
+                    context that does nothing if LEASE_TTL is not set. None if
+                    another host held an overlapping lease for LEASE_WAIT
+                    seconds.
+        """
+        if not self.lease_ttl:
+            return nullcontext()
+
+        lease = Lease(self.raw, self.base_r, folder, self.lease_ttl)
+        return lease if lease.acquire(self.lease_wait) else None
+
+    def crawl(self, plan, lcl=None):
+        """
+        @brief      Scans both sides of a plan's folder and calculates file
+                    states. Does not print so can be run from several threads
+                    at once.
+
+        @param      plan  Plan dict from prepare
+        @param      lcl   Flat of lcl if already listed (it is changed)
+
+        @return     The plan, with Flats lcl, rmt and old added, disk if they
+                    are DiskFlats and, if indexed, the index of rmt.
+        """
+        rmt_cache = self.hashes if self.quick else None
+
+        if plan["path_rmt"].startswith(self.indexed):
+            with stats.phase("index"):
+                rmt_cache = read_index(
+                    self.backend, plan["path_rmt"], self.hash_name
+                )
+            plan.update(index=rmt_cache, index_read=dict(rmt_cache))
+
+        if "only" in plan:
+            lcl, rmt = self.list_only(plan, rmt_cache)
+        else:
+            make = self.make_flat
+            if lcl is None:
+                lcl = self.backend.lsl(
+                    plan["path_lcl"], self.hash_name, self.hashes, make=make
+                )
+            rmt = self.backend.lsl(
+                plan["path_rmt"], self.hash_name, rmt_cache, make=make
+            )
+
+        with stats.phase("ignore"):
+            lcl.tag_ignore(plan["lcl_regexs"])
+            rmt.tag_ignore(plan["rmt_regexs"])
+
+        # Sides over the limit were filled as DiskFlats while listing, a side
+        # still in memory is copied if the two together are too big.
+        in_memory = isinstance(lcl, Flat), isinstance(rmt, Flat)
+        disk = not all(in_memory) or self.spill(
+            len(lcl.names) + len(rmt.names)
+        )
+        if disk:
+            from .disk import DiskFlat
+
+            with stats.phase("spill"):
+                if in_memory[0]:
+                    lcl = DiskFlat.copy_of(lcl, self.cache_mb())
+                if in_memory[1]:
+                    rmt = DiskFlat.copy_of(rmt, self.cache_mb())
+
+        if plan["recover"]:
+            old = Flat(plan["path_lcl"])
+        else:
+            with stats.phase("calc_states"), stats.profile():
+                old = self.last(plan["folder"], disk)
+                if "only" in plan:
+                    old = subset(old, plan["only"])
+
+                calc_states(old, lcl)
+                calc_states(old, rmt)
+
+        plan.update(lcl=lcl, rmt=rmt, old=old, disk=disk)
+        return plan
+
+    def target(self, plan, names):
+        """
+        @brief      Limits a plan to some files of its folder. Only they, and
+                    the last names of files that moved to them, are listed,
+                    synced and saved.
+
+        @param      plan   Plan dict from prepare
+        @param      names  List of the names (relative to the folder) of the
+                           files to sync
+
+        @return     The plan, None if the plan is in recovery mode as there is
+                    no saved state of the folder to update.
+        """
+        if plan["recover"]:
+            print(red("ERROR:"), qt(plan["folder"]), end="")
+            print(" must be synced whole before syncing single files")
+            return None
+
+        plan.update(only=sorted(set(names)))
+        return plan
+
+    def list_only(self, plan, rmt_cache):
+        # Lists the files of a targeted plan on both sides, adding the last
+        # names of those whose uid was elsewhere so their moves are seen.
+        sides = [
+            (plan["path_lcl"], self.hashes),
+            (plan["path_rmt"], rmt_cache),
+        ]
+        names = plan["only"]
+        lcl, rmt = [
+            self.backend.lsl(path, self.hash_name, cache, names)
+            for path, cache in sides
+        ]
+
+        old = self.last(plan["folder"])
+        extra = set()
+        for flat in (lcl, rmt):
+            for file in flat.names.values():
+                prior = old.uids.get(file.uid)
+                if prior is not None and prior.name not in plan["only"]:
+                    extra.add(prior.name)
+
+        if extra:
+            extra = sorted(extra)
+            for flat, (path, cache) in zip((lcl, rmt), sides):
+                found = self.backend.lsl(path, self.hash_name, cache, extra)
+                for name, file in found.names.items():
+                    flat.update(name, *file.dump())
+
+            plan["only"] = sorted(set(plan["only"]).union(extra))
+
+        return lcl, rmt
+
+    def dry_pass(self, plan):
+        """
+        @brief      Runs the dry pass for a crawled plan, printing the
+                    operations.
+
+        @param      plan  Plan dict from crawl
+
+        @return     The plan, with total and new_dirs added.
+        """
+        # First run & recover mode.
+        if plan["recover"]:
+            print("Running", ylw("recover/first_sync"), "mode")
+        else:
+            print("Reading last state")
+
+        print(grn("Dry pass:"))
+        size = len(plan["lcl"].names) + len(plan["rmt"].names)
+
+        parallel = self.procs > 1 and size >= PARALLEL_MIN
+        if parallel and not plan.get("disk"):
+            with stats.phase("dry_pass"):
+                total, new_dirs, lcl, _, ops = sync_parallel(
+                    plan["lcl"],
+                    plan["rmt"],
+                    plan["old"],
+                    plan["recover"],
+                    case=self.case,
+                    procs=self.procs,
+                )
+
+            # The live pass replays the planned operations.
+            plan.update(replay=True, after=lcl)
+        else:
+            ops = []
+            with stats.phase("dry_pass"), stats.profile():
+                total, new_dirs, lcl, _ = sync(
+                    plan["lcl"],
+                    plan["rmt"],
+                    plan["old"],
+                    plan["recover"],
+                    dry_run=True,
+                    case=self.case,
+                    ops=ops,
+                )
+
+        print("Found:", total, "job(s)")
+        print("With:", len(new_dirs), "folder(s) to make")
+
+        plan.update(total=total, new_dirs=new_dirs, ops=ops, planned=lcl)
+        if plan.get("replay"):
+            plan.update(inputs=self.inputs(plan))
+        return plan
+
+    def relist(self, plan, names):
+        """
+        @brief      Re-lists some local files of a planned folder, after
+                    something else (another remote's live pass) changed them,
+                    and plans it again.
+
+        @param      plan   Plan dict from dry_pass
+        @param      names  Set of the names (relative to the folder) of the
+                           files to re-list
+
+        @return     The plan, with its lcl and operations replaced.
+        """
+        if "only" in plan:
+            names = names.intersection(plan["only"])
+
+        fresh = self.backend.lsl(
+            plan["path_lcl"], self.hash_name, self.hashes, sorted(names)
+        )
+
+        if plan.get("disk"):
+            from .disk import DiskFlat
+
+            lcl = DiskFlat(plan["path_lcl"], self.cache_mb())
+        else:
+            lcl = Flat(plan["path_lcl"])
+
+        def add(file):
+            lcl.update(file.name, file.uid, file.time, size=file.size)
+
+        # Start from the listed state, minus delete place holders.
+        for name, file in plan["lcl"].names.items():
+            if name not in names and file.state != DELETED:
+                add(file)
+
+        for file in fresh.names.values():
+            add(file)
+
+        lcl.tag_ignore(plan["lcl_regexs"])
+        if not plan["recover"]:
+            calc_states(plan["old"], lcl)
+
+        plan.pop("replay", None)
+        plan.update(lcl=lcl)
+        return self.dry_pass(plan)
+
+    def stream_plan(self, plan):
+        """
+        @brief      Plans a recovery without hashing. Every file on just one
+                    side is copied to the other whatever its hash so only
+                    names are listed. The files on both sides are compared
+                    by execute() as they are hashed.
+
+        @param      plan  Plan dict from prepare, in recovery mode
+
+        @return     The plan, with total and new_dirs of the known jobs.
+        """
+        print("Running", ylw("streaming recover/first_sync"), "mode")
+
+        with stats.phase("list"):
+            lcl_entries = self.backend.list(plan["path_lcl"])
+            rmt_entries = self.backend.list(plan["path_rmt"])
+
+        lcl = by_name(plan["path_lcl"], lcl_entries, plan["lcl_regexs"])
+        rmt = by_name(plan["path_rmt"], rmt_entries, plan["rmt_regexs"])
+        both = sorted(name for name in lcl.names if name in rmt.names)
+
+        # Files on both sides have the same uid so only the rest are synced.
+        print(grn("Dry pass:"))
+        ops = []
+        with stats.phase("dry_pass"):
+            total, new_dirs, _, _ = sync(
+                lcl, rmt, None, True, dry_run=True, case=self.case, ops=ops
+            )
+
+        # The jobs run while the files on both sides are hashed, so are not
+        # waited for.
+        while ops and ops[-1][0] == "wait":
+            ops.pop()
+
+        print("Found:", total, "job(s)")
+        print("With:", len(new_dirs), "folder(s) to make")
+        print("Comparing:", len(both), "file(s) on both sides while syncing")
+
+        plan.update(
+            lcl=lcl,
+            rmt=rmt,
+            old=Flat(plan["path_lcl"]),
+            stream=both,
+            total=total,
+            new_dirs=new_dirs,
+            ops=ops,
+        )
+        plan.update(inputs=self.inputs(plan))
+        return plan
+
+    def plan(self, folder, recover=False):
+        """
+        @brief      Works out how to sync folder without changing anything.
+
+        @param      folder   The folder (relative to BASE_L) to sync
+        @param      recover  Flag to force recovery mode
+
+        @return     Plan dict to pass to execute.
+        """
+        plan = self.prepare(folder, recover)
+        if self.streaming and plan["recover"]:
+            return self.stream_plan(plan)
+
+        return self.dry_pass(self.crawl(plan))
+
+    def execute(self, plan):
+        """
+        @brief      Runs the live pass of a plan. Its new state is saved by the
+                    next commit(), until then a crash is recovered from.
+
+        @param      plan  Plan dict from plan
+
+        @return     None.
+        """
+        total = plan["total"]
+
+        if total == 0 and not plan["recover"]:
+            if "index" in plan:
+                self.save_index(plan)
+            return
+
+        print(grn("Live pass:"))
+
+        with self.lock:
+            self.pending.append(plan)
+            folders = list(self.resume)
+            for p in self.pending:
+                if p["folder"] not in folders:
+                    folders.append(p["folder"])
+            write(self.temp_file, {"folder": folders[0], "folders": folders})
+
+        with stats.phase("mkdirs"):
+            make_dirs(plan["new_dirs"], self.backend)
+
+        if "stream" in plan:
+            with stats.phase("live_pass"):
+                self.stream(plan)
+
+            self.finish(plan)
+            return
+
+        if plan.get("replay"):
+            # Loaded from a plan file or planned in parallel.
+            with stats.phase("live_pass"):
+                self.replay(plan)
+
+            self.finish(plan)
+            return
+
+        ops = []
+        with stats.phase("live_pass"):
+            _, _, lcl, _ = sync(
+                plan["lcl"],
+                plan["rmt"],
+                plan["old"],
+                plan["recover"],
+                total=total,
+                case=self.case,
+                dry_run=False,
+                backend=self.backend,
+                ops=ops,
+            )
+
+        plan.update(after=lcl, ops=ops)
+        self.finish(plan)
+
+    def finish(self, plan):
+        # Adds the full paths of the failed operations of a plan's live pass,
+        # and cut if the budget refused any of them. Live passes may run at
+        # once, so the failures taken from the backend are kept until commit.
+        with self.lock:
+            self.failed |= self.backend.failures()
+            failed = set(self.failed)
+        refused = set() if self.budget is None else set(self.budget.refused)
+
+        cut = False
+        for kind, src, dst in plan["ops"]:
+            if kind == "wait":
+                continue
+            elif src in refused or dst in refused:
+                stats.result(kind, "refused")
+                cut = True
+            elif src in failed or dst in failed:
+                stats.result(kind, "failed")
+            else:
+                stats.result(kind, "ok")
+
+        plan.update(failed=failed, cut=cut)
+
+    def stream(self, plan):
+        # Runs the jobs of a plan from stream_plan while the files on both
+        # sides are hashed in batches (in a thread), then copies the newest
+        # version of those that differ as each batch is done.
+        from concurrent.futures import ThreadPoolExecutor
+
+        track = Struct()
+        track.lcl = plan["path_lcl"]
+        track.rmt = plan["path_rmt"]
+        track.total = track.count = plan["total"]
+        track.dry = False
+        track.case = self.case
+        track.backend = self.backend
+        track.ops = plan["ops"]
+
+        rmt_cache = self.hashes if self.quick else None
+        both = plan["stream"]
+        after = Flat(plan["path_lcl"])
+
+        def hash_batch(names):
+            lcl = self.backend.lsl(
+                plan["path_lcl"], self.hash_name, self.hashes, names
+            )
+            rmt = self.backend.lsl(
+                plan["path_rmt"], self.hash_name, rmt_cache, names
+            )
+            lcl.tag_ignore(plan["lcl_regexs"])
+            rmt.tag_ignore(plan["rmt_regexs"])
+            return names, lcl, rmt
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            batches = [
+                executor.submit(hash_batch, both[i:i + STREAM_BATCH])
+                for i in range(0, len(both), STREAM_BATCH)
+            ]
+            self.replay(plan, finish=False)
+
+            for batch in batches:
+                names, lcl, rmt = batch.result()
+                for name in names:
+                    if name not in lcl.names or name not in rmt.names:
+                        continue
+
+                    f_lcl, f_rmt = lcl.names[name], rmt.names[name]
+                    after.update(name, f_lcl.uid, f_lcl.time, size=f_lcl.size)
+                    if f_lcl.uid == f_rmt.uid:
+                        continue
+
+                    # Same choice as match_states in recovery mode.
+                    if not f_lcl.ignore:
+                        newer = f_lcl.time > f_rmt.time
+                    elif not f_rmt.ignore:
+                        newer = not f_rmt.time > f_lcl.time
+                    else:
+                        continue
+
+                    track.total += 1
+                    if newer:
+                        telemetry.plan(f_lcl.size)
+                        push(track, name, name, lcl, rmt)
+                    else:
+                        telemetry.plan(f_rmt.size)
+                        pull(track, name, name, lcl, rmt)
+
+        self.backend.wait()
+        plan.update(total=track.count, after=after)
+
+    def commit(self):
+        """
+        @brief      Saves the state of every executed plan into history and
+                    nest then writes master.
+
+        @return     None.
+        """
+        if len(self.pending) == 0:
+            return
+
+        with stats.phase("save"):
+            for plan in self.pending:
+                self._save(plan)
+
+            self.save_master()
+            self.save_stamps()
+
+            if self.resume:
+                # Leaves the cut recoveries to be resumed by the next run.
+                folders = self.resume
+                temp = {"folder": folders[0], "folders": folders}
+                write(self.temp_file, dict(temp, resume=folders))
+            else:
+                os.remove(self.temp_file)
+
+        self.pending = []
+        self.failed = set()
+        if self.budget is not None:
+            self.budget.forget()
+        if self.metrics:
+            stats.write_prometheus(self.metrics)
+
+    def _save(self, plan):
+        # Merges the state of a plan's folder after its live pass into nest.
+        folder = plan["folder"]
+        now = self.settle(plan)
+
+        if plan["cut"]:
+            print(ylw("Budget spent:"), "the rest is left for the next run")
+            if plan["recover"] and folder not in self.resume:
+                self.resume.append(folder)
+        elif plan["recover"] and folder in self.resume:
+            self.resume.remove(folder)
+
+        now.rm_ignore()
+
+        # Merge into history.
+        self.history.add(plan["path_lcl"])
+        self.history.update(d for d in now.dirs)
+
+        # Merge into nest, just the targeted files if any.
+        if "only" in plan:
+            branch = get_branch(self.nest, folder)
+            for name in plan["only"]:
+                drop(branch, name)
+            for name, file in now.names.items():
+                insert(branch, name.split("/") + [file.uid])
+        else:
+            merge(self.nest, folder, pack(now))
+
+        for f in tuple(self.olds):
+            if overlap(f, folder):
+                del self.olds[f]
+
+        if "index" in plan:
+            self.save_index(plan)
+
+        log.debug("Saved %s", folder)
+
+    def settle(self, plan):
+        # Returns the state of a plan's folder right after its live pass,
+        # working it out the first time. FanOut settles each plan before the
+        # next remote's pass changes lcl.
+        if "now" in plan:
+            return plan["now"]
+
+        if plan["total"] == 0:
+            print("Skipping crawl as no jobs")
+            now = plan["after"]
+        elif self.fast_save and "stream" not in plan and not plan["cut"]:
+            # Streamed plans never knew the hashes of the copied files.
+            print("Skipping crawl as FAST_SAVE")
+            now = plan["after"]
+        else:
+            now = self.verify(plan)
+
+        plan.update(now=now)
+        return now
+
+    def save_index(self, plan):
+        # Writes the index of a plan's remote folder if it changed, the remote
+        # is re-listed (not hashed) if any operations ran.
+        index = plan["index"]
+        if any(kind != "wait" for kind, _, _ in plan["ops"]):
+            entries = self.backend.list(plan["path_rmt"])
+            index = updated(
+                index,
+                plan["ops"],
+                plan["failed"],
+                plan["lcl"],
+                plan["path_rmt"],
+                entries,
+            )
+        elif index == plan["index_read"]:
+            return
+
+        write_index(self.backend, plan["path_rmt"], self.hash_name, index)
+
+    def verify(self, plan):
+        """
+        @brief      Works out the state of lcl after a plan's live pass by
+                    re-listing only the files its operations touched. Files
+                    used by a failed operation keep their last state so the
+                    next sync retries them.
+
+        @param      plan  Plan dict from execute
+
+        @return     Flat of lcl after the live pass.
+        """
+        touched = set()
+        failed = set()
+
+        for _, src, dst in plan["ops"]:
+            bad = src in plan["failed"] or dst in plan["failed"]
+            for full in (src, dst):
+                name = self.relative(plan, full)
+                if name is not None:
+                    touched.add(name)
+                    if bad:
+                        failed.add(name)
+
+        print("Re-listing", len(touched), "file(s)")
+        if failed and plan["cut"]:
+            print(len(failed), "file(s) left for the next run or failed")
+        elif failed:
+            print(ylw("WARN:"), len(failed), "file(s) failed to sync")
+            log.warning("Failed to sync: %s", sorted(failed))
+
+        fresh = self.backend.lsl(
+            plan["path_lcl"], self.hash_name, self.hashes, sorted(touched)
+        )
+
+        if plan.get("disk"):
+            from .disk import DiskFlat
+
+            now = DiskFlat(plan["path_lcl"], self.cache_mb())
+        else:
+            now = Flat(plan["path_lcl"])
+
+        def add(file):
+            now.update(file.name, file.uid, file.time, size=file.size)
+
+        # Start from the planned state, minus delete place holders.
+        for name, file in plan["after"].names.items():
+            if name not in touched and file.state != DELETED:
+                add(file)
+
+        for name, file in fresh.names.items():
+            if name not in failed:
+                add(file)
+
+        old = plan["old"]
+        for name in sorted(failed):
+            if name in old.names:
+                add(old.names[name])
+
+        now.tag_ignore(plan["lcl_regexs"])
+        return now
+
+    def relative(self, plan, full):
+        # Returns the name of full path in a plan's folder, None if outside.
+        for base in (plan["path_lcl"], plan["path_rmt"]):
+            prefix = os.path.join(base, "")
+            if full is not None and full.startswith(prefix):
+                return full[len(prefix):]
+
+        return None
+
+    def changed(self, plan):
+        # Returns the names of the local files a plan's live pass used.
+        prefix = os.path.join(plan["path_lcl"], "")
+        names = set()
+        for kind, src, dst in plan["ops"]:
+            for full in (src, dst):
+                if kind != "wait" and full and full.startswith(prefix):
+                    names.add(full[len(prefix):])
+
+        return names
+
+    def export(self, plans, file):
+        """
+        @brief      Writes planned syncs to a plan file for apply().
+
+        @param      plans  List of plan dicts from dry_pass
+        @param      file   Path of the plan file to write
+
+        @return     None.
+        """
+        out = []
+        for plan in plans:
+            # Change to the saved state the plan expects to make.
+            old = {n: f.uid for n, f in plan["old"].names.items()}
+            new = {
+                n: f.uid
+                for n, f in plan["planned"].names.items()
+                if f.state != DELETED and not f.ignore
+            }
+
+            out.append(
+                {
+                    "folder": plan["folder"],
+                    "recover": plan["recover"],
+                    "total": plan["total"],
+                    "new_dirs": sorted(plan["new_dirs"]),
+                    "ops": plan["ops"],
+                    "inputs": self.inputs(plan),
+                    "nest": fingerprint(self.nest, plan["folder"]),
+                    "set": {n: u for n, u in new.items() if old.get(n) != u},
+                    "drop": sorted(n for n in old if n not in new),
+                }
+            )
+
+        write(file, {"hash": self.hash_name, "plans": out})
+
+    def inputs(self, plan):
+        # Returns the state of every path the operations of a crawled plan
+        # use, as the plan saw it: full path -> [size, uid] or None.
+        lcl = os.path.join(plan["path_lcl"], "")
+
+        inputs = {}
+        for _, src, dst in plan["ops"]:
+            for full in (src, dst):
+                if full is None:
+                    continue
+
+                flat = plan["lcl"] if full.startswith(lcl) else plan["rmt"]
+                f = flat.names.get(self.relative(plan, full))
+                if f is None or f.state == DELETED:
+                    inputs[full] = None
+                else:
+                    inputs[full] = [f.size, f.uid]
+
+        return inputs
+
+    def apply(self, file, folders=None):
+        """
+        @brief      Reads a plan file and checks each plan is still valid: the
+                    folder's saved state must not have changed and the files
+                    its operations use must be as they were, only those files
+                    are re-listed.
+
+        @param      file     Path of the plan file from export
+        @param      folders  List of the folders whose plans to check, None
+                             for all
+
+        @return     List of the valid plans, to pass to execute.
+        """
+        data = read(file)
+        if data["hash"] != self.hash_name:
+            print(red("ERROR:"), file, "was made with", data["hash"])
+            return []
+
+        plans = []
+        for saved in data["plans"]:
+            folder = saved["folder"]
+            if folders is not None and folder not in folders:
+                continue
+
+            print("")
+            plan = self.prepare(folder, saved["recover"])
+
+            if saved["nest"] != fingerprint(self.nest, folder):
+                print(red("Stale:"), qt(folder), "has been synced since")
+                continue
+
+            changed = self.stale(plan, saved["inputs"])
+            if changed:
+                print(red("Stale:"), qt(folder), end="")
+                print(",", len(changed), "file(s) have changed")
+                for full in changed[:10]:
+                    print("   ", full)
+                continue
+
+            # The state to save, the last state with the planned changes.
+            if plan["recover"]:
+                old = Flat(plan["path_lcl"])
+            else:
+                old = self.last(folder)
+
+            drop = set(saved["drop"])
+            after = Flat(plan["path_lcl"])
+            for name, f in old.names.items():
+                if name not in drop:
+                    after.update(name, f.uid, f.time)
+            for name, uid in saved["set"].items():
+                after.update(name, uid)
+
+            plan.update(
+                old=old,
+                after=after,
+                total=saved["total"],
+                new_dirs=saved["new_dirs"],
+                ops=[tuple(op) for op in saved["ops"]],
+                inputs=saved["inputs"],
+                replay=True,
+            )
+            print("Found:", plan["total"], "job(s)")
+            plans.append(plan)
+
+        return plans
+
+    def stale(self, plan, inputs):
+        # Returns the paths in inputs that no longer match the listing.
+        names = {plan["path_lcl"]: [], plan["path_rmt"]: []}
+        for full in inputs:
+            for base in names:
+                if full.startswith(os.path.join(base, "")):
+                    names[base].append(self.relative(plan, full))
+
+        now = {}
+        for base, some in names.items():
+            if len(some) == 0:
+                continue
+
+            cache = None
+            if self.quick or base == plan["path_lcl"]:
+                cache = self.hashes
+
+            flat = self.backend.lsl(base, self.hash_name, cache, some)
+            for name, f in flat.names.items():
+                now[os.path.join(base, name)] = [f.size, f.uid]
+
+        return sorted(f for f, was in inputs.items() if now.get(f) != was)
+
+    def replay(self, plan, finish=True):
+        # Runs the recorded operations of a plan, waiting for them to finish
+        # if finish is set.
+        count = 0
+        for kind, src, dst in plan["ops"]:
+            if kind == "wait":
+                self.backend.wait()
+                continue
+
+            count += 1
+            info = kind.capitalize() + ": " + src
+            if dst is not None:
+                info += " to: " + dst
+
+            print("%d/%d" % (count, plan["total"]), info)
+            log.info("%s %s TO %s", kind.upper(), src, dst)
+
+            if kind == "copy":
+                size = (plan["inputs"].get(src) or [0])[0]
+                self.backend.copy(src, dst, size)
+            elif kind == "move":
+                self.backend.move(src, dst)
+            elif kind == "delete":
+                self.backend.delete(src)
+
+        if finish:
+            self.backend.wait()
+
+    def prune(self, plan):
+        # Removes empty directories from both sides of a plan's folder.
+        self.backend.rmdirs(plan["path_rmt"])
+        self.backend.rmdirs(plan["path_lcl"])
+
+
+class FanOut:
+    # Syncs the same local folders to several remotes (config REMOTES), with
+    # a SyncSession for each remote sharing one backend. The local side of a
+    # folder is listed once and each file is read once for all the remotes'
+    # hashes.
+
+    def __init__(self, config, backend=None, flags=None):
+        if backend is None:
+            native = config.get("NATIVE_LOCAL", True)
+            fanout = [
+                prefix
+                for one in remotes(config)
+                for prefix in one.get("FAN_OUT_LIST", [])
+            ]
+            backend = Rclone(flags=flags, native=native, fanout=fanout)
+        self.backend = backend
+        self.sessions = [
+            SyncSession(one, self.backend) for one in remotes(config)
+        ]
+
+    def load(self, purge=False):
+        # See SyncSession.load, every remote's master is (re)read.
+        for session in self.sessions:
+            session.load(purge)
+
+    def crashed(self):
+        # Returns the folders a crashed run left unsaved on any remote.
+        folders = []
+        for session in self.sessions:
+            folders += [f for f in session.crashed() if f not in folders]
+
+        return folders
+
+    def unfinished(self):
+        # Returns the folders any remote's budget cut short, see crashed().
+        folders = []
+        for session in self.sessions:
+            folders += [f for f in session.unfinished() if f not in folders]
+
+        return folders
+
+    def spent(self):
+        return any(session.spent() for session in self.sessions)
+
+    def set_ignores(self, ignores):
+        for session in self.sessions:
+            session.set_ignores(ignores)
+
+    def save_stamps(self):
+        for session in self.sessions:
+            session.save_stamps()
+
+    def share(self, folders):
+        # See SyncSession.share. Local is listed once per folder already, so
+        # only each remote's listings are shared.
+        shared = {}
+        for session in self.sessions:
+            shared.update(session.roots(folders, local=False))
+
+        self.backend.share(shared)
+
+    def lease(self, folder):
+        # Takes the lease on folder in every remote, see SyncSession.lease.
+        # Returns None, holding none, if any is taken.
+        held = ExitStack()
+        for session in self.sessions:
+            lease = session.lease(folder)
+            if lease is None:
+                held.close()
+                return None
+            held.enter_context(lease)
+
+        return held
+
+    def prepare(self, folder, recover=False):
+        # Returns a list of plans for folder, one per session.
+        plans = []
+        for session in self.sessions:
+            print(grn("Remote:"), session.base_r)
+            plans.append(session.prepare(folder, recover))
+
+        return plans
+
+    def crawl(self, plans):
+        # Lists the local side of plans once then crawls each remote.
+        path_lcl = plans[0]["path_lcl"]
+        caches = {s.hash_name: s.hashes for s in self.sessions}
+        lcls = self.backend.lsl_many(path_lcl, caches, caches)
+
+        used = set()
+        for session, plan in zip(self.sessions, plans):
+            lcl = lcls[session.hash_name]
+            if session.hash_name in used:
+                lcl = deepcopy(lcl)
+            used.add(session.hash_name)
+
+            session.crawl(plan, lcl)
+
+        return plans
+
+    def dry_pass(self, plans):
+        for session, plan in zip(self.sessions, plans):
+            print("")
+            print(grn("Plan:"), qt(plan["folder"]), "to", session.base_r)
+            session.dry_pass(plan)
+
+        return plans
+
+    def plan(self, folder, recover=False):
+        """
+        @brief      Works out how to sync folder with every remote.
+
+        @param      folder   The folder (relative to BASE_L) to sync
+        @param      recover  Flag to force recovery mode
+
+        @return     List of plan dicts, one per session.
+        """
+        return self.dry_pass(self.crawl(self.prepare(folder, recover)))
+
+    def execute(self, plans):
+        # Runs the live passes of plans, from plan. Each plan was made from
+        # the local listing before any pass ran, so the local files changed
+        # by earlier passes are re-listed and the plan made again first. A
+        # file changed on two remotes is then a conflict, rather than the
+        # second remote's version overwriting the first's.
+        changed = set()
+        for session, plan in zip(self.sessions, plans):
+            print(grn("Remote:"), session.base_r)
+            if changed:
+                print(ylw("Re-planning:"), len(changed), end="")
+                print(" local file(s) changed by earlier remotes")
+                session.relist(plan, changed)
+
+            session.execute(plan)
+            if any(p is plan for p in session.pending):
+                session.settle(plan)
+            changed |= session.changed(plan)
+
+    def commit(self):
+        for session in self.sessions:
+            session.commit()
+
+    def prune(self, plans):
+        for session, plan in zip(self.sessions, plans):
+            session.prune(plan)
+
+
+ESCAPE = {
+    "\\": "\\\\",
+    ".": "\\.",
+    "^": "\\^",
+    "$": "\\$",
+    "*": "\\*",
+    "+": "\\+",
+    "?": "\\?",
+    "|": "\\|",
+    "(": "\\(",
+    ")": "\\)",
+    "{": "\\{",
+    "}": "\\}",
+    "[": "\\[",
+    "]": "\\]",
+}
@@ -0,0 +1,390 @@
+# Provides instrumentation: phase timers, operation latencies and counters
+
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import ujson
+
+# Upper bounds (seconds) of the operation latency histogram buckets.
+BUCKETS = (0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, float("inf"))
+
+# Help text of the counters exported by prometheus(), which always exports
+# these even if they are zero.
+HELP = {
+    "files_listed": "Files listed on either side.",
+    "bytes_hashed": "Bytes of files read to hash them.",
+    "bytes_transferred": "Bytes copied by finished transfers.",
+    "conflicts": "Files changed on both sides, kept as two copies.",
+    "rclone_errors": "Errors rclone hit and retried during transfers.",
+    "rclone_procs": "rclone processes started.",
+}
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.ops = {}
+        self.counts = {}
+        self.results = {}
+        self.profiles = []
+        self.profiling = False
+        self.profiler_busy = False
+
+    @contextmanager
+    def phase(self, name):
+        # Times the wall and cpu (of this thread) time spent in a with block.
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            with self.lock:
+                tot = self.phases.setdefault(name, [0.0, 0.0, 0])
+                tot[0] += wall
+                tot[1] += cpu
+                tot[2] += 1
+
+    def op(self, kind, seconds):
+        # Records the latency of one operation, i.e. an rclone copyto.
+        with self.lock:
+            hist = self.ops.setdefault(kind, [0, 0.0, [0] * len(BUCKETS)])
+            hist[0] += 1
+            hist[1] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    hist[2][i] += 1
+                    break
+
+    def count(self, name, n=1):
+        # Increments a counter, i.e. rclone processes spawned.
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def result(self, kind, outcome):
+        # Counts a sync operation, i.e. a copy, by how it ended.
+        with self.lock:
+            key = (kind, outcome)
+            self.results[key] = self.results.get(key, 0) + 1
+
+    @contextmanager
+    def profile(self):
+        # Runs cProfile over a with block if profiling is on. Only one thread
+        # is profiled at a time as profilers can not overlap.
+        with self.lock:
+            run = self.profiling and not self.profiler_busy
+            if run:
+                self.profiler_busy = True
+
+        if not run:
+            yield
+            return
+
+        import cProfile
+
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            with self.lock:
+                self.profiles.append(prof)
+                self.profiler_busy = False
+
+    def dump_profile(self, file):
+        # Writes the merged cProfile data, readable with pstats/snakeviz.
+        if len(self.profiles) == 0:
+            return
+
+        import pstats
+
+        merged = pstats.Stats(self.profiles[0])
+        for prof in self.profiles[1:]:
+            merged.add(prof)
+        merged.dump_stats(file)
+
+    def report(self):
+        # Returns all the statistics as a json serialisable dict.
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        return {
+            "wall": time.perf_counter() - self.start,
+            "cpu": own.ru_utime + own.ru_stime,
+            "children_cpu": kids.ru_utime + kids.ru_stime,
+            "peak_rss_kb": own.ru_maxrss,
+            "children_peak_rss_kb": kids.ru_maxrss,
+            "phases": {
+                k: {"wall": v[0], "cpu": v[1], "calls": v[2]}
+                for k, v in self.phases.items()
+            },
+            "ops": {
+                k: {
+                    "count": v[0],
+                    "sum": v[1],
+                    "buckets": dict(zip(map(str, BUCKETS), v[2])),
+                }
+                for k, v in self.ops.items()
+            },
+            "counts": dict(self.counts),
+            "results": {
+                "%s_%s" % key: n for key, n in self.results.items()
+            },
+        }
+
+    def write(self, file):
+        with open(file, "w") as fp:
+            ujson.dump(self.report(), fp, sort_keys=True, indent=2)
+
+    def prometheus(self):
+        # Returns the report in the Prometheus text format. Totals are since
+        # the start of the process, so a long running program's only grow.
+        rep = self.report()
+        phases = [(label(phase=k), p) for k, p in rep["phases"].items()]
+        lines = []
+
+        def metric(name, kind, text, samples):
+            name = "rsinc_" + name
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append("%s%s%s %r" % (name, suffix, labels, value))
+
+        metric(
+            "last_update_timestamp_seconds",
+            "gauge",
+            "When these metrics were written.",
+            [("", "", time.time())],
+        )
+        metric(
+            "run_seconds",
+            "gauge",
+            "Wall time since the start.",
+            [("", "", rep["wall"])],
+        )
+        metric(
+            "cpu_seconds_total",
+            "counter",
+            "CPU time used by rsinc and by its subprocesses.",
+            [
+                ("", label(process="rsinc"), rep["cpu"]),
+                ("", label(process="children"), rep["children_cpu"]),
+            ],
+        )
+        metric(
+            "peak_rss_bytes",
+            "gauge",
+            "Peak resident memory of rsinc.",
+            [("", "", rep["peak_rss_kb"] * 1024)],
+        )
+        metric(
+            "phase_seconds_total",
+            "counter",
+            "Wall time spent in each phase.",
+            [("", labels, p["wall"]) for labels, p in phases],
+        )
+        metric(
+            "phase_calls_total",
+            "counter",
+            "Times each phase ran.",
+            [("", labels, p["calls"]) for labels, p in phases],
+        )
+        metric(
+            "ops_total",
+            "counter",
+            "Operations of the live passes by kind and outcome.",
+            [
+                ("", label(kind=kind, outcome=outcome), n)
+                for (kind, outcome), n in sorted(self.results.items())
+            ],
+        )
+
+        samples = []
+        for op, o in rep["ops"].items():
+            total = 0
+            for bound, n in zip(BUCKETS, o["buckets"].values()):
+                total += n
+                le = "+Inf" if bound == float("inf") else str(bound)
+                samples.append(("_bucket", label(op=op, le=le), total))
+            samples.append(("_sum", label(op=op), o["sum"]))
+            samples.append(("_count", label(op=op), o["count"]))
+        metric(
+            "rclone_op_seconds",
+            "histogram",
+            "Latency of the rclone commands run.",
+            samples,
+        )
+
+        for name in sorted(set(HELP).union(rep["counts"])):
+            text = HELP.get(name, name.replace("_", " ").capitalize() + ".")
+            n = rep["counts"].get(name, 0)
+            metric(name + "_total", "counter", text, [("", "", n)])
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file):
+        # Writes prometheus() to file in one step, as the textfile collector
+        # of node_exporter can read it at any time.
+        temp = "%s.%d.tmp" % (file, os.getpid())
+        with open(temp, "w") as fp:
+            fp.write(self.prometheus())
+        os.replace(temp, file)
+
+    def show(self):
+        # Prints the report as a table.
+        rep = self.report()
+
+        print("Run: %.2fs wall, %.2fs cpu" % (rep["wall"], rep["cpu"]), end="")
+        print(", %.2fs cpu in subprocesses" % rep["children_cpu"])
+        print(
+            "Peak RSS: %d KiB (subprocesses %d KiB)"
+            % (rep["peak_rss_kb"], rep["children_peak_rss_kb"])
+        )
+
+        head = ("Phase", "Wall (s)", "CPU (s)", "Calls")
+        print("%-14s %10s %10s %7s" % head)
+        for name, p in rep["phases"].items():
+            print(
+                "%-14s %10.3f %10.3f %7d"
+                % (name, p["wall"], p["cpu"], p["calls"])
+            )
+
+        for kind, o in rep["ops"].items():
+            mean = o["sum"] / o["count"]
+            hist = " ".join(
+                "<=%s:%d" % (b, n) for b, n in o["buckets"].items() if n
+            )
+            print("Op %s: %d, mean %.3fs, %s" % (kind, o["count"], mean, hist))
+
+        for name, n in rep["counts"].items():
+            print("%s: %d" % (name, n))
+
+
+def label(**labels):
+    # Formats Prometheus labels i.e. label(op="copyto") -> '{op="copyto"}'.
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append('%s="%s"' % (key, value.replace("\n", "\\n")))
+
+    return "{%s}" % ",".join(pairs)
+
+
+def human(n):
+    # Formats a number of bytes i.e. 1536 -> "1.5 KiB".
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(n) < 1024 or unit == "TiB":
+            break
+        n /= 1024
+
+    return ("%d %s" if unit == "B" else "%.1f %s") % (n, unit)
+
+
+class Telemetry:
+    # Aggregates the bytes moved by transfers across all workers. Dry passes
+    # add planned bytes, live transfers report progress (from rclone's json
+    # stats) while running and their final size when they end.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.planned = 0
+        self.done = 0
+        self.transfers = 0
+        self.running = {}
+        self.start = None
+        self.busy = 0.0
+
+    def plan(self, size):
+        with self.lock:
+            self.planned += size
+
+    def begin(self, key):
+        with self.lock:
+            if self.start is None:
+                self.start = time.perf_counter()
+            self.running[key] = [0, 0.0, time.perf_counter()]
+
+    def update(self, key, done, speed):
+        with self.lock:
+            if key in self.running:
+                self.running[key][:2] = [done, speed]
+
+    def end(self, key, size, ok):
+        with self.lock:
+            done, _, start = self.running.pop(key, [0, 0.0, None])
+            n = size if ok else done
+            self.done += n
+            self.transfers += 1
+            if start is not None:
+                self.busy += time.perf_counter() - start
+
+        stats.count("bytes_transferred", n)
+
+    def transferred(self):
+        return self.done + sum(r[0] for r in self.running.values())
+
+    def average(self):
+        # Average throughput (bytes/s) since the first transfer started.
+        if self.start is None:
+            return 0.0
+
+        return self.transferred() / max(time.perf_counter() - self.start, 1e-9)
+
+    def speed(self):
+        # Current throughput (bytes/s), the sum over running transfers.
+        return sum(r[1] for r in self.running.values())
+
+    def eta(self):
+        # Seconds left at the average speed, None if unknown.
+        avg = self.average()
+        if avg <= 0:
+            return None
+
+        return max(self.planned - self.transferred(), 0) / avg
+
+    def progress(self):
+        # Short progress string for the per-operation output.
+        with self.lock:
+            eta = self.eta()
+            text = "%s/%s %s/s" % (
+                human(self.transferred()),
+                human(self.planned),
+                human(self.speed() or self.average()),
+            )
+
+        if eta is not None:
+            h, m, s = eta // 3600, eta // 60 % 60, eta % 60
+            text += " ETA %d:%02d:%02d" % (h, m, s)
+
+        return "[%s]" % text
+
+    def summary(self):
+        # Final throughput summary.
+        with self.lock:
+            total = self.transferred()
+            wall = 0
+            if self.start is not None:
+                wall = time.perf_counter() - self.start
+            mean = self.busy / self.transfers if self.transfers else 0
+
+            return (
+                "Transferred %s in %d file(s), %.1fs: %s/s average, "
+                "%.2fs per file"
+                % (
+                    human(total),
+                    self.transfers,
+                    wall,
+                    human(total / wall if wall else 0),
+                    mean,
+                )
+            )
+
+
+stats = Stats()  # global used to record the statistics of this run.
+telemetry = Telemetry()  # global tracking the throughput of transfers.
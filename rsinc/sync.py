@@ -1,12 +1,18 @@
+import contextlib
+import io
+import os
+import sys
 from copy import deepcopy
 
-from .classes import SubPool, THESAME, UPDATED, DELETED, CREATED
+from .classes import Flat, Struct, THESAME, UPDATED, DELETED, CREATED
 from .classes import NOMOVE, MOVED, CLONE, NOTHERE
-from .rclone import safe_push, safe_move, move, resolve_case, track
+from .rclone import safe_push, safe_move, move, resolve_case, wait
 from .rclone import null, delL, delR, push, pull, conflict
 from .colors import red
+from .stats import telemetry
+
+PARALLEL_MIN = 20000  # Files in a folder before planning in parallel pays.
 
-NUMBER_OF_WORKERS = 7
 # Encodes logic for match states function.
 LOGIC = [
     [null, pull, delL, conflict],
@@ -24,43 +30,210 @@ def sync(
     dry_run=True,
     total=0,
     case=True,
-    flags=None,
+    backend=None,
+    ops=None,
 ):
-    global track
+    """
+    @brief      Plans (dry run) or performs a two-way sync of lcl and rmt.
 
+    @param      lcl      Flat of the lcl directory
+    @param      rmt      Flat of the rmt directory
+    @param      old      Flat of the past state of lcl and rmt
+    @param      recover  Flag to use recovery logic
+    @param      dry_run  Flag to only print (and count) the operations
+    @param      total    Number of operations, from the dry run
+    @param      case     Flag to do case insensitive name checking
+    @param      backend  Backend performing the operations, needed if live
+    @param      ops      List to append the operations to, as (kind, src,
+                         dst) tuples of full paths
+
+    @return     Number of operations, directories to make, copies of lcl and
+                rmt as they will be after the sync.
+    """
+    track = Struct()
     track.lcl = lcl.path
     track.rmt = rmt.path
     track.total = total
     track.dry = dry_run
     track.case = case
-    track.count = 0
-    track.pool = SubPool(NUMBER_OF_WORKERS)
-    track.rclone_flags = [] if flags is None else flags
+    track.backend = backend
+    track.ops = ops
 
     cp_lcl = deepcopy(lcl)
     cp_rmt = deepcopy(rmt)
 
     if recover:
-        match_states(cp_lcl, cp_rmt, recover=True)
-        match_states(cp_rmt, cp_lcl, recover=True)
+        match_states(track, cp_lcl, cp_rmt, recover=True)
+        match_states(track, cp_rmt, cp_lcl, recover=True)
     else:
-        match_moves(old, cp_lcl, cp_rmt)
-        match_moves(old, cp_rmt, cp_lcl)
+        match_moves(track, old, cp_lcl, cp_rmt)
+        match_moves(track, old, cp_rmt, cp_lcl)
 
         cp_lcl.clean()
         cp_rmt.clean()
-        track.pool.wait()
+        wait(track)
 
-        match_states(cp_lcl, cp_rmt, recover=False)
-        match_states(cp_rmt, cp_lcl, recover=False)
+        match_states(track, cp_lcl, cp_rmt, recover=False)
+        match_states(track, cp_rmt, cp_lcl, recover=False)
 
-    track.pool.wait()
+    wait(track)
 
     dirs = (cp_lcl.dirs - lcl.dirs) | (cp_rmt.dirs - rmt.dirs)
 
     return track.count, dirs, cp_lcl, cp_rmt
 
 
+def top(name):
+    # Returns the key of the partition name belongs to, its directory. Case
+    # is ignored so names that can clash share a partition.
+    return name.rpartition("/")[0].lower()
+
+
+def partition(lcl, rmt, old, parts):
+    """
+    @brief      Splits the files of a folder into independent groups: files in
+                different groups have different directories (ignoring case)
+                and uids, so no move, clone or case clash crosses groups.
+
+    @param      lcl    Flat of the lcl directory
+    @param      rmt    Flat of the rmt directory
+    @param      old    Flat of the past state of lcl and rmt
+    @param      parts  Number of groups to pack the independent directories into
+
+    @return     Dict mapping partition keys (see top) to group numbers.
+    """
+    parent = {}
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    # Union directories that share a uid.
+    owner = {}
+    for flat in (lcl, rmt, old):
+        for name, file in flat.names.items():
+            k = top(name)
+            parent.setdefault(k, k)
+
+            other = owner.setdefault(file.uid, k)
+            if other != k:
+                parent[find(k)] = find(other)
+
+    sizes = {}
+    for flat in (lcl, rmt, old):
+        for name in flat.names:
+            root = find(top(name))
+            sizes[root] = sizes.get(root, 0) + 1
+
+    # Pack the components into parts groups, largest first.
+    load = [0] * parts
+    group = {}
+    for root in sorted(sizes, key=sizes.get, reverse=True):
+        g = load.index(min(load))
+        load[g] += sizes[root]
+        group[root] = g
+
+    return {k: group[find(k)] for k in parent}
+
+
+def to_rows(flat):
+    # Returns the files of flat as (name, *dump) rows, which pickle much
+    # faster than Files.
+    return [(name,) + file.dump() for name, file in flat.names.items()]
+
+
+def split(flat, groups, n):
+    # Splits the rows of flat into n lists by the group of their partition.
+    out = [[] for _ in range(n)]
+    for row in to_rows(flat):
+        out[groups[top(row[0])]].append(row)
+
+    return out
+
+
+def build(path, rows):
+    # Builds a Flat from rows, see to_rows.
+    flat = Flat(path)
+    for row in rows:
+        flat.update(*row)
+
+    return flat
+
+
+def _plan_part(args):
+    # Dry runs sync on one partition in a worker process. Returns the number
+    # of operations, rows of lcl and rmt after, the operations, the printed
+    # output and the planned bytes.
+    paths, rows, recover, case = args
+    lcl, rmt, old = (build(p, r) for p, r in zip(paths, rows))
+
+    ops = []
+    planned = telemetry.planned
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        count, _, cp_lcl, cp_rmt = sync(
+            lcl, rmt, old, recover, dry_run=True, case=case, ops=ops
+        )
+
+    after = (to_rows(cp_lcl), to_rows(cp_rmt))
+    text = out.getvalue()
+
+    return count, after, ops, text, telemetry.planned - planned
+
+
+def sync_parallel(lcl, rmt, old=None, recover=False, case=True, procs=None):
+    """
+    @brief      Plans (dry run only) a two-way sync by splitting the folder
+                into independent partitions and running sync on them in a
+                process pool. Gives the same operations as sync.
+
+    @param      lcl      Flat of the lcl directory
+    @param      rmt      Flat of the rmt directory
+    @param      old      Flat of the past state of lcl and rmt
+    @param      recover  Flag to use recovery logic
+    @param      case     Flag to do case insensitive name checking
+    @param      procs    Number of processes, defaults to the cpu count
+
+    @return     Number of operations, directories to make, copies of lcl and
+                rmt as they will be after the sync, list of the operations.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    old = Flat(lcl.path) if old is None else old
+    procs = os.cpu_count() if procs is None else procs
+    n = procs * 4
+
+    groups = partition(lcl, rmt, old, n)
+    paths = (lcl.path, rmt.path, old.path)
+    jobs = [
+        (paths, rows, recover, case)
+        for rows in zip(*(split(f, groups, n) for f in (lcl, rmt, old)))
+        if rows[0] or rows[1]
+    ]
+
+    with ProcessPoolExecutor(max_workers=procs) as executor:
+        results = list(executor.map(_plan_part, jobs))
+
+    count = 0
+    ops = []
+    lcl_rows, rmt_rows = [], []
+
+    for part_count, after, part_ops, text, planned in results:
+        count += part_count
+        ops += part_ops
+        lcl_rows += after[0]
+        rmt_rows += after[1]
+        sys.stdout.write(text)
+        telemetry.plan(planned)
+
+    cp_lcl = build(lcl.path, lcl_rows)
+    cp_rmt = build(rmt.path, rmt_rows)
+    dirs = (cp_lcl.dirs - lcl.dirs) | (cp_rmt.dirs - rmt.dirs)
+
+    return count, dirs, cp_lcl, cp_rmt, ops
+
+
 def calc_states(old, new):
     """
     @brief      Calculates if files on one side have been updated, moved,
@@ -71,7 +244,7 @@ def calc_states(old, new):
 
     @return     None.
     """
-    new_before_deletes = tuple(new.names.keys())
+    new_before_deletes = new.snapshot(sort=False)
 
     for name, file in old.names.items():
         if name not in new.names and (
@@ -99,19 +272,20 @@ def calc_states(old, new):
             file.state = CREATED
 
 
-def match_states(lcl, rmt, recover):
+def match_states(track, lcl, rmt, recover):
     """
     @brief      Basic sync of files in lcl to remote given all moves performed.
                 Uses LOGIC array to determine actions, see bottom of file. If
                 recover keeps newest file.
 
+    @param      track    Struct of the sync in progress
     @param      lcl      Flat of the lcl directory
     @param      rmt      Flat of the rmt directory
     @param      recover  Flag to use recovery logic
 
     @return     None.
     """
-    names = sorted(lcl.names.keys())
+    names = lcl.snapshot()
 
     for name in names:
         file = lcl.names[name]
@@ -124,31 +298,32 @@ def match_states(lcl, rmt, recover):
         if name in rmt.names:
             rmt.names[name].synced = True
             if not recover:
-                LOGIC[file.state][rmt.names[name].state](name, name, lcl, rmt)
+                LOGIC[file.state][rmt.names[name].state](
+                    track, name, name, lcl, rmt
+                )
             elif file.uid != rmt.names[name].uid:
                 if file.time > rmt.names[name].time:
-                    push(name, name, lcl, rmt)
+                    push(track, name, name, lcl, rmt)
                 else:
-                    pull(name, name, lcl, rmt)
+                    pull(track, name, name, lcl, rmt)
         elif file.state != DELETED:
-            safe_push(name, lcl, rmt)
+            safe_push(track, name, lcl, rmt)
         else:
             print(red("WARN:"), "unpaired deleted:", lcl.path, name)
 
 
-def match_moves(old, lcl, rmt):
+def match_moves(track, old, lcl, rmt):
     """
     @brief      Mirrors file moves in lcl by moving files in rmt.
 
-    @param      old   Flat of the past state of lcl and rmt
-    @param      lcl   Flat of the lcl directory
-    @param      rmt   Flat of the rmt directory
+    @param      track  Struct of the sync in progress
+    @param      old    Flat of the past state of lcl and rmt
+    @param      lcl    Flat of the lcl directory
+    @param      rmt    Flat of the rmt directory
 
     @return     None.
     """
-    global track
-
-    names = sorted(lcl.names.keys())
+    names = lcl.snapshot()
 
     for name in names:
         if name not in lcl.names:
@@ -187,14 +362,14 @@ def match_moves(old, lcl, rmt):
                 mvd_lcl = lcl.uids[old.names[name].uid]
                 mvd_lcl.synced = True
 
-                safe_move(name, mvd_lcl.name, rmt, lcl)
+                safe_move(track, name, mvd_lcl.name, rmt, lcl)
             else:
                 # Not deleted, not supposed to be moved, not been moved.
                 # Therefore rename rmt and procced with matching files move.
-                nn = resolve_case(name, rmt)
-                move(name, nn, rmt)
+                nn = resolve_case(track, name, rmt)
+                move(track, name, nn, rmt)
                 # Must wait for rename
-                track.pool.wait()
+                wait(track)
 
         trace, f_rmt = trace_rmt(file, old, rmt)
 
@@ -203,22 +378,22 @@ def match_moves(old, lcl, rmt):
 
             if f_rmt.state == DELETED:
                 # Delete shy. Will trigger unpaired delete warn in match states.
-                safe_push(name, lcl, rmt)
+                safe_push(track, name, lcl, rmt)
             else:
                 # Move complimentary in rmt.
-                safe_move(f_rmt.name, name, rmt, lcl)
+                safe_move(track, f_rmt.name, name, rmt, lcl)
 
         elif trace == MOVED:
             # Give preference to remote moves.
             f_rmt.synced = True
-            safe_move(name, f_rmt.name, lcl, rmt)
+            safe_move(track, name, f_rmt.name, lcl, rmt)
 
         elif trace == CLONE:
-            safe_push(name, lcl, rmt)
+            safe_push(track, name, lcl, rmt)
 
         elif trace == NOTHERE:
             # This should never happen?
-            safe_push(name, lcl, rmt)
+            safe_push(track, name, lcl, rmt)
 
 
 def trace_rmt(file, old, rmt):
@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench(script, *args):
+    # Runs a benchmark script on a small input and returns its json report.
+    out = subprocess.run(
+        [sys.executable, os.path.join("benchmarks", script)] + list(args),
+        stdout=subprocess.PIPE,
+        cwd=ROOT,
+        check=True,
+    )
+    return json.loads(out.stdout)
+
+
+def test_bench_sync_runs():
+    report = bench("bench_sync.py", "--files", "300", "1000")
+
+    assert [r["files"] for r in report["results"]] == [300, 1000]
+    for result in report["results"]:
+        assert result["ops"] > 0
+        assert "match_states" in result["phases"]
+
+
+def test_bench_list_runs():
+    args = ("--dirs", "20", "--latency", "0", "--workers", "2", "3")
+    report = bench("bench_list.py", *args)
+
+    assert report["entries"] == 20 * 5 + 5
+    assert set(report["wall"]) == {"sequential", "fan_out_2", "fan_out_3"}
+
+
+def test_bench_packed_runs():
+    report = bench("bench_packed.py", "--files", "300", "--depth", "3", "50")
+
+    assert set(report["wall"]) == {"depth_3", "depth_50"}
@@ -0,0 +1,84 @@
+import os
+
+from rsinc.backends import Budget, Local, Memory
+from rsinc.session import SyncSession
+
+
+def memory():
+    backend = Memory()
+    for name, size in (("big", 5000), ("a", 400), ("b", 400), ("c", 400)):
+        backend.put("r:" + name, size, name)
+    return backend
+
+
+def test_first_copy_runs_even_if_too_big():
+    budget = Budget(memory(), max_bytes=1000)
+
+    budget.copy("r:big", "l:big", 5000)
+    budget.copy("r:a", "l:a", 400)
+    budget.move("r:b", "l:b")
+    budget.delete("r:c")
+
+    assert budget.refused == {"r:a", "l:a"}
+    assert "l:big" in budget.backend.files
+    assert "l:b" in budget.backend.files
+    assert "r:c" not in budget.backend.files
+    assert budget.over()
+
+
+def test_copies_that_do_not_fit_are_skipped():
+    budget = Budget(memory(), max_bytes=1000)
+
+    budget.copy("r:a", "l:a", 400)
+    budget.copy("r:big", "l:big", 5000)
+    budget.copy("r:b", "l:b", 400)
+    budget.copy("r:c", "l:c", 400)
+
+    assert budget.refused == {"r:big", "l:big", "r:c", "l:c"}
+    assert budget.sent == 800
+    assert not budget.over()
+    assert budget.failures() == {"r:big", "l:big", "r:c", "l:c"}
+    budget.forget()
+    assert budget.failures() == set()
+
+
+def test_out_of_time_refuses_everything():
+    budget = Budget(memory(), seconds=-1)
+
+    budget.copy("r:a", "l:a", 400)
+    budget.move("r:b", "l:b")
+    budget.delete("r:c")
+
+    assert budget.refused == {"r:a", "l:a", "r:b", "l:b", "r:c"}
+    assert budget.over()
+
+
+def test_runs_make_progress_past_a_big_file(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    os.makedirs(os.path.join(lcl, "f"))
+    os.makedirs(os.path.join(rmt, "f"))
+    for name, size in (("a_big", 5000), ("b", 600), ("c", 600)):
+        with open(os.path.join(lcl, "f", name), "w") as fp:
+            fp.write("x" * size)
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "MAX_BYTES": 1000,
+    }
+
+    synced = []
+    for _ in range(3):
+        # A new session, and budget, for each run.
+        session = SyncSession(config, Local({"r:": rmt}))
+        plan = session.plan("f")
+        session.execute(plan)
+        session.commit()
+        synced.append(sorted(os.listdir(os.path.join(rmt, "f"))))
+
+    assert synced == [["a_big"], ["a_big", "b"], ["a_big", "b", "c"]]
@@ -0,0 +1,123 @@
+import contextlib
+import io
+import os
+import time
+from copy import deepcopy
+
+from rsinc.backends import Local
+from rsinc.classes import Flat
+from rsinc.disk import DiskFlat
+from rsinc.session import SyncSession
+from rsinc.sync import sync, calc_states
+
+
+def sides(make):
+    # Old, lcl and rmt of a folder with each kind of change in it, made into
+    # Flats by make.
+    old = {"a/%d" % i: "u%d" % i for i in range(6)}
+    lcl, rmt = dict(old), dict(old)
+
+    lcl["a/0"] = "x0"  # Updated.
+    lcl["a/1"], rmt["a/1"] = "x1", "y1"  # Conflict.
+    del rmt["a/2"]  # Deleted.
+    lcl["b/moved"] = lcl.pop("a/3")  # Moved.
+    rmt["A/4"] = "z"  # Clashes with a/4 ignoring case.
+    lcl["a/clone"] = "u5"  # Clone.
+
+    out = []
+    for path, files in (("/l", old), ("/l", lcl), ("/r", rmt)):
+        flat = Flat(path)
+        for name, uid in files.items():
+            flat.update(name, uid, size=len(uid))
+        out.append(make(flat))
+
+    old, lcl, rmt = out
+    calc_states(old, lcl)
+    calc_states(old, rmt)
+    return lcl, rmt, old
+
+
+def plan(make):
+    # Dry runs sync on sides(make), returning everything it gives.
+    ops = []
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        count, dirs, cp_lcl, cp_rmt = sync(*sides(make), ops=ops)
+
+    files = [
+        sorted((n, f.dump()) for n, f in flat.names.items())
+        for flat in (cp_lcl, cp_rmt)
+    ]
+    return count, dirs, ops, out.getvalue(), files
+
+
+def test_disk_flats_plan_the_same_as_flats():
+    expect = plan(lambda flat: flat)
+    got = plan(DiskFlat.copy_of)
+
+    assert got == expect
+    assert expect[0] == 10
+
+
+def test_disk_flat_copies_are_independent():
+    flat = DiskFlat("/l")
+    flat.update("a", "u1", size=2)
+    flat.update("b", "u1", size=2)
+    copy = deepcopy(flat)
+
+    copy.rm("a")
+    copy.names["b"].synced = True
+    copy.update("c", "u2", size=2)
+
+    assert sorted(flat.names) == ["a", "b"]
+    assert not flat.names["b"].synced
+    assert flat.names["b"].is_clone and "u2" not in flat.uids
+    assert sorted(copy.names) == ["b", "c"]
+    assert copy.names["b"].synced and "a" not in copy.lower
+
+
+def test_sessions_over_the_memory_limit_sync(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    os.makedirs(os.path.join(lcl, "f"))
+    os.makedirs(os.path.join(rmt, "f"))
+    for i in range(150):
+        with open(os.path.join(lcl, "f", "%d.txt" % i), "w") as fp:
+            fp.write(str(i))
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "MEMORY_LIMIT_MB": 1,
+    }
+
+    def run():
+        session = SyncSession(config, Local({"r:": rmt}))
+        plan = session.plan("f")
+        session.execute(plan)
+        session.commit()
+        return plan
+
+    assert run()["disk"]
+    assert sorted(os.listdir(os.path.join(rmt, "f"))) == sorted(
+        os.listdir(os.path.join(lcl, "f"))
+    )
+
+    os.remove(os.path.join(lcl, "f", "0.txt"))
+    os.rename(os.path.join(lcl, "f", "1.txt"), os.path.join(lcl, "f", "x"))
+    with open(os.path.join(rmt, "f", "2.txt"), "w") as fp:
+        fp.write("edited")
+    stamp = time.time() + 10
+    os.utime(os.path.join(rmt, "f", "2.txt"), (stamp, stamp))
+
+    plan = run()
+    assert plan["disk"] and plan["total"] == 3
+    assert not os.path.exists(os.path.join(rmt, "f", "0.txt"))
+    assert os.path.exists(os.path.join(rmt, "f", "x"))
+    with open(os.path.join(lcl, "f", "2.txt")) as fp:
+        assert fp.read() == "edited"
+
+    assert run()["total"] == 0
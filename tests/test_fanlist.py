@@ -0,0 +1,53 @@
+import os
+
+from rsinc.backends import Local
+
+
+def tree(root):
+    # Makes a tree wide and deep enough for fan_list to list in parts.
+    for i in range(6):
+        for j in range(4):
+            d = os.path.join(root, "d%d" % i, "e%d" % j, "f")
+            os.makedirs(d)
+            with open(os.path.join(d, "x"), "w") as fp:
+                fp.write("%d%d" % (i, j))
+        with open(os.path.join(root, "d%d" % i, "y"), "w") as fp:
+            fp.write(str(i))
+    with open(os.path.join(root, "z"), "w") as fp:
+        fp.write("z")
+
+
+def test_fan_list_finds_what_list_does(tmp_path):
+    tree(str(tmp_path))
+    backend = Local({"r:": str(tmp_path)}, workers=3, fanout=["r:"])
+
+    entries, hashes = backend.fan_list("r:")
+
+    assert sorted(entries) == sorted(backend.list("r:"))
+    assert len(entries) == 6 * 4 + 6 + 1
+    assert hashes == {}
+
+
+def test_lsl_fans_only_under_its_prefixes(tmp_path):
+    tree(str(tmp_path))
+    plain = Local({"r:": str(tmp_path)})
+    fanned = Local({"r:": str(tmp_path)}, workers=3, fanout=["r:d"])
+    calls = []
+    list_dirs = fanned.list_dirs
+
+    def counted(*args):
+        calls.append(args[:2])
+        return list_dirs(*args)
+
+    fanned.list_dirs = counted
+
+    for path in ("r:", "r:d1"):
+        want = plain.lsl(path, "SHA-1")
+        got = fanned.lsl(path, "SHA-1")
+        assert {n: f.uid for n, f in got.names.items()} == {
+            n: f.uid for n, f in want.names.items()
+        }
+
+    # Only r:d1 was fanned out, starting at its root.
+    assert calls[0] == ("r:d1", "") and len(calls) > 1
+    assert set(path for path, _ in calls) == {"r:d1"}
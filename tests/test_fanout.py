@@ -0,0 +1,69 @@
+import os
+import time
+
+from rsinc.backends import Local
+from rsinc.session import FanOut
+
+
+def make(tmp_path):
+    # A FanOut syncing folder "f" of lcl to the remotes r1: and r2:.
+    roots = {}
+    for name in ("lcl", "r1", "r2"):
+        os.makedirs(str(tmp_path / name / "f"))
+        roots[name + ":"] = str(tmp_path / name)
+
+    config = {
+        "BASE_L": roots["lcl:"],
+        "BASE_R": "r1:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "REMOTES": [{}, {"BASE_R": "r2:"}],
+    }
+    return FanOut(config, Local(roots)), roots
+
+
+def run(fan):
+    plans = fan.plan("f")
+    fan.execute(plans)
+    fan.commit()
+
+
+def edit(path, text):
+    with open(path, "w") as fp:
+        fp.write(text)
+
+    # Each edit is newer than the last, whatever the clock's resolution.
+    stamp = time.time() + len(text)
+    os.utime(path, (stamp, stamp))
+
+
+def contents(root):
+    out = {}
+    for name in os.listdir(os.path.join(root, "f")):
+        with open(os.path.join(root, "f", name)) as fp:
+            out[name] = fp.read()
+
+    return out
+
+
+def test_two_remotes_editing_one_file_conflict(tmp_path):
+    fan, roots = make(tmp_path)
+    edit(os.path.join(roots["lcl:"], "f", "x.txt"), "base")
+    run(fan)
+
+    edit(os.path.join(roots["r1:"], "f", "x.txt"), "one")
+    edit(os.path.join(roots["r2:"], "f", "x.txt"), "two!")
+    run(fan)
+    run(fan)
+
+    # Kept as a conflict, as with a single remote, and left alone after.
+    both = {"lcl_x.txt": "one", "rmt_x.txt": "two!"}
+    for root in roots.values():
+        assert contents(root) == both
+
+    run(fan)
+    for root in roots.values():
+        assert contents(root) == both
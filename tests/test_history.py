@@ -0,0 +1,66 @@
+import os
+
+import ujson
+
+from rsinc.backends import Local
+from rsinc.history import History
+from rsinc.session import SyncSession
+
+
+def test_only_added_paths_are_in_the_history():
+    history = History()
+    history.update(["/l/a/b", "/l/a/b/c/", "/l/x"])
+
+    assert "/l/a/b" in history
+    assert "/l/a/b/" in history
+    assert "/l/a/b/c" in history
+    assert "/l/x" in history
+    assert "/l/a" not in history
+    assert "/l" not in history
+    assert "/l/a/b/c/d" not in history
+    assert "/l/x/y" not in history
+    assert "/l/y" not in history
+
+    history.add("/l/a")
+    assert "/l/a" in history and "/l/a/b/c" in history
+
+
+def test_history_loads_its_dump_and_old_lists():
+    history = History()
+    history.update(["/l/a/b", "/l/a", "/l/c"])
+    saved = ujson.loads(ujson.dumps(history.dump()))
+
+    for loaded in (History(saved), History(["/l/a/b", "/l/a", "/l/c"])):
+        assert loaded.dump() == history.dump()
+        assert "/l/a" in loaded and "/l/a/b" in loaded
+        assert "/l/b" not in loaded
+
+
+def test_synced_subfolders_are_not_first_synced_again(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    os.makedirs(os.path.join(lcl, "f", "sub"))
+    os.makedirs(os.path.join(rmt, "f"))
+    with open(os.path.join(lcl, "f", "sub", "a"), "w") as fp:
+        fp.write("a")
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+    }
+
+    session = SyncSession(config, Local({"r:": rmt}))
+    assert session.prepare("f/sub")["recover"]
+    plan = session.plan("f")
+    session.execute(plan)
+    session.commit()
+
+    # A new session reads the history back from master.
+    session = SyncSession(config, Local({"r:": rmt}))
+    assert not session.prepare("f")["recover"]
+    assert not session.prepare("f/sub")["recover"]
+    assert session.prepare("g")["recover"]
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be imported when they are used.
+LAZY = ("halo", "pyfiglet", "tqdm", "rfc3339", "cProfile", "pstats")
+
+# Well above the usual import time, so only a real regression fails.
+BUDGET_MS = 500
+
+
+def import_rsinc():
+    # Returns (cumulative ms importing rsinc.rsinc, set of modules imported).
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import rsinc.rsinc"],
+        stderr=subprocess.PIPE,
+        cwd=ROOT,
+        check=True,
+    )
+
+    total = None
+    modules = set()
+    for line in out.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        modules.add(name)
+        if name == "rsinc.rsinc":
+            total = int(cumulative) / 1000
+
+    return total, modules
+
+
+def test_heavy_modules_are_not_imported_eagerly():
+    _, modules = import_rsinc()
+    assert sorted(m for m in modules if m.split(".")[0] in LAZY) == []
+
+
+def test_import_time():
+    import_rsinc()  # Warm up the bytecode cache.
+    assert min(import_rsinc()[0] for _ in range(3)) < BUDGET_MS
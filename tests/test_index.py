@@ -0,0 +1,121 @@
+import os
+import time
+
+from rsinc.backends import Local, Memory
+from rsinc.classes import Flat
+from rsinc.index import INDEX, read_index, updated, write_index
+from rsinc.session import SyncSession
+
+
+class Counted(Local):
+    # Local backend recording the names hashed in remote folders.
+
+    def __init__(self, roots):
+        super().__init__(roots)
+        self.hashed = []
+
+    def hash(self, path, hash_name, names=None):
+        out = super().hash(path, hash_name, names)
+        if path.startswith("r:"):
+            self.hashed += sorted(out)
+        return out
+
+
+def edit(path, text):
+    with open(path, "w") as fp:
+        fp.write(text)
+
+    stamp = time.time() + len(text)
+    os.utime(path, (stamp, stamp))
+
+
+def test_index_round_trip():
+    backend = Memory()
+
+    cache = {
+        "r:f/a": (1, 10.0, "h1"),
+        "r:f/d/b": (2, 20.0, "h2"),
+        "r:g/c": (3, 30.0, "h3"),
+        "r:f/" + INDEX: (4, 40.0, "h4"),
+    }
+    write_index(backend, "r:f", "SHA-1", cache)
+
+    index = {k: v for k, v in cache.items() if k.startswith("r:f/")}
+    del index["r:f/" + INDEX]
+    assert read_index(backend, "r:f", "SHA-1") == index
+    assert read_index(backend, "r:f", "MD5") == {}
+    assert read_index(backend, "r:g", "SHA-1") == {}
+
+    backend.write("r:f/" + INDEX, b"garbage")
+    assert read_index(backend, "r:f", "SHA-1") == {}
+
+
+def test_updated_keeps_only_known_hashes():
+    lcl = Flat("/l")
+    lcl.update("new", "5hnew", size=5)
+    known = {
+        "r:f/a": (1, 10.0, "ha"),
+        "r:f/b": (1, 10.0, "hb"),
+        "r:f/c": (1, 10.0, "hc"),
+        "r:f/d": (1, 10.0, "hd"),
+    }
+    ops = [
+        ("copy", "/l/new", "r:f/new"),
+        ("move", "r:f/a", "r:f/moved"),
+        ("delete", "r:f/b", None),
+        ("copy", "/l/new", "r:f/failed"),
+    ]
+    entries = [
+        ("new", 5, 50.0),
+        ("moved", 1, 60.0),
+        ("failed", 5, 50.0),
+        ("c", 1, 10.0),  # Unchanged.
+        ("d", 2, 10.0),  # Changed outside rsinc.
+    ]
+
+    out = updated(known, ops, {"r:f/failed"}, lcl, "r:f", entries)
+
+    assert out == {
+        "r:f/new": (5, 50.0, "hnew"),
+        "r:f/moved": (1, 60.0, "ha"),
+        "r:f/c": (1, 10.0, "hc"),
+    }
+
+
+def test_indexed_remotes_only_hash_changed_files(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    os.makedirs(os.path.join(lcl, "f"))
+    os.makedirs(os.path.join(rmt, "f"))
+    for name in ("a", "b", "c"):
+        edit(os.path.join(lcl, "f", name), name)
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "HASH_INDEX": ["r:"],
+    }
+
+    def run():
+        backend = Counted({"r:": rmt})
+        session = SyncSession(config, backend)
+        plan = session.plan("f")
+        session.execute(plan)
+        session.commit()
+        return plan["total"], backend.hashed
+
+    assert run() == (3, [])
+    assert os.path.exists(os.path.join(rmt, "f", INDEX))
+    assert run() == (0, [])
+
+    edit(os.path.join(rmt, "f", "b"), "edited")
+    assert run() == (1, ["b"])
+    assert run() == (0, [])
+
+    with open(os.path.join(lcl, "f", "b")) as fp:
+        assert fp.read() == "edited"
+    assert not os.path.exists(os.path.join(lcl, "f", INDEX))
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+from rsinc import rsinc
+from rsinc.backends import Local
+from rsinc.session import SyncSession, rounds
+
+
+class Counting(Local):
+    # Local backend with slow copies, logging when each runs.
+    def __init__(self, roots):
+        super().__init__(roots)
+        self.copies = []
+        self.lock = threading.Lock()
+
+    def copy(self, src, dst, size=0):
+        start = time.monotonic()
+        time.sleep(0.2)
+        super().copy(src, dst, size)
+        with self.lock:
+            self.copies.append((dst, start, time.monotonic()))
+
+
+def make(tmp_path, monkeypatch, names):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    for name in names:
+        path = os.path.join(lcl, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write(name)
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+    }
+    backend = Counting({"r:": rmt})
+    args = rsinc.build_parser().parse_args(["-a", "-j", "4"])
+    monkeypatch.setattr(rsinc, "args", args, raising=False)
+    return SyncSession(config, backend), backend, rmt
+
+
+def test_rounds_keep_overlapping_folders_apart():
+    assert rounds(["a", "b", "c"]) == [["a", "b", "c"]]
+    assert rounds(["a", "a/b", "c", "a/b/d"]) == [
+        ["a", "c"],
+        ["a/b"],
+        ["a/b/d"],
+    ]
+    assert rounds(["a/b", "a", "b"]) == [["a/b", "b"], ["a"]]
+
+
+def test_live_passes_run_at_once(tmp_path, monkeypatch):
+    names = ["%s/x.txt" % f for f in "abcd"]
+    session, backend, rmt = make(tmp_path, monkeypatch, names)
+
+    rsinc.sync_many(session, list("abcd"), [])
+
+    assert sorted(d for d, _, _ in backend.copies) == [
+        "r:/" + n for n in names
+    ]
+    starts = [start for _, start, _ in backend.copies]
+    ends = [end for _, _, end in backend.copies]
+    assert max(starts) < min(ends)
+
+
+def test_overlapping_folders_are_planned_after_saving(tmp_path, monkeypatch):
+    session, backend, rmt = make(tmp_path, monkeypatch, ["a/b/x.txt"])
+
+    rsinc.sync_many(session, ["a", "a/b"], [])
+
+    assert [d for d, _, _ in backend.copies] == ["r:/a/b/x.txt"]
+    assert os.listdir(os.path.join(rmt, "a", "b")) == ["x.txt"]
+
+    # Both plans used to pull the edit, from the same stale state.
+    with open(os.path.join(rmt, "a", "b", "x.txt"), "w") as fp:
+        fp.write("edited")
+    backend.copies.clear()
+    rsinc.sync_many(session, ["a", "a/b"], [])
+
+    assert [d for d, _, _ in backend.copies] == [
+        str(tmp_path / "lcl" / "a" / "b" / "x.txt")
+    ]
+    with open(str(tmp_path / "lcl" / "a" / "b" / "x.txt")) as fp:
+        assert fp.read() == "edited"
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+import time
+
+from rsinc import lease
+from rsinc.backends import Local
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Tries to take a lease in another process, printing whether it got it.
+TAKE = """
+import sys
+from rsinc import lease
+from rsinc.backends import Local
+
+lease.SETTLE = lease.POLL = 0.05
+root, folder, wait = sys.argv[1:]
+held = lease.Lease(Local({"r:": root}), "r:", folder, 30).acquire(float(wait))
+print(held)
+"""
+
+
+def other(tmp_path, folder, wait=0):
+    # True if another process takes the lease on folder within wait seconds.
+    out = subprocess.run(
+        [sys.executable, "-c", TAKE, str(tmp_path), folder, str(wait)],
+        stdout=subprocess.PIPE,
+        cwd=ROOT,
+        check=True,
+    )
+    return out.stdout.decode().split()[-1] == "True"
+
+
+def make(tmp_path, monkeypatch, folder, ttl=30):
+    monkeypatch.setattr(lease, "SETTLE", 0.05)
+    return lease.Lease(Local({"r:": str(tmp_path)}), "r:", folder, ttl)
+
+
+def test_held_lease_blocks_overlapping_folders(tmp_path, monkeypatch):
+    held = make(tmp_path, monkeypatch, "a")
+    assert held.acquire(0)
+
+    assert not other(tmp_path, "a")
+    assert not other(tmp_path, "a/b")
+    assert other(tmp_path, "c")
+
+    held.release()
+
+
+def test_released_lease_can_be_taken(tmp_path, monkeypatch):
+    held = make(tmp_path, monkeypatch, "a")
+    assert held.acquire(0)
+    held.release()
+
+    assert other(tmp_path, "a")
+
+
+def test_lease_of_a_dead_process_lapses(tmp_path, monkeypatch):
+    # Written once and never renewed, like a host that died.
+    dead = make(tmp_path, monkeypatch, "a", ttl=1)
+    dead.write()
+    assert not other(tmp_path, "a")
+
+    time.sleep(1.1)
+    assert other(tmp_path, "a")
+
+
+def test_waits_for_a_lease_to_be_released(tmp_path, monkeypatch):
+    held = make(tmp_path, monkeypatch, "a")
+    assert held.acquire(0)
+
+    waiting = subprocess.Popen(
+        [sys.executable, "-c", TAKE, str(tmp_path), "a", "10"],
+        stdout=subprocess.PIPE,
+        cwd=ROOT,
+    )
+    time.sleep(0.5)
+    held.release()
+
+    out, _ = waiting.communicate(timeout=10)
+    assert out.decode().split()[-1] == "True"
@@ -0,0 +1,45 @@
+from rsinc.backends import Memory
+from rsinc.session import SyncSession
+
+
+def test_sessions_sync_memory_backends(tmp_path):
+    backend = Memory()
+    for i in range(3):
+        backend.put("/l/f/%d" % i, 10, "h%d" % i, 100)
+    backend.put("r:/f/x", 5, "hx", 100)
+
+    config = {
+        "BASE_L": "/l",
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+    }
+    session = SyncSession(config, backend)
+
+    def sync():
+        plan = session.plan("f")
+        session.execute(plan)
+        session.commit()
+        return plan
+
+    assert sync()["total"] == 4
+    both = {"0": (10, "h0", 100), "1": (10, "h1", 100)}
+    both.update({"2": (10, "h2", 100), "x": (5, "hx", 100)})
+    for base in ("/l/f/", "r:/f/"):
+        files = backend.files.items()
+        assert {k[len(base):]: v for k, v in files if k[:5] == base} == both
+
+    backend.put("r:/f/0", 11, "new", 200)
+    backend.move("/l/f/1", "/l/f/y")
+    ops = [op for op in sync()["ops"] if op[0] != "wait"]
+
+    assert sorted(ops) == [
+        ("copy", "r:/f/0", "/l/f/0"),
+        ("move", "r:/f/1", "r:/f/y"),
+    ]
+    assert backend.files["/l/f/0"] == (11, "new", 200)
+    assert "r:/f/1" not in backend.files and "r:/f/y" in backend.files
+    assert sync()["total"] == 0
@@ -0,0 +1,102 @@
+import hashlib
+import os
+
+from rsinc import native
+
+
+def reference_quickxor(data):
+    # QuickXorHash byte by byte, as OneDrive describes it.
+    width, out = 160, 0
+    for i, byte in enumerate(data):
+        bit = (i * 11) % width
+        out ^= byte << bit
+    out = (out & ((1 << width) - 1)) ^ (out >> width)
+    out ^= len(data) << (width - 64)
+    return out.to_bytes(width // 8, "little").hex()
+
+
+def test_quickxor_matches_the_reference():
+    data = bytes((i * 7 + i // 3) % 256 for i in range(1000))
+    for n in (0, 1, 20, 159, 160, 161, 999, 1000):
+        h = native.QuickXorHash()
+        for start in range(0, n, 37):
+            h.update(data[start:min(n, start + 37)])
+        assert h.hexdigest() == reference_quickxor(data[:n])
+
+
+def test_hashes_are_the_same_read_or_mapped(tmp_path, monkeypatch):
+    path = str(tmp_path / "x")
+    data = os.urandom(5000)
+    with open(path, "wb") as fp:
+        fp.write(data)
+
+    names = ("SHA-1", "MD5", "QuickXorHash")
+    read = native.hash_file(path, names)
+    monkeypatch.setattr(native, "MMAP_MIN", 1024)
+    mapped = native.hash_file(path, names)
+
+    assert read == mapped
+    assert read["SHA-1"] == hashlib.sha1(data).hexdigest()
+    assert read["MD5"] == hashlib.md5(data).hexdigest()
+    assert read["QuickXorHash"] == reference_quickxor(data)
+    assert native.hash_file(str(tmp_path / "missing"), names) is None
+
+
+def test_pool_hashes_the_same(tmp_path, monkeypatch):
+    paths = []
+    for i in range(5):
+        paths.append(str(tmp_path / str(i)))
+        with open(paths[-1], "wb") as fp:
+            fp.write(os.urandom(100 * i))
+
+    sizes = [100 * i for i in range(5)]
+    serial = native.hash_many(paths, sizes, ("SHA-1",))
+    monkeypatch.setattr(native, "POOL_MIN", 0)
+    pooled = native.hash_many(paths, sizes, ("SHA-1",), workers=2)
+
+    assert pooled == serial
+
+
+def test_scan_skips_symlinks_unless_followed(tmp_path):
+    os.makedirs(str(tmp_path / "d" / "e"))
+    for name in ("a", "d/b", "d/e/c"):
+        with open(str(tmp_path / name), "w") as fp:
+            fp.write(name)
+    os.symlink(str(tmp_path / "a"), str(tmp_path / "link"))
+    os.symlink(str(tmp_path / "d"), str(tmp_path / "dlink"))
+
+    plain = sorted(e[0] for e in native.scan(str(tmp_path)))
+    followed = sorted(e[0] for e in native.scan(str(tmp_path), True))
+
+    assert plain == ["a", "d/b", "d/e/c"]
+    assert followed == plain + ["dlink/b", "dlink/e/c", "link"]
+    sizes = {e[0]: e[1] for e in native.scan(str(tmp_path))}
+    assert sizes == {"a": 1, "d/b": 3, "d/e/c": 5}
+
+
+def test_lsl_only_hashes_files_not_in_the_cache(tmp_path, monkeypatch):
+    for name in ("a", "b", "c"):
+        with open(str(tmp_path / name), "w") as fp:
+            fp.write(name)
+
+    hashed = []
+    hash_many = native.hash_many
+
+    def counted(paths, sizes, hash_names, workers=None):
+        hashed.extend(os.path.basename(p) for p in paths)
+        return hash_many(paths, sizes, hash_names, workers)
+
+    monkeypatch.setattr(native, "hash_many", counted)
+
+    cache = {}
+    first = native.lsl(str(tmp_path), "SHA-1", cache=cache)
+    with open(str(tmp_path / "b"), "w") as fp:
+        fp.write("bb")
+    second = native.lsl(str(tmp_path), "SHA-1", cache=cache)
+
+    assert sorted(hashed[:3]) == ["a", "b", "c"]
+    assert hashed[3:] == ["b"]
+    assert first.names["a"].uid == second.names["a"].uid
+    assert first.names["b"].uid != second.names["b"].uid
+    sha = hashlib.sha1(b"bb").hexdigest()
+    assert second.names["b"].uid.endswith(sha)
@@ -0,0 +1,49 @@
+import sys
+
+from rsinc.classes import Flat
+from rsinc.packed import count, drop, get_branch, merge, pack, unpack
+
+
+def flat(names):
+    out = Flat("/l")
+    for name in names:
+        out.update(name, "u" + name)
+
+    return out
+
+
+def files(nest):
+    # Dict of the files in nest, name -> uid.
+    out = Flat("")
+    unpack(nest, out)
+    return {name: f.uid for name, f in out.names.items()}
+
+
+def test_pack_and_unpack_round_trip():
+    names = ["a", "d/b", "d/e/c", "d/e/f", "g/h/i/j"]
+    nest = pack(flat(names))
+
+    assert files(nest) == {name: "u" + name for name in names}
+    assert count(nest) == 5
+    assert files(get_branch(nest, "d/e")) == {"c": "ud/e/c", "f": "ud/e/f"}
+
+
+def test_drop_and_merge():
+    nest = pack(flat(["a", "d/b", "d/e/c"]))
+
+    drop(nest, "d/b")
+    drop(nest, "missing/x")
+    assert files(nest) == {"a": "ua", "d/e/c": "ud/e/c"}
+
+    merge(nest, "d/e", pack(flat(["new"])))
+    merge(nest, "x/y", pack(flat(["z"])))
+    assert files(nest) == {"a": "ua", "d/e/new": "unew", "x/y/z": "uz"}
+
+
+def test_trees_deeper_than_the_recursion_limit():
+    deep = "/".join(["d"] * (sys.getrecursionlimit() + 100))
+    nest = pack(flat([deep + "/x", "y"]))
+
+    assert count(nest) == 2
+    assert files(nest) == {deep + "/x": "u" + deep + "/x", "y": "uy"}
+    assert count(get_branch(nest, deep)) == 1
@@ -0,0 +1,68 @@
+import contextlib
+import io
+
+from rsinc.classes import Flat
+from rsinc.sync import sync, sync_parallel, calc_states, partition
+
+
+def flat(path, files):
+    out = Flat(path)
+    for name, uid in files.items():
+        out.update(name, uid, size=len(uid))
+
+    return out
+
+
+def sides():
+    # Old, lcl and rmt of a folder with each kind of change in it.
+    old = {"a/%d" % i: "u%d" % i for i in range(6)}
+    old.update({"b/%d" % i: "v%d" % i for i in range(6)})
+    lcl, rmt = dict(old), dict(old)
+
+    lcl["a/0"] = "x0"  # Updated.
+    rmt["a/1"] = "y1"
+    lcl["a/2"], rmt["a/2"] = "x2", "y2"  # Conflict.
+    del lcl["a/3"]  # Deleted.
+    lcl["c/moved"] = lcl.pop("b/0")  # Moved to another directory.
+    rmt["b/new"] = "n"  # Created.
+    rmt["A/5"] = "z"  # Clashes with a/5 ignoring case.
+    lcl["b/clone"] = "v1"  # Clone.
+
+    old, lcl, rmt = flat("/l", old), flat("/l", lcl), flat("/r", rmt)
+    calc_states(old, lcl)
+    calc_states(old, rmt)
+    return lcl, rmt, old
+
+
+def result(count, dirs, cp_lcl, ops, text):
+    # The parts of a sync's result that must not depend on how it was run.
+    ops = sorted(op for op in ops if op[0] != "wait")
+    names = sorted((n, f.uid) for n, f in cp_lcl.names.items())
+    lines = sorted(text.splitlines())
+    return count, dirs, names, ops, lines
+
+
+def test_sync_parallel_plans_the_same_as_sync():
+    ops = []
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        count, dirs, cp_lcl, _ = sync(*sides(), ops=ops)
+    expect = result(count, dirs, cp_lcl, ops, out.getvalue())
+
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        count, dirs, cp_lcl, _, ops = sync_parallel(*sides(), procs=2)
+    got = result(count, dirs, cp_lcl, ops, out.getvalue())
+
+    assert got == expect
+    assert expect[0] == 12
+    assert ("move", "/r/b/0", "/r/c/moved") in expect[3]
+    assert ("move", "/r/A/5", "/r/A/_5") in expect[3]
+
+
+def test_partition_keeps_moves_and_case_clashes_together():
+    lcl, rmt, old = sides()
+    groups = partition(lcl, rmt, old, 8)
+
+    # b/0 moved to c, and A shares a's key as case is ignored.
+    assert set(groups) == {"a", "b", "c"}
+    assert groups["b"] == groups["c"]
+    assert groups["a"] != groups["b"]
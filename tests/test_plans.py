@@ -0,0 +1,102 @@
+import os
+import time
+
+from rsinc.backends import Local
+from rsinc.session import SyncSession
+
+
+def edit(path, text):
+    with open(path, "w") as fp:
+        fp.write(text)
+
+    stamp = time.time() + len(text)
+    os.utime(path, (stamp, stamp))
+
+
+def make(tmp_path):
+    # A session syncing folders "f" and "g", with a synced file in each, and
+    # a new file in f.
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    for folder in ("f", "g"):
+        os.makedirs(os.path.join(lcl, folder))
+        os.makedirs(os.path.join(rmt, folder))
+        edit(os.path.join(lcl, folder, "a"), "a")
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+    }
+
+    session = SyncSession(config, Local({"r:": rmt}))
+    for folder in ("f", "g"):
+        sync(session, folder)
+
+    edit(os.path.join(lcl, "f", "b"), "b")
+    os.remove(os.path.join(rmt, "g", "a"))
+    return session, lcl, rmt
+
+
+def sync(session, folder):
+    plan = session.plan(folder)
+    session.execute(plan)
+    session.commit()
+    return plan
+
+
+def export(session, tmp_path):
+    # Plans f and g and writes them to a plan file.
+    file = str(tmp_path / "plan.json")
+    session.export([session.plan("f"), session.plan("g")], file)
+    return file
+
+
+def test_applied_plans_sync_and_save(tmp_path):
+    session, lcl, rmt = make(tmp_path)
+    file = export(session, tmp_path)
+
+    plans = session.apply(file)
+    assert [p["total"] for p in plans] == [1, 1]
+    for plan in plans:
+        session.execute(plan)
+    session.commit()
+
+    assert os.path.exists(os.path.join(rmt, "f", "b"))
+    assert not os.path.exists(os.path.join(lcl, "g", "a"))
+
+    # The saved state is what a sync would have left.
+    assert sync(session, "f")["total"] == 0
+    assert sync(session, "g")["total"] == 0
+
+
+def test_plans_of_changed_files_are_stale(tmp_path):
+    session, lcl, rmt = make(tmp_path)
+    file = export(session, tmp_path)
+
+    edit(os.path.join(lcl, "f", "b"), "bb")
+    plans = session.apply(file)
+
+    assert [p["folder"] for p in plans] == ["g"]
+
+
+def test_plans_of_folders_synced_since_are_stale(tmp_path):
+    session, lcl, rmt = make(tmp_path)
+    file = export(session, tmp_path)
+
+    sync(session, "g")
+    plans = session.apply(file)
+
+    assert [p["folder"] for p in plans] == ["f"]
+    assert [p["folder"] for p in session.apply(file, ["g"])] == []
+
+
+def test_plans_of_another_hash_are_refused(tmp_path):
+    session, lcl, rmt = make(tmp_path)
+    file = export(session, tmp_path)
+
+    session.hash_name = "MD5"
+    assert session.apply(file) == []
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import ujson
+
+from rsinc import rsinc
+from rsinc.backends import Local
+from rsinc.session import FanOut
+
+
+def test_purge_resets_every_remote(tmp_path, monkeypatch):
+    lcl = str(tmp_path / "lcl")
+    os.makedirs(os.path.join(lcl, "f"))
+    with open(os.path.join(lcl, "f", "x.txt"), "w") as fp:
+        fp.write("x")
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": str(tmp_path / "r1"),
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "LOG_FOLDER": str(tmp_path / "logs"),
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "REMOTES": [
+            {},
+            {"BASE_R": str(tmp_path / "r2")},
+            {
+                "BASE_R": str(tmp_path / "r3"),
+                "MASTER": str(tmp_path / "3.json"),
+            },
+        ],
+    }
+    path = str(tmp_path / "config.json")
+    with open(path, "w") as fp:
+        ujson.dump(config, fp)
+
+    fan = FanOut(config, Local())
+    plans = fan.plan("f")
+    fan.execute(plans)
+    fan.commit()
+
+    masters = [s.master for s in fan.sessions]
+    assert masters[1] == str(tmp_path / "master-1.json")
+    for master in masters:
+        with open(master) as fp:
+            assert ujson.load(fp)["history"]
+
+    argv = ["rsinc", "--config_path", path, "-a", "-d", "-p", lcl + "/f"]
+    monkeypatch.setattr(sys, "argv", argv)
+    rsinc.main()
+
+    for master in masters:
+        with open(master) as fp:
+            assert not ujson.load(fp)["history"]
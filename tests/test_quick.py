@@ -0,0 +1,80 @@
+import os
+import time
+
+from rsinc.backends import Local
+from rsinc.session import SyncSession
+
+
+class Counted(Local):
+    # Local backend recording the full paths of the files it hashes.
+
+    def __init__(self, roots):
+        super().__init__(roots)
+        self.hashed = []
+
+    def hash(self, path, hash_name, names=None):
+        out = super().hash(path, hash_name, names)
+        self.hashed += sorted(os.path.join(path, name) for name in out)
+        return out
+
+
+def edit(path, text):
+    with open(path, "w") as fp:
+        fp.write(text)
+
+    stamp = time.time() + len(text)
+    os.utime(path, (stamp, stamp))
+
+
+def test_quick_mode_only_hashes_changed_files(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    os.makedirs(os.path.join(lcl, "f"))
+    os.makedirs(os.path.join(rmt, "f"))
+    for name in ("a", "b", "c"):
+        edit(os.path.join(lcl, "f", name), name)
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "QUICK": True,
+    }
+
+    def run():
+        # A new session each run, so the hashes come from STAMPS.
+        backend = Counted({"r:": rmt})
+        session = SyncSession(config, backend)
+        plan = session.plan("f")
+        session.execute(plan)
+        session.commit()
+        session.save_stamps()
+        return plan["total"], backend.hashed
+
+    total, hashed = run()
+    assert total == 3
+    assert sorted(hashed) == [os.path.join(lcl, "f", n) for n in "abc"]
+    assert os.path.exists(str(tmp_path / "stamps.json"))
+
+    # The copies are hashed the first time they are listed, then never.
+    assert run() == (0, ["r:/f/a", "r:/f/b", "r:/f/c"])
+    assert run() == (0, [])
+
+    edit(os.path.join(rmt, "f", "b"), "edited")
+    edit(os.path.join(lcl, "f", "c"), "edited too")
+    total, hashed = run()
+    assert total == 2
+    # Plus the pulled b, when the synced files are re-listed.
+    assert sorted(hashed) == sorted(
+        ["r:/f/b", os.path.join(lcl, "f", "c"), os.path.join(lcl, "f", "b")]
+    )
+    assert run() == (0, ["r:/f/c"])  # The pushed c, listed again.
+    assert run() == (0, [])
+
+    # Stamps made with another hash are ignored.
+    assert len(SyncSession(config, Local()).hashes) == 6
+    config["HASH_NAME"] = "MD5"
+    assert SyncSession(config, Local()).hashes == {}
@@ -0,0 +1,88 @@
+import os
+import time
+
+from rsinc.backends import Local
+from rsinc.session import SyncSession
+
+
+class Flaky(Local):
+    # Local backend whose copies to paths ending in "bad" fail, recording the
+    # names of every lsl that lists only some files.
+
+    def __init__(self, roots):
+        super().__init__(roots)
+        self.relisted = []
+
+    def copy(self, src, dst, size=0):
+        if dst.endswith("bad"):
+            self.failed.update((src, dst))
+            return
+        super().copy(src, dst, size)
+
+    def lsl(self, path, hash_name, cache=None, names=None, make=None):
+        if names is not None:
+            self.relisted.append(sorted(names))
+        return super().lsl(path, hash_name, cache, names, make)
+
+
+def edit(path, text):
+    with open(path, "w") as fp:
+        fp.write(text)
+
+    stamp = time.time() + len(text)
+    os.utime(path, (stamp, stamp))
+
+
+def make(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    os.makedirs(os.path.join(lcl, "f"))
+    os.makedirs(os.path.join(rmt, "f"))
+    for i in range(10):
+        edit(os.path.join(lcl, "f", str(i)), str(i))
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+    }
+    return config, lcl, rmt
+
+
+def run(config, rmt):
+    backend = Flaky({"r:": rmt})
+    session = SyncSession(config, backend)
+    plan = session.plan("f")
+    session.execute(plan)
+    session.commit()
+    return plan["total"], backend.relisted
+
+
+def test_only_touched_files_are_relisted(tmp_path):
+    config, lcl, rmt = make(tmp_path)
+    run(config, rmt)
+
+    edit(os.path.join(rmt, "f", "1"), "edited")
+    os.rename(os.path.join(lcl, "f", "2"), os.path.join(lcl, "f", "moved"))
+    os.remove(os.path.join(lcl, "f", "3"))
+
+    assert run(config, rmt) == (3, [["1", "2", "3", "moved"]])
+    assert run(config, rmt) == (0, [])
+
+
+def test_failed_files_are_retried(tmp_path):
+    config, lcl, rmt = make(tmp_path)
+    edit(os.path.join(lcl, "f", "bad"), "bad")
+
+    total, _ = run(config, rmt)
+    assert total == 11
+    assert not os.path.exists(os.path.join(rmt, "f", "bad"))
+
+    # Not saved as synced, so the next run pushes it again.
+    edit(os.path.join(lcl, "f", "4"), "changed")
+    assert run(config, rmt)[0] == 2
+    with open(os.path.join(rmt, "f", "4")) as fp:
+        assert fp.read() == "changed"
@@ -0,0 +1,44 @@
+from rsinc.session import roots
+
+TREE = {
+    "docs": {"a", "b", "notes.txt"},
+    "docs/a": {"x"},
+    "docs/b": {"y"},
+    "docs/c": {"z"},
+}
+
+
+def children(path):
+    return TREE.get(path)
+
+
+def test_nested_folders_use_the_outer_one():
+    assert roots(["docs/a", "docs/a/x"], children) == {
+        "docs/a": ["docs/a", "docs/a/x"]
+    }
+
+
+def test_ancestor_with_unsynced_file_is_not_shared():
+    assert roots(["docs/a", "docs/b"], children) == {}
+
+
+def test_ancestor_with_unsynced_folder_is_not_shared():
+    tree = dict(TREE, docs={"a", "b", "c"})
+    assert roots(["docs/a", "docs/b"], tree.get) == {}
+
+
+def test_fully_synced_ancestor_is_shared():
+    tree = {"docs": {"a", "b"}}
+    assert roots(["docs/a", "docs/b"], tree.get) == {
+        "docs": ["docs/a", "docs/b"]
+    }
+
+
+def test_unknown_children_are_not_shared():
+    assert roots(["docs/a", "docs/b"], lambda path: None) == {}
+
+
+def test_folder_serving_only_itself_is_not_shared():
+    assert roots(["docs/a", "docs/b/y", "docs/b"], children) == {
+        "docs/b": ["docs/b", "docs/b/y"]
+    }
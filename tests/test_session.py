@@ -0,0 +1,103 @@
+import os
+import time
+
+import ujson
+
+from rsinc.backends import Local
+from rsinc.session import SyncSession
+
+
+class Counted(Local):
+    # Local backend recording the full paths of the files it hashes.
+
+    def __init__(self, roots):
+        super().__init__(roots)
+        self.hashed = []
+
+    def hash(self, path, hash_name, names=None):
+        out = super().hash(path, hash_name, names)
+        self.hashed += sorted(os.path.join(path, name) for name in out)
+        return out
+
+
+def edit(path, text):
+    with open(path, "w") as fp:
+        fp.write(text)
+
+    stamp = time.time() + len(text)
+    os.utime(path, (stamp, stamp))
+
+
+def make(tmp_path):
+    # Writes a config file for folders "f" and "g" and returns its path.
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    for folder in ("f", "g"):
+        os.makedirs(os.path.join(lcl, folder))
+        os.makedirs(os.path.join(rmt, folder))
+        edit(os.path.join(lcl, folder, "a"), "a")
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+    }
+    path = str(tmp_path / "config.json")
+    with open(path, "w") as fp:
+        ujson.dump(config, fp)
+
+    return path, lcl, rmt
+
+
+def sync(session, folder):
+    plan = session.plan(folder)
+    session.execute(plan)
+    session.commit()
+    return plan["total"]
+
+
+def test_warm_sessions_hash_local_files_once(tmp_path):
+    path, lcl, rmt = make(tmp_path)
+    backend = Counted({"r:": rmt})
+    session = SyncSession(path, backend)
+
+    assert sync(session, "f") == 1
+    assert sync(session, "f") == 0
+    edit(os.path.join(lcl, "f", "b"), "b")
+    assert sync(session, "f") == 1
+
+    local = [p for p in backend.hashed if p.startswith(lcl)]
+    assert sorted(local) == [os.path.join(lcl, "f", n) for n in "ab"]
+
+
+def test_plans_commit_together_and_crashes_are_seen(tmp_path):
+    path, lcl, rmt = make(tmp_path)
+    session = SyncSession(path, Local({"r:": rmt}))
+
+    plans = [session.plan("f"), session.plan("g")]
+    for plan in plans:
+        session.execute(plan)
+
+    # Until the commit another session would recover both.
+    other = SyncSession(path, Local({"r:": rmt}))
+    assert other.crashed() == ["f", "g"]
+
+    session.commit()
+    assert session.crashed() == [] and session.pending == []
+    assert sorted(os.listdir(os.path.join(rmt, "g"))) == ["a"]
+
+
+def test_load_rereads_master(tmp_path):
+    path, lcl, rmt = make(tmp_path)
+    first = SyncSession(path, Local({"r:": rmt}))
+    second = SyncSession(path, Local({"r:": rmt}))
+
+    sync(second, "f")
+    assert first.prepare("f")["recover"]
+
+    first.load()
+    assert not first.prepare("f")["recover"]
+    assert sync(first, "f") == 0
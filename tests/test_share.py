@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+from rsinc.backends import Local
+
+
+class Slow(Local):
+    # Local backend whose listings take a while and are counted.
+    def __init__(self, roots):
+        super().__init__(roots)
+        self.listed = []
+
+    def list(self, path, names=None):
+        self.listed.append((path, names))
+        time.sleep(0.2)
+        return super().list(path, names)
+
+
+def make(tmp_path):
+    for name in ("a/x", "b", "c"):
+        os.makedirs(str(tmp_path / name))
+        with open(str(tmp_path / name / "f.txt"), "w") as fp:
+            fp.write(name)
+
+    return Slow({"r:": str(tmp_path)})
+
+
+def test_nested_folder_is_served_from_one_listing(tmp_path):
+    backend = make(tmp_path)
+    backend.share({"r:a": ["r:a", "r:a/x"]})
+
+    outer = backend.lsl("r:a", "SHA-1")
+    inner = backend.lsl("r:a/x", "SHA-1")
+
+    assert sorted(outer.names) == ["x/f.txt"]
+    assert sorted(inner.names) == ["f.txt"]
+    assert backend.listed == [("r:a", None)]
+
+
+def test_listing_is_dropped_after_its_last_use(tmp_path):
+    backend = make(tmp_path)
+    backend.share({"r:a": ["r:a", "r:a/x"]})
+
+    backend.lsl("r:a", "SHA-1")
+    assert "r:a" in backend.listings
+
+    backend.lsl("r:a/x", "SHA-1")
+    assert backend.listings == {}
+    assert backend.shared == ()
+
+
+def test_changed_files_are_relisted(tmp_path):
+    backend = make(tmp_path)
+    backend.share({"r:a": ["r:a", "r:a/x"]})
+
+    backend.lsl("r:a", "SHA-1")
+    backend.copy("r:b/f.txt", "r:a/x/g.txt")
+    inner = backend.lsl("r:a/x", "SHA-1")
+
+    assert sorted(inner.names) == ["f.txt", "g.txt"]
+    assert backend.listed[1] == ("r:a", ["x/g.txt"])
+
+
+def test_roots_are_listed_at_once(tmp_path):
+    backend = make(tmp_path)
+    backend.share({"r:b": ["r:b", "r:b"], "r:c": ["r:c", "r:c"]})
+
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=backend.lsl, args=(path, "SHA-1"))
+        for path in ("r:b", "r:c")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert time.monotonic() - start < 0.35
@@ -0,0 +1,150 @@
+import os
+import pstats
+import threading
+
+import ujson
+
+from rsinc.backends import Local
+from rsinc.session import SyncSession
+from rsinc.stats import Stats, label, stats
+
+
+def samples(text):
+    # Parses Prometheus text into a dict mapping "name{labels}" to values,
+    # checking every sample's metric has its HELP and TYPE first.
+    out, typed = {}, set()
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            typed.add(line.split()[2])
+        elif not line.startswith("# HELP "):
+            key, value = line.rsplit(" ", 1)
+            name = key.split("{")[0]
+            base = name.rsplit("_", 1)[0]
+            assert name in typed or base in typed, line
+            out[key] = float(value)
+
+    return out
+
+
+def test_report_and_prometheus_agree():
+    s = Stats()
+    with s.phase("list"):
+        pass
+    with s.phase("list"):
+        pass
+    for seconds in (0.005, 0.02, 0.02, 50, 500):
+        s.op("copyto", seconds)
+    s.count("files_listed", 7)
+    s.count("custom_thing")
+    s.result("copy", "ok")
+    s.result("copy", "ok")
+    s.result("delete", "failed")
+
+    rep = s.report()
+    assert rep["phases"]["list"]["calls"] == 2
+    assert rep["ops"]["copyto"]["count"] == 5
+    assert rep["ops"]["copyto"]["buckets"]["0.03"] == 2
+    assert rep["results"] == {"copy_ok": 2, "delete_failed": 1}
+
+    got = samples(s.prometheus())
+    op = 'rsinc_rclone_op_seconds_bucket{op="copyto",le=%s}'
+    assert got[op % '"0.01"'] == 1
+    assert got[op % '"0.03"'] == 3
+    assert got[op % '"100"'] == 4
+    assert got[op % '"+Inf"'] == 5
+    assert got['rsinc_rclone_op_seconds_count{op="copyto"}'] == 5
+    assert got['rsinc_phase_calls_total{phase="list"}'] == 2
+    assert got['rsinc_ops_total{kind="copy",outcome="ok"}'] == 2
+    assert got['rsinc_ops_total{kind="delete",outcome="failed"}'] == 1
+    assert got["rsinc_files_listed_total"] == 7
+    assert got["rsinc_custom_thing_total"] == 1
+    assert got["rsinc_conflicts_total"] == 0
+
+
+def test_profiles_are_merged_and_never_overlap(tmp_path):
+    s = Stats()
+    with s.profile():
+        sum(range(1000))
+    assert s.profiles == []
+
+    s.profiling = True
+    inside = threading.Event()
+    release = threading.Event()
+
+    def other():
+        with s.profile():
+            inside.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    inside.wait(5)
+    with s.profile():  # Runs unprofiled, the other thread has the profiler.
+        sorted(range(1000))
+    release.set()
+    thread.join()
+    with s.profile():
+        sorted(range(1000))
+
+    assert len(s.profiles) == 2
+    file = str(tmp_path / "prof")
+    s.dump_profile(file)
+    assert pstats.Stats(file).total_calls > 0
+
+
+def test_stats_json_is_the_report(tmp_path):
+    s = Stats()
+    with s.phase("list"):
+        s.count("files_listed", 3)
+
+    file = str(tmp_path / "stats.json")
+    s.write(file)
+    with open(file) as fp:
+        saved = ujson.load(fp)
+
+    assert saved["counts"] == {"files_listed": 3}
+    assert saved["phases"]["list"]["calls"] == 1
+    assert saved["peak_rss_kb"] > 0
+
+
+def test_labels_are_escaped():
+    assert label(op='a"b\\c\nd') == '{op="a\\"b\\\\c\\nd"}'
+
+
+def test_sessions_write_metrics_on_commit(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    os.makedirs(os.path.join(lcl, "f"))
+    os.makedirs(os.path.join(rmt, "f"))
+    for name, size in (("a", 600), ("b", 600)):
+        with open(os.path.join(lcl, "f", name), "w") as fp:
+            fp.write("x" * size)
+
+    metrics = str(tmp_path / "rsinc.prom")
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "MAX_BYTES": 1000,
+        "METRICS_FILE": metrics,
+    }
+
+    # The statistics are of the whole process, so only the change counts.
+    before = dict(stats.results)
+    session = SyncSession(config, Local({"r:": rmt}))
+    plan = session.plan("f")
+    session.execute(plan)
+    session.commit()
+
+    with open(metrics) as fp:
+        got = samples(fp.read())
+    for kind, outcome in (("copy", "ok"), ("copy", "refused")):
+        key = "rsinc_ops_total" + label(kind=kind, outcome=outcome)
+        assert got[key] - before.get((kind, outcome), 0) == 1
+
+    assert got["rsinc_files_listed_total"] >= 2
+    names = os.listdir(str(tmp_path))
+    assert not [n for n in names if n.startswith("rsinc.prom.")]
@@ -0,0 +1,86 @@
+import os
+import time
+
+from rsinc.backends import Local
+from rsinc.session import SyncSession
+
+
+class Timed(Local):
+    # Local backend with slow copies, logging when copies and hashes run.
+    def __init__(self, roots):
+        super().__init__(roots)
+        self.log = []
+
+    def copy(self, src, dst, size=0):
+        self.log.append(("copy", time.monotonic()))
+        time.sleep(0.05)
+        super().copy(src, dst, size)
+
+    def hash(self, path, hash_name, names=None):
+        self.log.append(("hash", time.monotonic()))
+        return super().hash(path, hash_name, names)
+
+
+def write(path, text, stamp):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fp:
+        fp.write(text)
+    os.utime(path, (stamp, stamp))
+
+
+def make(tmp_path):
+    lcl, rmt = str(tmp_path / "lcl"), str(tmp_path / "rmt")
+    for i in range(10):
+        write(os.path.join(lcl, "f", "only%d.txt" % i), "x" * i, 1000)
+
+    write(os.path.join(lcl, "f", "same.txt"), "same", 1000)
+    write(os.path.join(rmt, "f", "same.txt"), "same", 1000)
+    write(os.path.join(lcl, "f", "both.txt"), "old", 1000)
+    write(os.path.join(rmt, "f", "both.txt"), "new!", 2000)
+
+    config = {
+        "BASE_L": lcl,
+        "BASE_R": "r:",
+        "CASE_INSENSATIVE": True,
+        "HASH_NAME": "SHA-1",
+        "MASTER": str(tmp_path / "master.json"),
+        "TEMP_FILE": str(tmp_path / "rsinc.tmp"),
+        "FAST_SAVE": False,
+        "STREAM": True,
+    }
+    backend = Timed({"r:": rmt})
+    return SyncSession(config, backend), backend, lcl, rmt
+
+
+def test_hashing_runs_while_copying(tmp_path):
+    session, backend, lcl, rmt = make(tmp_path)
+
+    plan = session.plan("f")
+    assert "stream" in plan
+    session.execute(plan)
+    session.commit()
+
+    # The ten copies planned from names take 0.5 s, hashing starts long
+    # before the last of them.
+    copies = [t for kind, t in backend.log if kind == "copy"]
+    hashes = [t for kind, t in backend.log if kind == "hash"]
+    assert min(hashes) < copies[5]
+
+    # The newer version of the file on both sides won.
+    with open(os.path.join(lcl, "f", "both.txt")) as fp:
+        assert fp.read() == "new!"
+    assert sorted(os.listdir(os.path.join(lcl, "f"))) == sorted(
+        os.listdir(os.path.join(rmt, "f"))
+    )
+
+
+def test_streamed_state_is_saved(tmp_path):
+    session, backend, lcl, rmt = make(tmp_path)
+
+    plan = session.plan("f")
+    session.execute(plan)
+    session.commit()
+
+    plan = session.plan("f")
+    assert "stream" not in plan
+    assert plan["total"] == 0
@@ -0,0 +1,53 @@
+import os
+
+from rsinc.rsinc import read_targets
+
+
+def write_list(tmp_path, paths):
+    file = tmp_path / "paths.txt"
+    file.write_text("\n".join(paths) + "\n")
+    return str(file)
+
+
+def test_groups_paths_by_deepest_folder(tmp_path):
+    base = str(tmp_path / "base")
+    file = write_list(
+        tmp_path,
+        [
+            os.path.join(base, "a", "x.txt"),
+            os.path.join(base, "a", "b", "y.txt"),
+            "",
+            os.path.join(base, "c", "z.txt"),
+        ],
+    )
+
+    targets = read_targets(file, base, ["a", "a/b"])
+
+    assert targets == {"a": ["x.txt"], "a/b": ["y.txt"]}
+
+
+def test_root_folder(tmp_path):
+    base = str(tmp_path / "base")
+    file = write_list(
+        tmp_path,
+        [
+            os.path.join(base, "x.txt"),
+            os.path.join(base, "d", "y.txt"),
+            os.path.join(base, "a", "..", "z.txt"),
+        ],
+    )
+
+    assert read_targets(file, base, ["."]) == {
+        ".": ["x.txt", "d/y.txt", "z.txt"]
+    }
+
+
+def test_root_does_not_shadow_short_folders(tmp_path):
+    base = str(tmp_path / "base")
+    file = write_list(
+        tmp_path, [os.path.join(base, "a", "x.txt"), base + "/y.txt"]
+    )
+
+    targets = read_targets(file, base, [".", "a"])
+
+    assert targets == {"a": ["x.txt"], ".": ["y.txt"]}
@@ -0,0 +1,56 @@
+import sys
+
+from rsinc.classes import SubPool
+from rsinc.stats import Telemetry, human, stats, telemetry
+
+# Logs rclone's json stats, and a plain line, to stderr then exits with
+# the code given.
+FAKE = """
+import sys
+sys.stderr.write('{"stats": {"bytes": 40, "speed": 8.0, "errors": 2}}\\n')
+sys.stderr.write('not json\\n')
+sys.exit(int(sys.argv[1]))
+"""
+
+
+def test_telemetry_counts_running_and_finished_transfers():
+    t = Telemetry()
+    t.plan(300)
+    assert t.eta() is None
+
+    t.begin("a")
+    t.begin("b")
+    t.update("a", 50, 10.0)
+    t.update("b", 25, 5.0)
+    assert t.transferred() == 75
+    assert t.speed() == 15.0
+    assert t.progress().startswith("[75 B/300 B 15 B/s ETA ")
+
+    t.end("a", 100, True)
+    t.end("b", 100, False)  # Only what was sent counts.
+    assert t.transferred() == 125
+    assert t.transfers == 2
+    assert "125 B in 2 file(s)" in t.summary()
+
+
+def test_human_sizes():
+    assert human(0) == "0 B"
+    assert human(1536) == "1.5 KiB"
+    assert human(3 * 2**30) == "3.0 GiB"
+    assert human(2**50) == "1024.0 TiB"
+
+
+def test_subpool_feeds_rclone_stats_into_telemetry(capfd):
+    done, errors = telemetry.done, stats.counts.get("rclone_errors", 0)
+
+    pool = SubPool(2)
+    for code in (0, 1):
+        pool.run([sys.executable, "-c", FAKE, str(code)], size=100)
+    pool.wait()
+
+    # The failed transfer counts what it sent before failing.
+    assert telemetry.done - done == 140
+    assert stats.counts["rclone_errors"] - errors == 4
+    assert len(pool.take_failed()) == 1
+    assert pool.take_failed() == []
+    assert capfd.readouterr().err.count("not json") == 2